@@ -3,7 +3,7 @@ import threading
 import time
 import telegram
 import re
-from telegram import InlineQueryResultPhoto
+from telegram import InlineQueryResultPhoto, InlineQueryResultCachedPhoto
 from telegram.ext import InlineQueryHandler
 from telegram.error import BadRequest, RetryAfter
 from telegram import ParseMode
@@ -16,7 +16,7 @@ from telegram import (
     InlineKeyboardMarkup,
     InputMediaPhoto,
 )
-from telegram.ext import Updater, Dispatcher, CommandHandler, CallbackQueryHandler
+from telegram.ext import Updater, Dispatcher, CommandHandler, CallbackQueryHandler, ChatMemberHandler
 import json
 import uuid
 import logging
@@ -24,11 +24,15 @@ import urllib.parse
 import random
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 from dotenv import load_dotenv
 import re
 import string
 import math
+import hashlib
+import heapq
+import itertools
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont
 import requests
 from io import BytesIO
@@ -72,8 +76,40 @@ dispatcher = updater.dispatcher
 
 primer_mensaje = True
 
+# ─── Conteo de lecturas a Mongo por comando ──────────────────────────────────
+# Un listener de pymongo suma, en el hilo que la hace, cada operación que lee
+# documentos; log_command reparte esa cuenta por comando (ver /rendimiento).
+_lecturas_hilo    = threading.local()
+_COMANDOS_LECTURA = {"find", "getMore", "aggregate", "count", "distinct", "findAndModify"}
+LECTURAS_MONGO    = {}   # comando -> {"llamadas", "lecturas", "max"}
+
+class _ContadorLecturasMongo(monitoring.CommandListener):
+    def started(self, event):
+        if event.command_name in _COMANDOS_LECTURA:
+            _lecturas_hilo.n = getattr(_lecturas_hilo, "n", 0) + 1
+    def succeeded(self, event):
+        pass
+    def failed(self, event):
+        pass
+
+def lecturas_mongo_hilo():
+    return getattr(_lecturas_hilo, "n", 0)
+
+def registrar_lecturas_comando(comando, lecturas):
+    st = LECTURAS_MONGO.setdefault(comando, {"llamadas": 0, "lecturas": 0, "max": 0})
+    st["llamadas"] += 1
+    st["lecturas"] += lecturas
+    st["max"]       = max(st["max"], lecturas)
+
+def estadisticas_lecturas_mongo():
+    filas = sorted(LECTURAS_MONGO.items(), key=lambda kv: -kv[1]["lecturas"] / kv[1]["llamadas"])[:10]
+    texto = "🧮 <b>Lecturas Mongo por comando</b> (promedio · máx)\n"
+    for comando, st in filas:
+        texto += f"• {comando}: <b>{st['lecturas'] / st['llamadas']:.1f}</b> · {st['max']} ({st['llamadas']} usos)\n"
+    return texto if filas else texto + "• Sin datos aún\n"
+
 # MongoDB setup
-client = MongoClient(MONGO_URI)
+client = MongoClient(MONGO_URI, event_listeners=[_ContadorLecturasMongo()])
 db = client['karuta_bot']
 col_usuarios        = db['usuarios']
 col_cartas_usuario  = db['cartas_usuario']
@@ -83,6 +119,14 @@ col_mercado         = db['mercado_cartas']
 col_historial_ventas= db['historial_ventas']
 col_drops_log       = db['drops_log']
 col_temas_comandos  = db.temas_comandos
+col_config_chats    = db['config_chats']
+col_file_ids        = db['telegram_file_ids']
+col_seriales_sobrantes = db['seriales_sobrantes']
+col_favoritos       = db['favoritos']
+col_resumen_coleccion = db['resumen_coleccion']
+col_drops_activos   = db['drops_activos']
+col_recordatorios   = db['recordatorios_idolday']
+col_migraciones     = db['migraciones']
 
 # Índices
 col_mercado.create_index("id_unico", unique=True)
@@ -92,6 +136,22 @@ col_cartas_usuario.create_index([("user_id", 1), ("id_unico", 1)])  # NUEVO: ín
 col_mercado.create_index("vendedor_id")
 col_usuarios.create_index("user_id", unique=True)
 col_usuarios.create_index("username")   # NUEVO: para búsquedas por username
+col_file_ids.create_index([("url", 1), ("variante", 1)], unique=True)
+col_seriales_sobrantes.create_index([("nombre", 1), ("version", 1), ("grupo", 1)])
+col_favoritos.create_index([("clave", 1), ("user_id", 1)], unique=True)
+col_favoritos.create_index("user_id")
+col_resumen_coleccion.create_index("user_id", unique=True)
+col_drops_activos.create_index("creado", expireAfterSeconds=24 * 3600)
+col_recordatorios.create_index("due_at")
+# Álbum: orden sin distinguir mayúsculas (misma collation que las consultas)
+col_cartas_usuario.create_index(
+    [("user_id", 1), ("grupo", 1), ("nombre", 1), ("card_id", 1), ("id_unico", 1)],
+    collation={"locale": "es", "strength": 2}
+)
+col_cartas_usuario.create_index(
+    [("user_id", 1), ("card_id", 1), ("id_unico", 1)],
+    collation={"locale": "es", "strength": 2}
+)
 
 from pymongo import ASCENDING
 col_mercado.create_index(
@@ -120,18 +180,255 @@ def error_handler(update, context):
 dispatcher.add_error_handler(error_handler)
 # ─────────────────────────────────────────────────────────────────────────────
 
+# ─── Planificador único (heap) para tareas diferidas ─────────────────────────
+# Un solo hilo para expiración de drops, timeouts de trades, borrados diferidos
+# y limpiezas periódicas, en vez de un hilo/Timer dormido por cada tarea.
+_planificador_heap   = []    # (cuando_monotonic, tarea_id)
+_planificador_tareas = {}    # tarea_id -> (fn, args, nombre, intervalo)
+_planificador_cv     = threading.Condition()
+_planificador_seq    = itertools.count(1)
+PLANIFICADOR_STATS   = {"ejecutadas": 0, "canceladas": 0, "errores": 0, "retraso_max_ms": 0.0}
+
+def programar(segundos, fn, *args, nombre=None, intervalo=None):
+    """Ejecuta fn(*args) en `segundos`. Devuelve un id para cancelar_tarea()."""
+    tarea_id = next(_planificador_seq)
+    with _planificador_cv:
+        _planificador_tareas[tarea_id] = (fn, args, nombre or fn.__name__, intervalo)
+        heapq.heappush(_planificador_heap, (time.monotonic() + max(0, segundos), tarea_id))
+        _planificador_cv.notify()
+    return tarea_id
+
+def programar_periodica(intervalo, fn, *args, nombre=None, inicial=None):
+    return programar(intervalo if inicial is None else inicial, fn, *args, nombre=nombre, intervalo=intervalo)
+
+def cancelar_tarea(tarea_id):
+    if tarea_id is None:
+        return False
+    with _planificador_cv:
+        cancelada = _planificador_tareas.pop(tarea_id, None) is not None
+    if cancelada:
+        PLANIFICADOR_STATS["canceladas"] += 1
+    return cancelada
+
+def _bucle_planificador():
+    while True:
+        with _planificador_cv:
+            while True:
+                # Las canceladas se descartan al llegar a la cima del heap
+                while _planificador_heap and _planificador_heap[0][1] not in _planificador_tareas:
+                    heapq.heappop(_planificador_heap)
+                if not _planificador_heap:
+                    _planificador_cv.wait()
+                    continue
+                cuando, tarea_id = _planificador_heap[0]
+                ahora = time.monotonic()
+                if cuando > ahora:
+                    _planificador_cv.wait(cuando - ahora)
+                    continue
+                heapq.heappop(_planificador_heap)
+                fn, args, nombre, intervalo = _planificador_tareas[tarea_id]
+                if intervalo:
+                    heapq.heappush(_planificador_heap, (max(cuando + intervalo, ahora), tarea_id))
+                else:
+                    del _planificador_tareas[tarea_id]
+                break
+        retraso = (ahora - cuando) * 1000
+        PLANIFICADOR_STATS["retraso_max_ms"] = max(PLANIFICADOR_STATS["retraso_max_ms"], retraso)
+        try:
+            fn(*args)
+            PLANIFICADOR_STATS["ejecutadas"] += 1
+        except Exception as e:
+            PLANIFICADOR_STATS["errores"] += 1
+            print(f"[planificador] Error en {nombre}:", e)
+
+def tareas_pendientes():
+    with _planificador_cv:
+        conteo = {}
+        for _, _, nombre, _ in _planificador_tareas.values():
+            conteo[nombre] = conteo.get(nombre, 0) + 1
+    return conteo
+
+def estadisticas_planificador():
+    conteo = tareas_pendientes()
+    st     = PLANIFICADOR_STATS
+    texto  = (
+        f"⏱️ <b>Planificador</b>\n"
+        f"• Pendientes: <b>{sum(conteo.values())}</b> · Ejecutadas: <b>{st['ejecutadas']}</b> · "
+        f"Canceladas: <b>{st['canceladas']}</b> · Errores: <b>{st['errores']}</b>\n"
+        f"• Retraso máx: <b>{st['retraso_max_ms']:.0f}</b> ms\n"
+    )
+    for nombre, n in sorted(conteo.items(), key=lambda x: -x[1]):
+        texto += f"  · {nombre}: {n}\n"
+    return texto
+
+threading.Thread(target=_bucle_planificador, daemon=True, name="planificador").start()
+# ─────────────────────────────────────────────────────────────────────────────
+
+# ─── Cola de borrado de mensajes ─────────────────────────────────────────────
+# Los borrados diferidos (mensajes sueltos del chat general, avisos de cooldown)
+# van a un heap propio que vacía un único hilo a BORRADOS_POR_SEG como máximo.
+# Un RetryAfter pausa toda la cola una sola vez y el mensaje vuelve a ella, en
+# vez de que cada borrado pendiente choque por su cuenta con el flood limit.
+BORRADOS_POR_SEG     = float(os.getenv("BORRADOS_POR_SEG", "15"))
+BORRADOS_COLA_MAX    = int(os.getenv("BORRADOS_COLA_MAX", "10000"))
+BORRADOS_INTENTOS    = 3
+_cola_borrados       = []    # (cuando_monotonic, seq, chat_id, message_id, intentos)
+_borrados_cv         = threading.Condition()
+BORRADOS_STATS = {"encolados": 0, "borrados": 0, "fallidos": 0, "descartados": 0,
+                  "flood_waits": 0, "profundidad_max": 0}
+
+def borrar_mensaje_en(segundos, chat_id, message_id, intentos=0):
+    with _borrados_cv:
+        if len(_cola_borrados) >= BORRADOS_COLA_MAX:
+            BORRADOS_STATS["descartados"] += 1
+            return
+        heapq.heappush(_cola_borrados, (time.monotonic() + max(0, segundos), next(_planificador_seq),
+                                        chat_id, message_id, intentos))
+        BORRADOS_STATS["encolados"] += 1
+        BORRADOS_STATS["profundidad_max"] = max(BORRADOS_STATS["profundidad_max"], len(_cola_borrados))
+        _borrados_cv.notify()
+
+def _trabajador_borrados():
+    while True:
+        with _borrados_cv:
+            while True:
+                if not _cola_borrados:
+                    _borrados_cv.wait()
+                    continue
+                espera = _cola_borrados[0][0] - time.monotonic()
+                if espera > 0:
+                    _borrados_cv.wait(espera)
+                    continue
+                _, _, chat_id, message_id, intentos = heapq.heappop(_cola_borrados)
+                break
+        try:
+            bot.delete_message(chat_id, message_id)
+            BORRADOS_STATS["borrados"] += 1
+        except RetryAfter as e:
+            BORRADOS_STATS["flood_waits"] += 1
+            if intentos + 1 < BORRADOS_INTENTOS:
+                borrar_mensaje_en(e.retry_after, chat_id, message_id, intentos + 1)
+            else:
+                BORRADOS_STATS["fallidos"] += 1
+            time.sleep(e.retry_after)
+            continue
+        except BadRequest:
+            # Ya borrado o demasiado viejo: nada que reintentar
+            BORRADOS_STATS["fallidos"] += 1
+        except Exception as e:
+            BORRADOS_STATS["fallidos"] += 1
+            print("[borrados] Error al borrar:", e)
+        time.sleep(1.0 / BORRADOS_POR_SEG)
+
+def estadisticas_borrados():
+    ahora = time.monotonic()
+    with _borrados_cv:
+        en_cola  = len(_cola_borrados)
+        vencidos = sum(1 for item in _cola_borrados if item[0] <= ahora)
+    st = BORRADOS_STATS
+    return (
+        f"🧹 <b>Cola de borrados</b> (máx {BORRADOS_POR_SEG:g}/s)\n"
+        f"• En cola: <b>{en_cola}</b> ({vencidos} vencidos) · Máx: <b>{st['profundidad_max']}</b>/{BORRADOS_COLA_MAX}\n"
+        f"• Borrados: <b>{st['borrados']}</b> · Fallidos: <b>{st['fallidos']}</b> · "
+        f"Descartados: <b>{st['descartados']}</b> · Flood waits: <b>{st['flood_waits']}</b>\n"
+    )
+
+threading.Thread(target=_trabajador_borrados, daemon=True, name="borrados").start()
+# ─────────────────────────────────────────────────────────────────────────────
+
 ID_GRUPOS_PERMITIDOS = [
     -1002636853982,
     -0,
 ]
 
+COMANDOS_POR_TEMA = {
+    "album2": [5],
+    "album":  [5],
+    "mercado": [706]
+}
+
+# ─── Configuración por chat (caché) ──────────────────────────────────────────
+# Temas asignados (/settema), grupos permitidos y rutas comando -> temas se
+# cargan de una vez y se sirven desde memoria. /settema y /removetema invalidan
+# la caché; además se recarga cada CONFIG_CHATS_TTL_SEG por si otro proceso
+# cambió algo. Las listas de arriba son los valores por defecto; en
+# config_chats un documento {chat_id, permitido, comandos_por_tema} los amplía.
+CONFIG_CHATS_TTL_SEG = int(os.getenv("CONFIG_CHATS_TTL_SEG", "300"))
+# Hasta la primera carga buena (o si falla) rigen los grupos por defecto
+_config_chats        = {"expira": 0, "grupos": {c for c in ID_GRUPOS_PERMITIDOS if c}, "temas": {}, "rutas": {}}
+_config_chats_mutex  = threading.Lock()
+CONFIG_CHATS_STATS   = {"consultas": 0, "recargas": 0, "invalidaciones": 0}
+
+def _cargar_config_chats():
+    grupos = {c for c in ID_GRUPOS_PERMITIDOS if c}
+    temas  = {}
+    rutas  = {}
+    for d in col_temas_comandos.find({}):
+        if "thread_ids" in d:
+            threads = {str(tid) for tid in d["thread_ids"]}
+        elif "thread_id" in d:
+            threads = {str(d["thread_id"])}
+        else:
+            threads = set()
+        temas.setdefault(d["chat_id"], {})[d["comando"]] = threads
+    for d in col_config_chats.find({}):
+        if d.get("permitido"):
+            grupos.add(d["chat_id"])
+        elif d.get("permitido") is False:
+            grupos.discard(d["chat_id"])
+        if d.get("comandos_por_tema"):
+            rutas[d["chat_id"]] = {k: list(v) for k, v in d["comandos_por_tema"].items()}
+    return {"expira": time.time() + CONFIG_CHATS_TTL_SEG, "grupos": grupos, "temas": temas, "rutas": rutas}
+
+def config_chats():
+    global _config_chats
+    CONFIG_CHATS_STATS["consultas"] += 1
+    if _config_chats["expira"] > time.time():
+        return _config_chats
+    with _config_chats_mutex:
+        if _config_chats["expira"] <= time.time():
+            try:
+                _config_chats = _cargar_config_chats()
+                CONFIG_CHATS_STATS["recargas"] += 1
+            except Exception as e:
+                # Si Mongo falla se sigue con la última configuración conocida
+                print("[config_chats] Error recargando:", e)
+                _config_chats = dict(_config_chats, expira=time.time() + 30)
+    return _config_chats
+
+def invalidar_config_chats():
+    _config_chats["expira"] = 0
+    CONFIG_CHATS_STATS["invalidaciones"] += 1
+
+def grupos_permitidos():
+    return config_chats()["grupos"]
+
+def temas_de_comando(chat_id, comando):
+    """Threads (como str) asignados a un comando en el chat, o None si no tiene."""
+    return config_chats()["temas"].get(chat_id, {}).get(comando)
+
+def temas_por_comando(chat_id, comando):
+    rutas = config_chats()["rutas"].get(chat_id)
+    if rutas and comando in rutas:
+        return rutas[comando]
+    return COMANDOS_POR_TEMA.get(comando, [])
+
+def estadisticas_config_chats():
+    cfg = _config_chats
+    st  = CONFIG_CHATS_STATS
+    return (
+        f"🗺 <b>Configuración de chats</b> (TTL {CONFIG_CHATS_TTL_SEG}s)\n"
+        f"• Grupos permitidos: <b>{len(cfg['grupos'])}</b> · Chats con temas: <b>{len(cfg['temas'])}</b>\n"
+        f"• Consultas: <b>{st['consultas']}</b> · Recargas: <b>{st['recargas']}</b> · Invalidaciones: <b>{st['invalidaciones']}</b>\n"
+    )
+
 def grupo_oficial(func):
     @wraps(func)
     def wrapper(update, context, *args, **kwargs):
         chat = update.effective_chat
         if chat.type == 'private':
             return func(update, context, *args, **kwargs)
-        if chat.id in ID_GRUPOS_PERMITIDOS:
+        if chat.id in grupos_permitidos():
             return func(update, context, *args, **kwargs)
         try:
             update.message.reply_text("🚫 Este bot solo puede usarse en grupos oficiales.")
@@ -140,19 +437,13 @@ def grupo_oficial(func):
         return
     return wrapper
 
-COMANDOS_POR_TEMA = {
-    "album2": [5],
-    "album":  [5],
-    "mercado": [706]
-}
-
 def solo_en_temas_permitidos(nombre_comando):
     def decorador(func):
         @wraps(func)
         def wrapper(update, context, *args, **kwargs):
             if update.message and update.message.chat.type in ["group", "supergroup"]:
                 thread_id = getattr(update.message, "message_thread_id", None)
-                permitidos = COMANDOS_POR_TEMA.get(nombre_comando, [])
+                permitidos = temas_por_comando(update.message.chat.id, nombre_comando)
                 if thread_id is None or thread_id not in permitidos:
                     update.message.reply_text("❌ Este comando solo se puede usar en los temas oficiales del grupo.")
                     return
@@ -190,12 +481,7 @@ def borrar_mensajes_no_idolday(update, context):
                 any(frase in texto for frase in FRASES_PERMITIDAS)
             ):
                 return
-            def borrar_msg():
-                try:
-                    msg.delete()
-                except Exception as e:
-                    print("[Borrador mensajes] Error al borrar:", e)
-            threading.Timer(3, borrar_msg).start()
+            borrar_mensaje_en(3, msg.chat_id, msg.message_id)
     except Exception as e:
         print("[Borrador mensajes] Error:", e)
 
@@ -207,9 +493,86 @@ def log_command(func):
         logging.info(
             f"Comando: {func.__name__} | Usuario: {user.id} ({user.username}) | Chat: {chat.id}"
         )
-        return func(update, context, *args, **kwargs)
+        lecturas_antes = lecturas_mongo_hilo()
+        try:
+            return func(update, context, *args, **kwargs)
+        finally:
+            registrar_lecturas_comando(func.__name__, lecturas_mongo_hilo() - lecturas_antes)
     return wrapper
 
+# ─── Contexto de usuario por actualización ───────────────────────────────────
+# Dentro de una misma actualización varios helpers (t(), /kkp, tienda, mercado)
+# necesitan el documento del usuario. usuario_ctx lo lee una sola vez con la
+# proyección de los campos pedidos y lo guarda en el CallbackContext; las
+# escrituras hechas con actualizar_usuario se reflejan en esa copia.
+# Los campos son de primer nivel ("objetos", no "objetos.lightstick").
+def _usuarios_de_contexto(context):
+    if context is None:
+        return {}
+    cache = getattr(context, "usuarios_ctx", None)
+    if cache is None:
+        cache = {}
+        try:
+            context.usuarios_ctx = cache
+        except AttributeError:
+            pass
+    return cache
+
+def usuario_ctx(context, user_id, *campos):
+    """Documento del usuario para esta actualización; sin campos se lee completo."""
+    entrada = _usuarios_de_contexto(context).setdefault(user_id, {"doc": {}, "campos": set(), "completo": False})
+    if entrada["completo"]:
+        return entrada["doc"]
+    if not campos:
+        entrada["doc"]      = col_usuarios.find_one({"user_id": user_id}) or {}
+        entrada["completo"] = True
+        return entrada["doc"]
+    faltan = [c for c in campos if c not in entrada["campos"]]
+    if faltan:
+        proyeccion = {c: 1 for c in faltan}
+        proyeccion["_id"] = 0
+        entrada["doc"].update(col_usuarios.find_one({"user_id": user_id}, proyeccion) or {})
+        entrada["campos"].update(faltan)
+    return entrada["doc"]
+
+def _ruta_local(doc, campo):
+    partes = campo.split(".")
+    for p in partes[:-1]:
+        if not isinstance(doc.get(p), dict):
+            doc[p] = {}
+        doc = doc[p]
+    return doc, partes[-1]
+
+def actualizar_usuario(context, user_id, cambios, upsert=False):
+    """update_one sobre el usuario que además actualiza la copia del contexto."""
+    res = col_usuarios.update_one({"user_id": user_id}, cambios, upsert=upsert)
+    entrada = _usuarios_de_contexto(context).get(user_id)
+    if entrada:
+        doc = entrada["doc"]
+        for campo, valor in cambios.get("$set", {}).items():
+            d, k = _ruta_local(doc, campo); d[k] = valor
+        for campo, valor in cambios.get("$inc", {}).items():
+            d, k = _ruta_local(doc, campo); d[k] = (d.get(k) or 0) + valor
+        for campo in cambios.get("$unset", {}):
+            d, k = _ruta_local(doc, campo); d.pop(k, None)
+        for campo, valor in cambios.get("$addToSet", {}).items():
+            d, k = _ruta_local(doc, campo)
+            lista = d.setdefault(k, [])
+            if valor not in lista:
+                lista.append(valor)
+    return res
+
+def usa_usuario(*campos):
+    """Precarga en el contexto los campos del usuario que usa el handler."""
+    def decorador(func):
+        @wraps(func)
+        def wrapper(update, context, *args, **kwargs):
+            if update.effective_user:
+                usuario_ctx(context, update.effective_user.id, *campos)
+            return func(update, context, *args, **kwargs)
+        return wrapper
+    return decorador
+
 # ─── LOCKS para drops (evita race condition) ─────────────────────────────────
 _drop_locks = {}
 _drop_locks_mutex = threading.Lock()
@@ -221,26 +584,216 @@ def get_drop_lock(drop_id):
         return _drop_locks[drop_id]
 # ─────────────────────────────────────────────────────────────────────────────
 
-# ─── LIMPIEZA PERIÓDICA DE DROPS EN RAM ──────────────────────────────────────
+# ─── ESTADO DE DROPS ACTIVOS ─────────────────────────────────────────────────
+# Todo acceso al estado de un drop pasa por las funciones drop_*; el backend se
+# elige con DROPS_BACKEND:
+#   memoria: dict DROPS_ACTIVOS + un lock por drop (un solo proceso)
+#   mongo:   colección drops_activos; reservar una carta es un update atómico
+#            reclamada false -> true, así los drops sobreviven reinicios y
+#            varios procesos del bot pueden atender los mismos botones.
+DROPS_BACKEND     = os.getenv("DROPS_BACKEND", "memoria").lower()
+DURACION_DROP_SEG = 60
 DROPS_ACTIVOS = {}
 
+def _vigente(drop, ahora):
+    return not drop.get("expirado") and (drop.get("expira") is None or drop["expira"] > ahora)
+
+def _mem_guardar(drop_id, drop):
+    DROPS_ACTIVOS[drop_id] = drop
+
+def _mem_actualizar(drop_id, campos):
+    drop = DROPS_ACTIVOS.get(drop_id)
+    if drop:
+        drop.update(campos)
+
+def _mem_borrar(drop_id):
+    DROPS_ACTIVOS.pop(drop_id, None)
+    with _drop_locks_mutex:
+        _drop_locks.pop(drop_id, None)
+
+def _mem_reservar_carta(drop_id, idx, user_id):
+    lock = get_drop_lock(drop_id)
+    if not lock.acquire(blocking=False):
+        return None, "ocupado"
+    try:
+        drop = DROPS_ACTIVOS.get(drop_id)
+        if not drop:
+            return None, "no_existe"
+        if not _vigente(drop, time.time()):
+            return None, "expirado"
+        carta = drop["cartas"][idx]
+        if carta.get("reclamada"):
+            return None, "reclamada"
+        carta["reclamada"]      = True
+        carta["usuario"]        = user_id
+        carta["hora_reclamada"] = time.time()
+        return drop, None
+    finally:
+        lock.release()
+
+def _mem_liberar_carta(drop_id, idx, user_id):
+    with get_drop_lock(drop_id):
+        drop = DROPS_ACTIVOS.get(drop_id)
+        if drop and drop["cartas"][idx].get("usuario") == user_id:
+            drop["cartas"][idx]["reclamada"] = False
+            drop["cartas"][idx]["usuario"]   = None
+
+def _mem_sumar_intento(drop_id, idx):
+    with get_drop_lock(drop_id):
+        carta = DROPS_ACTIVOS[drop_id]["cartas"][idx]
+        carta["intentos"] = carta.get("intentos", 0) + 1
+        return carta["intentos"]
+
+def _mem_primer_reclamo_dueño(drop_id, ahora):
+    with get_drop_lock(drop_id):
+        drop = DROPS_ACTIVOS[drop_id]
+        if drop.get("primer_reclamo_dueño") is None:
+            drop["primer_reclamo_dueño"] = ahora
+        return drop["primer_reclamo_dueño"]
+
+def _mem_agregar_reclamante(drop_id, user_id):
+    with get_drop_lock(drop_id):
+        DROPS_ACTIVOS[drop_id].setdefault("usuarios_reclamaron", []).append(user_id)
+
+def _mem_expirar(drop_id):
+    with get_drop_lock(drop_id):
+        drop = DROPS_ACTIVOS.get(drop_id)
+        if not drop or drop.get("expirado"):
+            return None
+        drop["expirado"] = True
+        return drop
+
+def _mem_limpiar(antiguedad):
+    ahora = time.time()
+    expirados = [
+        k for k, v in list(DROPS_ACTIVOS.items())
+        if v.get("expirado") and (ahora - v.get("inicio", 0)) > antiguedad
+    ]
+    for k in expirados:
+        _mem_borrar(k)
+
+def _mongo_guardar(drop_id, drop):
+    doc = dict(drop, _id=drop_id, creado=datetime.utcnow())
+    col_drops_activos.replace_one({"_id": drop_id}, doc, upsert=True)
+
+def _mongo_obtener(drop_id):
+    return col_drops_activos.find_one({"_id": drop_id})
+
+def _mongo_actualizar(drop_id, campos):
+    col_drops_activos.update_one({"_id": drop_id}, {"$set": campos})
+
+def _mongo_borrar(drop_id):
+    col_drops_activos.delete_one({"_id": drop_id})
+
+def _mongo_reservar_carta(drop_id, idx, user_id):
+    ahora = time.time()
+    drop = col_drops_activos.find_one_and_update(
+        {"_id": drop_id, "expirado": False, f"cartas.{idx}.reclamada": False,
+         "$or": [{"expira": None}, {"expira": {"$gt": ahora}}]},
+        {"$set": {
+            f"cartas.{idx}.reclamada": True,
+            f"cartas.{idx}.usuario": user_id,
+            f"cartas.{idx}.hora_reclamada": ahora,
+        }},
+        return_document=True
+    )
+    if drop:
+        return drop, None
+    # No se pudo reservar: averiguar por qué solo para el mensaje
+    actual = col_drops_activos.find_one({"_id": drop_id}, {"expirado": 1, "expira": 1})
+    if not actual:
+        return None, "no_existe"
+    if not _vigente(actual, ahora):
+        return None, "expirado"
+    return None, "reclamada"
+
+def _mongo_liberar_carta(drop_id, idx, user_id):
+    col_drops_activos.update_one(
+        {"_id": drop_id, f"cartas.{idx}.usuario": user_id},
+        {"$set": {f"cartas.{idx}.reclamada": False, f"cartas.{idx}.usuario": None}}
+    )
+
+def _mongo_sumar_intento(drop_id, idx):
+    doc = col_drops_activos.find_one_and_update(
+        {"_id": drop_id}, {"$inc": {f"cartas.{idx}.intentos": 1}},
+        projection={"cartas": 1}, return_document=True
+    )
+    return doc["cartas"][idx].get("intentos", 0) if doc else 0
+
+def _mongo_primer_reclamo_dueño(drop_id, ahora):
+    doc = col_drops_activos.find_one_and_update(
+        {"_id": drop_id, "primer_reclamo_dueño": None},
+        {"$set": {"primer_reclamo_dueño": ahora}},
+        projection={"_id": 1}
+    )
+    if doc:
+        return ahora
+    doc = col_drops_activos.find_one({"_id": drop_id}, {"primer_reclamo_dueño": 1}) or {}
+    return doc.get("primer_reclamo_dueño")
+
+def _mongo_agregar_reclamante(drop_id, user_id):
+    col_drops_activos.update_one({"_id": drop_id}, {"$push": {"usuarios_reclamaron": user_id}})
+
+def _mongo_expirar(drop_id):
+    return col_drops_activos.find_one_and_update(
+        {"_id": drop_id, "expirado": False},
+        {"$set": {"expirado": True}},
+        return_document=True
+    )
+
+def _mongo_limpiar(antiguedad):
+    col_drops_activos.delete_many({"expirado": True, "inicio": {"$lt": time.time() - antiguedad}})
+
+_BACKENDS_DROPS = {
+    "memoria": {
+        "guardar": _mem_guardar, "obtener": DROPS_ACTIVOS.get, "actualizar": _mem_actualizar,
+        "borrar": _mem_borrar, "reservar_carta": _mem_reservar_carta,
+        "liberar_carta": _mem_liberar_carta, "sumar_intento": _mem_sumar_intento,
+        "primer_reclamo_dueño": _mem_primer_reclamo_dueño,
+        "agregar_reclamante": _mem_agregar_reclamante, "expirar": _mem_expirar,
+        "limpiar": _mem_limpiar,
+    },
+    "mongo": {
+        "guardar": _mongo_guardar, "obtener": _mongo_obtener, "actualizar": _mongo_actualizar,
+        "borrar": _mongo_borrar, "reservar_carta": _mongo_reservar_carta,
+        "liberar_carta": _mongo_liberar_carta, "sumar_intento": _mongo_sumar_intento,
+        "primer_reclamo_dueño": _mongo_primer_reclamo_dueño,
+        "agregar_reclamante": _mongo_agregar_reclamante, "expirar": _mongo_expirar,
+        "limpiar": _mongo_limpiar,
+    },
+}
+if DROPS_BACKEND not in _BACKENDS_DROPS:
+    print(f"[drops] Backend desconocido '{DROPS_BACKEND}', usando memoria.")
+    DROPS_BACKEND = "memoria"
+_drops = _BACKENDS_DROPS[DROPS_BACKEND]
+
+def drop_guardar(drop_id, drop):           return _drops["guardar"](drop_id, drop)
+def drop_obtener(drop_id):                 return _drops["obtener"](drop_id)
+def drop_actualizar(drop_id, campos):      return _drops["actualizar"](drop_id, campos)
+def drop_borrar(drop_id):                  return _drops["borrar"](drop_id)
+def drop_liberar_carta(drop_id, idx, uid): return _drops["liberar_carta"](drop_id, idx, uid)
+def drop_sumar_intento(drop_id, idx):      return _drops["sumar_intento"](drop_id, idx)
+def drop_agregar_reclamante(drop_id, uid): return _drops["agregar_reclamante"](drop_id, uid)
+
+def drop_reservar_carta(drop_id, idx, user_id):
+    """Marca la carta como reclamada si nadie la tomó. Devuelve (drop, motivo_fallo)."""
+    return _drops["reservar_carta"](drop_id, idx, user_id)
+
+def drop_primer_reclamo_dueño(drop_id, ahora):
+    """Registra el primer reclamo del dueño si no existe; devuelve el valor guardado."""
+    return _drops["primer_reclamo_dueño"](drop_id, ahora)
+
+def drop_expirar(drop_id):
+    """Marca el drop como expirado; devuelve el drop solo a quien lo expiró."""
+    return _drops["expirar"](drop_id)
+
 def limpiar_drops_viejos():
-    while True:
-        try:
-            ahora = time.time()
-            with _drop_locks_mutex:
-                expirados = [
-                    k for k, v in DROPS_ACTIVOS.items()
-                    if v.get("expirado") and (ahora - v.get("inicio", 0)) > 3600
-                ]
-            for k in expirados:
-                DROPS_ACTIVOS.pop(k, None)
-                _drop_locks.pop(k, None)
-        except Exception as e:
-            print("[limpiar_drops_viejos] Error:", e)
-        time.sleep(300)
+    try:
+        _drops["limpiar"](3600)
+    except Exception as e:
+        print("[limpiar_drops_viejos] Error:", e)
 
-threading.Thread(target=limpiar_drops_viejos, daemon=True).start()
+programar_periodica(300, limpiar_drops_viejos)
 # ─────────────────────────────────────────────────────────────────────────────
 
 # ─── TIMEOUT AUTOMÁTICO DE TRADES ABANDONADOS ────────────────────────────────
@@ -248,37 +801,29 @@ TRADES_EN_CURSO  = {}
 TRADES_POR_USUARIO = {}
 TRADE_TIMEOUT_SEG = 300  # 5 minutos
 
-def limpiar_trades_viejos():
-    while True:
+def cerrar_trade(trade_id):
+    """Quita el trade de RAM y cancela su timeout. Devuelve el trade (o None)."""
+    trade = TRADES_EN_CURSO.pop(trade_id, None)
+    if trade:
+        for uid in trade.get("usuarios", []):
+            TRADES_POR_USUARIO.pop(uid, None)
+        cancelar_tarea(trade.get("tarea_timeout"))
+    return trade
+
+def expirar_trade(trade_id):
+    trade = cerrar_trade(trade_id)
+    if trade:
         try:
-            ahora = time.time()
-            trades_expirados = [
-                tid for tid, t in list(TRADES_EN_CURSO.items())
-                if ahora - t.get("inicio", ahora) > TRADE_TIMEOUT_SEG
-            ]
-            for tid in trades_expirados:
-                trade = TRADES_EN_CURSO.pop(tid, None)
-                if trade:
-                    for uid in trade.get("usuarios", []):
-                        TRADES_POR_USUARIO.pop(uid, None)
-                    try:
-                        bot.send_message(
-                            chat_id=trade["chat_id"],
-                            text="⏰ El intercambio expiró por inactividad.",
-                            message_thread_id=trade.get("thread_id")
-                        )
-                    except Exception:
-                        pass
-        except Exception as e:
-            print("[limpiar_trades_viejos] Error:", e)
-        time.sleep(60)
-
-threading.Thread(target=limpiar_trades_viejos, daemon=True).start()
+            bot.send_message(
+                chat_id=trade["chat_id"],
+                text="⏰ El intercambio expiró por inactividad.",
+                message_thread_id=trade.get("thread_id")
+            )
+        except Exception:
+            pass
 # ─────────────────────────────────────────────────────────────────────────────
 
 COOLDOWN_USUARIO_SEG = 6 * 60 * 60
-COOLDOWN_GRUPO_SEG   = 30
-COOLDOWN_GRUPO       = {}
 
 if not os.path.isfile('cartas.json'):
     raise ValueError("No se encontró el archivo cartas.json")
@@ -297,6 +842,68 @@ def _precalcular_sets():
 SETS_PRECALCULADOS = _precalcular_sets()
 # ─────────────────────────────────────────────────────────────────────────────
 
+# ─── POOL DE DROPS (muestreo ponderado, método alias) ────────────────────────
+# Se construye una vez desde cartas.json: cartas únicas por (nombre, version) en
+# "Excelente estado", con peso opcional por rareza y por grupo, ambos desde env
+# (PESOS_RAREZA_DROP='{"Común": 1}', PESOS_GRUPO_DROP='{"TWICE": 2, "BTS": 0.5}').
+# Lo que no aparece pesa 1. Cada extracción es O(1).
+def _pesos_drop_env(nombre):
+    try:
+        return json.loads(os.getenv(nombre, "{}"))
+    except ValueError:
+        print(f"[drop] {nombre} no es JSON válido, se ignora")
+        return {}
+
+PESOS_RAREZA_DROP = _pesos_drop_env("PESOS_RAREZA_DROP")
+PESOS_GRUPO_DROP  = _pesos_drop_env("PESOS_GRUPO_DROP")
+
+def _peso_carta_drop(c):
+    return (float(PESOS_RAREZA_DROP.get(c.get("rareza", ""), 1.0))
+            * float(PESOS_GRUPO_DROP.get(c.get("grupo", ""), 1.0)))
+
+def construir_pool_drop(lista_cartas):
+    unicas = list({(c['nombre'], c['version']): c for c in lista_cartas if c.get("estado") == "Excelente estado"}.values())
+    unicas = [c for c in unicas if _peso_carta_drop(c) > 0]
+    n      = len(unicas)
+    prob   = [0.0] * n
+    alias  = [0] * n
+    if n:
+        total   = sum(_peso_carta_drop(c) for c in unicas)
+        escalas = [_peso_carta_drop(c) * n / total for c in unicas]
+        chicos  = [i for i, p in enumerate(escalas) if p < 1.0]
+        grandes = [i for i, p in enumerate(escalas) if p >= 1.0]
+        while chicos and grandes:
+            ch = chicos.pop(); gr = grandes.pop()
+            prob[ch]  = escalas[ch]
+            alias[ch] = gr
+            escalas[gr] = escalas[gr] + escalas[ch] - 1.0
+            (chicos if escalas[gr] < 1.0 else grandes).append(gr)
+        for i in chicos + grandes:
+            prob[i] = 1.0
+    return {"cartas": unicas, "prob": prob, "alias": alias}
+
+def _extraer_indice(pool):
+    i = random.randrange(len(pool["cartas"]))
+    return i if random.random() < pool["prob"][i] else pool["alias"][i]
+
+def sortear_cartas_drop(k=2, pool=None):
+    """k cartas distintas del pool; si el pool es más chico que k, se permiten repetidas."""
+    pool = pool or POOL_DROP
+    n    = len(pool["cartas"])
+    if n == 0:
+        return []
+    if n < k:
+        return [pool["cartas"][_extraer_indice(pool)] for _ in range(k)]
+    elegidos = []
+    while len(elegidos) < k:
+        i = _extraer_indice(pool)
+        if i not in elegidos:
+            elegidos.append(i)
+    return [pool["cartas"][i] for i in elegidos]
+
+POOL_DROP = construir_pool_drop(cartas)
+# ─────────────────────────────────────────────────────────────────────────────
+
 SESIONES_REGALO = {}
 
 ESTADOS_CARTA = [
@@ -317,11 +924,6 @@ ESTADO_MULTIPLICADORES = {
     "Muy mal estado": 0.05
 }
 
-user_last_cmd  = {}
-group_last_cmd = {}
-COOLDOWN_USER  = 3
-COOLDOWN_GROUP = 1
-
 def solo_en_tema_asignado(comando):
     def decorator(func):
         @wraps(func)
@@ -332,18 +934,12 @@ def solo_en_tema_asignado(comando):
             if update.effective_chat and update.effective_chat.type == "private":
                 return func(update, context, *args, **kwargs)
 
-            tema_asignado = col_temas_comandos.find_one({"chat_id": chat_id, "comando": comando})
+            threads_permitidos = temas_de_comando(chat_id, comando)
 
             # Si no hay tema configurado para este comando: permitir en cualquier lugar
-            if not tema_asignado:
+            if threads_permitidos is None:
                 return func(update, context, *args, **kwargs)
 
-            threads_permitidos = set()
-            if "thread_ids" in tema_asignado:
-                threads_permitidos = {str(tid) for tid in tema_asignado["thread_ids"]}
-            elif "thread_id" in tema_asignado:
-                threads_permitidos = {str(tema_asignado["thread_id"])}
-
             thread_id_actual = None
             if getattr(update, 'message', None):
                 thread_id_actual = str(getattr(update.message, "message_thread_id", None))
@@ -376,18 +972,12 @@ def en_tema_asignado_o_privado(comando):
             if chat and chat.type == "private":
                 return func(update, context, *args, **kwargs)
 
-            tema_asignado = col_temas_comandos.find_one({"chat_id": chat_id, "comando": comando})
+            threads_permitidos = temas_de_comando(chat_id, comando)
 
             # Si no hay tema configurado: permitir en cualquier lugar del grupo
-            if not tema_asignado:
+            if threads_permitidos is None:
                 return func(update, context, *args, **kwargs)
 
-            threads_permitidos = set()
-            if "thread_ids" in tema_asignado:
-                threads_permitidos = {str(tid) for tid in tema_asignado["thread_ids"]}
-            elif "thread_id" in tema_asignado:
-                threads_permitidos = {str(tema_asignado["thread_id"])}
-
             thread_id_actual = None
             if getattr(update, 'message', None):
                 thread_id_actual = str(getattr(update.message, "message_thread_id", None))
@@ -466,85 +1056,572 @@ def mensaje_tutorial_privado(update, context):
 
 # ─── Misiones ────────────────────────────────────────────────────────────────
 def actualiza_mision_diaria(user_id, context=None):
-    user_doc = col_usuarios.find_one({"user_id": user_id}) or {}
-    misiones = user_doc.get("misiones", {})
-    hoy_str  = datetime.utcnow().strftime('%Y-%m-%d')
-    ultima   = misiones.get("ultima_mision_idolday", "")
-
-    if ultima != hoy_str:
-        misiones["idolday_hoy"]      = 0
-        misiones["idolday_entregada"]= ""
-        misiones["primer_drop"]      = {}
-
-    # Misión primer drop
-    premio_primer_drop = False
-    if misiones.get("primer_drop", {}).get("fecha") != hoy_str:
-        col_usuarios.update_one({"user_id": user_id}, {"$inc": {"kponey": 50}})
-        misiones["primer_drop"] = {"fecha": hoy_str, "premio": True}
-        premio_primer_drop = True
-        if context:
-            try:
-                context.bot.send_message(
-                    chat_id=user_id,
-                    text="🎉 ¡Primer drop del día realizado!\nHas recibido <b>50 Kponey</b>.",
-                    parse_mode="HTML"
-                )
-            except Exception:
-                pass
-
-    # Misión 3 drops
-    misiones["idolday_hoy"] = misiones.get("idolday_hoy", 0) + 1
-    misiones["ultima_mision_idolday"] = hoy_str
-
-    mision_completada = misiones["idolday_hoy"] >= 3
-    premio_tres_drops = False
-    if mision_completada and misiones.get("idolday_entregada", "") != hoy_str:
-        col_usuarios.update_one({"user_id": user_id}, {"$inc": {"kponey": 150}})
-        if context:
-            try:
-                context.bot.send_message(
-                    chat_id=user_id,
-                    text="🎉 ¡Misión diaria completada!\nHas recibido <b>150 Kponey</b> por hacer 3 drops hoy.",
-                    parse_mode="HTML"
-                )
-            except Exception:
-                pass
-        misiones["idolday_entregada"] = hoy_str
-        premio_tres_drops = True
+    """Suma un drop a las misiones del día y paga los premios en una sola escritura.
+
+    El pipeline reinicia las misiones si cambió el día, incrementa el contador
+    y decide los premios sobre el propio documento. Los premios de esta llamada
+    se deducen del documento anterior con las mismas reglas, sin guardarlos.
+    """
+    hoy_str = datetime.utcnow().strftime('%Y-%m-%d')
+    doc = col_usuarios.find_one_and_update(
+        {"user_id": user_id},
+        [
+            {"$set": {"misiones": {"$cond": [
+                {"$eq": ["$misiones.ultima_mision_idolday", hoy_str]},
+                "$misiones",
+                {"$mergeObjects": [
+                    {"$ifNull": ["$misiones", {}]},
+                    {"idolday_hoy": 0, "idolday_entregada": "", "primer_drop": {}},
+                ]},
+            ]}}},
+            {"$set": {
+                "_premio_primer": {"$ne": ["$misiones.primer_drop.fecha", hoy_str]},
+                "misiones.idolday_hoy": {"$add": [{"$ifNull": ["$misiones.idolday_hoy", 0]}, 1]},
+                "misiones.ultima_mision_idolday": hoy_str,
+            }},
+            {"$set": {"_premio_tres": {"$and": [
+                {"$gte": ["$misiones.idolday_hoy", 3]},
+                {"$ne": [{"$ifNull": ["$misiones.idolday_entregada", ""]}, hoy_str]},
+            ]}}},
+            {"$set": {
+                "kponey": {"$add": [
+                    {"$ifNull": ["$kponey", 0]},
+                    {"$cond": ["$_premio_primer", 50, 0]},
+                    {"$cond": ["$_premio_tres", 150, 0]},
+                ]},
+                "misiones.primer_drop": {"$cond": [
+                    "$_premio_primer", {"fecha": hoy_str, "premio": True}, "$misiones.primer_drop"
+                ]},
+                "misiones.idolday_entregada": {"$cond": ["$_premio_tres", hoy_str, "$misiones.idolday_entregada"]},
+            }},
+            # premios_ultimo_drop: banderas que guardaban versiones anteriores
+            {"$unset": ["_premio_primer", "_premio_tres", "misiones.premios_ultimo_drop"]},
+        ],
+        projection={"misiones": 1}
+    )
+    if not doc:
+        return False, False, False
+
+    misiones = doc.get("misiones") or {}
+    if misiones.get("ultima_mision_idolday") != hoy_str:
+        misiones = {"idolday_hoy": 0, "idolday_entregada": "", "primer_drop": {}}
+    drops_hoy          = (misiones.get("idolday_hoy") or 0) + 1
+    mision_completada  = drops_hoy >= 3
+    primer_drop        = misiones.get("primer_drop")
+    premio_primer_drop = (primer_drop.get("fecha") if isinstance(primer_drop, dict) else None) != hoy_str
+    premio_tres_drops  = mision_completada and (misiones.get("idolday_entregada") or "") != hoy_str
+
+    if context and premio_primer_drop:
+        try:
+            context.bot.send_message(
+                chat_id=user_id,
+                text="🎉 ¡Primer drop del día realizado!\nHas recibido <b>50 Kponey</b>.",
+                parse_mode="HTML"
+            )
+        except Exception:
+            pass
+    if context and premio_tres_drops:
+        try:
+            context.bot.send_message(
+                chat_id=user_id,
+                text="🎉 ¡Misión diaria completada!\nHas recibido <b>150 Kponey</b> por hacer 3 drops hoy.",
+                parse_mode="HTML"
+            )
+        except Exception:
+            pass
 
-    col_usuarios.update_one({"user_id": user_id}, {"$set": {"misiones": misiones}})
     return mision_completada, premio_tres_drops, premio_primer_drop
 
-# ─── Cooldown de comandos ─────────────────────────────────────────────────────
-def check_cooldown(update):
-    now = time.time()
-    uid = update.effective_user.id
-    gid = update.effective_chat.id
-    if uid in user_last_cmd and now - user_last_cmd[uid] < COOLDOWN_USER:
-        return False, f"¡Espera {COOLDOWN_USER} segundos entre comandos!"
-    if gid in group_last_cmd and now - group_last_cmd[gid] < COOLDOWN_GROUP:
-        return False, "Este grupo está usando comandos muy rápido. Espera 1 segundo."
-    return True, None
+# ─── Limitador de frecuencia (token buckets) ─────────────────────────────────
+# Cada comando tiene un cubo de fichas por usuario y otro por chat. Un cubo
+# (capacidad, seg_por_ficha) permite ráfagas de `capacidad` usos y luego un uso
+# cada `seg_por_ficha`. Los cubos viven en un OrderedDict acotado: un cubo que
+# ya se rellenó entero equivale a no tenerlo, así que la purga periódica lo
+# borra, y si aun así se llega a LIMITADOR_MAX_CLAVES se expulsa el más viejo.
+LIMITES_POR_DEFECTO = {"usuario": (1, 3.0), "grupo": (2, 1.0)}
+LIMITES_COMANDOS = {
+    # Paginado de álbumes: barato, se permiten ráfagas
+    "album_pagina":  {"usuario": (6, 0.5)},
+    "album2_pagina": {"usuario": (6, 0.5)},
+    "album":         {"usuario": (2, 3.0)},
+    "album2":        {"usuario": (2, 3.0)},
+    "mercado":       {"usuario": (2, 3.0)},
+    # /idolday: un drop por grupo cada 30 s (el cooldown de 6 h va aparte)
+    "idolday":       {"grupo": (1, 30.0)},
+}
+LIMITADOR_MAX_CLAVES = int(os.getenv("LIMITADOR_MAX_CLAVES", "50000"))
+_cubos           = OrderedDict()   # (comando, ambito, id) -> [fichas, ts]
+_cubos_mutex     = threading.Lock()
+LIMITADOR_STATS  = {}              # comando -> {"permitidos": n, "rechazados": n}
+LIMITADOR_TOTALES = {"expulsados": 0, "purgados": 0}
+
+def _limite(comando, ambito):
+    return LIMITES_COMANDOS.get(comando, {}).get(ambito) or LIMITES_POR_DEFECTO[ambito]
+
+def _fichas_actuales(clave, limite, ahora):
+    capacidad, periodo = limite
+    cubo = _cubos.get(clave)
+    if cubo is None:
+        return capacidad
+    return min(capacidad, cubo[0] + (ahora - cubo[1]) / periodo)
+
+def tomar_ficha(comando, usuario=None, grupo=None):
+    """Consume una ficha de cada cubo indicado, todo o nada.
+
+    Devuelve (ok, espera_seg, ambito_que_rechazó)."""
+    ahora = time.time()
+    cubos = [(ambito, id_) for ambito, id_ in (("usuario", usuario), ("grupo", grupo)) if id_ is not None]
+    with _cubos_mutex:
+        estados = []
+        for ambito, id_ in cubos:
+            clave  = (comando, ambito, id_)
+            limite = _limite(comando, ambito)
+            fichas = _fichas_actuales(clave, limite, ahora)
+            if fichas < 1:
+                stats = LIMITADOR_STATS.setdefault(comando, {"permitidos": 0, "rechazados": 0})
+                stats["rechazados"] += 1
+                return False, (1 - fichas) * limite[1], ambito
+            estados.append((clave, fichas))
+        for clave, fichas in estados:
+            _cubos[clave] = [fichas - 1, ahora]
+            _cubos.move_to_end(clave)
+        while len(_cubos) > LIMITADOR_MAX_CLAVES:
+            _cubos.popitem(last=False)
+            LIMITADOR_TOTALES["expulsados"] += 1
+        stats = LIMITADOR_STATS.setdefault(comando, {"permitidos": 0, "rechazados": 0})
+        stats["permitidos"] += 1
+    return True, 0, None
+
+def devolver_ficha(comando, usuario=None, grupo=None):
+    """Reintegra una ficha tomada para un uso que al final no ocurrió."""
+    with _cubos_mutex:
+        for ambito, id_ in (("usuario", usuario), ("grupo", grupo)):
+            cubo = _cubos.get((comando, ambito, id_)) if id_ is not None else None
+            if cubo:
+                cubo[0] = min(_limite(comando, ambito)[0], cubo[0] + 1)
+
+def purgar_cubos_inactivos():
+    ahora = time.time()
+    with _cubos_mutex:
+        llenos = []
+        for clave in _cubos:
+            limite = _limite(clave[0], clave[1])
+            if _fichas_actuales(clave, limite, ahora) >= limite[0]:
+                llenos.append(clave)
+        for clave in llenos:
+            del _cubos[clave]
+    LIMITADOR_TOTALES["purgados"] += len(llenos)
+
+programar_periodica(60, purgar_cubos_inactivos)
+
+def estadisticas_limitador():
+    permitidos = sum(s["permitidos"] for s in LIMITADOR_STATS.values())
+    rechazados = sum(s["rechazados"] for s in LIMITADOR_STATS.values())
+    top = sorted(LIMITADOR_STATS.items(), key=lambda kv: kv[1]["rechazados"], reverse=True)[:5]
+    txt = (
+        f"🚦 <b>Limitador de frecuencia</b>\n"
+        f"• Cubos: <b>{len(_cubos)}</b>/{LIMITADOR_MAX_CLAVES} · Purgados: <b>{LIMITADOR_TOTALES['purgados']}</b> · Expulsados: <b>{LIMITADOR_TOTALES['expulsados']}</b>\n"
+        f"• Permitidos: <b>{permitidos}</b> · Rechazados: <b>{rechazados}</b>\n"
+    )
+    for comando, s in top:
+        if s["rechazados"]:
+            txt += f"  · {comando}: {s['permitidos']} ok / {s['rechazados']} rechazados\n"
+    return txt
 
 def cooldown_critico(func):
+    comando = func.__name__.replace("comando_", "", 1)
     @wraps(func)
     def wrapper(update, context, *args, **kwargs):
-        ok, msg = check_cooldown(update)
+        ok, espera, ambito = tomar_ficha(comando, usuario=update.effective_user.id, grupo=update.effective_chat.id)
         if not ok:
-            update.message.reply_text(msg)
+            segundos = max(1, math.ceil(espera))
+            if ambito == "usuario":
+                update.message.reply_text(f"¡Espera {segundos} segundos entre comandos!")
+            else:
+                update.message.reply_text(f"Este grupo está usando comandos muy rápido. Espera {segundos} segundo{'s' if segundos != 1 else ''}.")
             return
-        now = time.time()
-        user_last_cmd[update.effective_user.id]  = now
-        group_last_cmd[update.effective_chat.id] = now
         return func(update, context, *args, **kwargs)
     return wrapper
 
-# ─── Imagen con número ───────────────────────────────────────────────────────
-def agregar_numero_a_imagen(imagen_url, numero):
-    response = requests.get(imagen_url, timeout=10)
-    img  = Image.open(BytesIO(response.content)).convert("RGBA")
-    draw = ImageDraw.Draw(img)
-    font_size = int(img.height * 0.05)
+# ─── Pool compartido para trabajo de imágenes ─────────────────────────────────
+# Un único ThreadPoolExecutor para todo el proceso (drops, album2, precalentado)
+# con cola acotada: si hay IMG_COLA_MAX tareas pendientes, las nuevas se rechazan
+# en vez de crear más hilos. Cada lote tiene un timeout por tarea.
+IMG_WORKERS     = int(os.getenv("IMG_WORKERS", "4"))
+IMG_COLA_MAX    = int(os.getenv("IMG_COLA_MAX", "32"))
+IMG_TIMEOUT_SEG = float(os.getenv("IMG_TIMEOUT_SEG", "15"))
+
+_pool_imagenes       = ThreadPoolExecutor(max_workers=IMG_WORKERS, thread_name_prefix="imagenes")
+_cupos_imagenes      = threading.BoundedSemaphore(IMG_COLA_MAX)
+_pool_imagenes_mutex = threading.Lock()
+POOL_IMAGENES_STATS  = {
+    "en_cola": 0, "ejecutando": 0, "completadas": 0, "fallidas": 0,
+    "timeouts": 0, "rechazadas": 0, "ms_total": 0.0, "ms_max": 0.0,
+}
+
+def _ejecutar_tarea_imagen(fn, args, encolada):
+    with _pool_imagenes_mutex:
+        POOL_IMAGENES_STATS["en_cola"]    -= 1
+        POOL_IMAGENES_STATS["ejecutando"] += 1
+    ok = False
+    try:
+        resultado = fn(*args)
+        ok = True
+        return resultado
+    finally:
+        ms = (time.perf_counter() - encolada) * 1000
+        with _pool_imagenes_mutex:
+            st = POOL_IMAGENES_STATS
+            st["ejecutando"] -= 1
+            st["completadas" if ok else "fallidas"] += 1
+            st["ms_total"] += ms
+            st["ms_max"]    = max(st["ms_max"], ms)
+        _cupos_imagenes.release()
+
+def enviar_tarea_imagen(fn, *args, espera=2.0):
+    """Encola fn(*args) en el pool de imágenes. Lanza RuntimeError si la cola está llena."""
+    if not _cupos_imagenes.acquire(timeout=espera):
+        with _pool_imagenes_mutex:
+            POOL_IMAGENES_STATS["rechazadas"] += 1
+        raise RuntimeError("Cola de imágenes llena")
+    with _pool_imagenes_mutex:
+        POOL_IMAGENES_STATS["en_cola"] += 1
+    try:
+        return _pool_imagenes.submit(_ejecutar_tarea_imagen, fn, args, time.perf_counter())
+    except Exception:
+        with _pool_imagenes_mutex:
+            POOL_IMAGENES_STATS["en_cola"] -= 1
+        _cupos_imagenes.release()
+        raise
+
+def ejecutar_tareas_imagen(fn, items, timeout=None):
+    """Aplica fn a cada item en el pool; devuelve resultados en orden (None si falló o expiró)."""
+    timeout = IMG_TIMEOUT_SEG if timeout is None else timeout
+    futuros = []
+    for item in items:
+        try:
+            futuros.append(enviar_tarea_imagen(fn, item))
+        except Exception as e:
+            logger.warning(f"[pool_imagenes] Tarea rechazada: {e}")
+            futuros.append(None)
+    limite = time.time() + timeout
+    resultados = []
+    for fut in futuros:
+        if fut is None:
+            resultados.append(None)
+            continue
+        try:
+            resultados.append(fut.result(timeout=max(0, limite - time.time())))
+        except Exception as e:
+            if not fut.done():
+                with _pool_imagenes_mutex:
+                    POOL_IMAGENES_STATS["timeouts"] += 1
+                logger.warning("[pool_imagenes] Timeout esperando tarea de imagen")
+            else:
+                logger.warning(f"[pool_imagenes] Error en tarea de imagen: {e}")
+            resultados.append(None)
+    return resultados
+
+def estadisticas_pool_imagenes():
+    with _pool_imagenes_mutex:
+        st = dict(POOL_IMAGENES_STATS)
+    terminadas = st["completadas"] + st["fallidas"]
+    promedio   = st["ms_total"] / terminadas if terminadas else 0
+    return (
+        f"🧵 <b>Pool de imágenes</b> ({IMG_WORKERS} hilos, cola {IMG_COLA_MAX})\n"
+        f"• En cola: <b>{st['en_cola']}</b> · Ejecutando: <b>{st['ejecutando']}</b>\n"
+        f"• OK/fallidas: <b>{st['completadas']}</b>/<b>{st['fallidas']}</b> · Timeouts: <b>{st['timeouts']}</b> · Rechazadas: <b>{st['rechazadas']}</b>\n"
+        f"• Latencia prom/máx: <b>{promedio:.0f}</b>/<b>{st['ms_max']:.0f}</b> ms\n"
+    )
+
+# ─── Caché de imágenes del catálogo (memoria LRU + disco) ────────────────────
+# Nivel 1: imágenes ya decodificadas en RAM, con presupuesto en bytes.
+# Nivel 2: bytes originales en disco, nombrados por el hash de la URL.
+CACHE_IMAGENES_DIR       = os.getenv("CACHE_IMAGENES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache_imagenes"))
+CACHE_IMAGENES_MAX_BYTES = int(os.getenv("CACHE_IMAGENES_MAX_MB", "256")) * 1024 * 1024
+
+_cache_imagenes       = OrderedDict()   # url -> Image RGBA
+_cache_imagenes_bytes = 0
+_cache_imagenes_mutex = threading.Lock()
+CACHE_IMAGENES_STATS  = {"hits_memoria": 0, "hits_disco": 0, "misses": 0, "errores": 0, "expulsadas": 0}
+
+try:
+    os.makedirs(CACHE_IMAGENES_DIR, exist_ok=True)
+except Exception as _e:
+    print(f"[cache_imagenes] No se pudo crear {CACHE_IMAGENES_DIR}: {_e}")
+
+def _ruta_cache_imagen(url):
+    return os.path.join(CACHE_IMAGENES_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".bin")
+
+def _tamano_imagen(img):
+    return img.width * img.height * len(img.getbands())
+
+def _bytes_imagen_catalogo(url):
+    """Devuelve los bytes originales de la imagen, desde disco o descargándolos."""
+    ruta = _ruta_cache_imagen(url)
+    try:
+        with open(ruta, "rb") as f:
+            contenido = f.read()
+        if contenido:
+            CACHE_IMAGENES_STATS["hits_disco"] += 1
+            return contenido
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[cache_imagenes] Error leyendo {ruta}: {e}")
+
+    CACHE_IMAGENES_STATS["misses"] += 1
+    r = requests.get(url, timeout=10)
+    r.raise_for_status()
+    contenido = r.content
+    try:
+        tmp = f"{ruta}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(contenido)
+        os.replace(tmp, ruta)
+    except Exception as e:
+        print(f"[cache_imagenes] No se pudo guardar {url} en disco: {e}")
+    return contenido
+
+def _guardar_en_memoria(url, img):
+    global _cache_imagenes_bytes
+    tam = _tamano_imagen(img)
+    if tam > CACHE_IMAGENES_MAX_BYTES:
+        return
+    with _cache_imagenes_mutex:
+        if url in _cache_imagenes:
+            _cache_imagenes.move_to_end(url)
+            return
+        _cache_imagenes[url] = img
+        _cache_imagenes_bytes += tam
+        while _cache_imagenes_bytes > CACHE_IMAGENES_MAX_BYTES and _cache_imagenes:
+            _, vieja = _cache_imagenes.popitem(last=False)
+            _cache_imagenes_bytes -= _tamano_imagen(vieja)
+            CACHE_IMAGENES_STATS["expulsadas"] += 1
+
+def obtener_imagen_catalogo(url):
+    """Imagen RGBA del catálogo. Devuelve una copia: el llamador puede dibujar sobre ella."""
+    with _cache_imagenes_mutex:
+        img = _cache_imagenes.get(url)
+        if img is not None:
+            _cache_imagenes.move_to_end(url)
+            CACHE_IMAGENES_STATS["hits_memoria"] += 1
+            return img.copy()
+    try:
+        img = Image.open(BytesIO(_bytes_imagen_catalogo(url))).convert("RGBA")
+    except Exception:
+        CACHE_IMAGENES_STATS["errores"] += 1
+        raise
+    _guardar_en_memoria(url, img)
+    return img.copy()
+
+def _precalentar_imagen(url):
+    contenido = _bytes_imagen_catalogo(url)
+    with _cache_imagenes_mutex:
+        en_memoria = url in _cache_imagenes
+        hay_espacio = _cache_imagenes_bytes < CACHE_IMAGENES_MAX_BYTES
+    if not en_memoria and hay_espacio:
+        _guardar_en_memoria(url, Image.open(BytesIO(contenido)).convert("RGBA"))
+
+def precalentar_cache_imagenes(urls):
+    """Baja a disco todas las URLs y carga en RAM las que quepan en el presupuesto."""
+    inicio = time.time()
+    ok = 0
+    for url in urls:
+        # De a una por vez en el pool compartido, para no acaparar los hilos
+        try:
+            enviar_tarea_imagen(_precalentar_imagen, url, espera=60).result(timeout=IMG_TIMEOUT_SEG * 2)
+            ok += 1
+        except Exception as e:
+            CACHE_IMAGENES_STATS["errores"] += 1
+            print(f"[cache_imagenes] Precalentado falló para {url}: {e}")
+    logger.info(f"[cache_imagenes] Precalentadas {ok}/{len(urls)} imágenes en {time.time() - inicio:.1f}s")
+
+def iniciar_precalentado_imagenes(urls):
+    threading.Thread(target=precalentar_cache_imagenes, args=(list(urls),), daemon=True).start()
+
+def estadisticas_cache_imagenes():
+    with _cache_imagenes_mutex:
+        en_memoria = len(_cache_imagenes)
+        usados     = _cache_imagenes_bytes
+    s = CACHE_IMAGENES_STATS
+    consultas = s["hits_memoria"] + s["hits_disco"] + s["misses"]
+    ratio = (s["hits_memoria"] + s["hits_disco"]) / consultas * 100 if consultas else 0
+    return (
+        f"🖼️ <b>Caché de imágenes</b>\n"
+        f"• En RAM: <b>{en_memoria}</b> ({usados // (1024*1024)}/{CACHE_IMAGENES_MAX_BYTES // (1024*1024)} MB)\n"
+        f"• Hits RAM/disco: <b>{s['hits_memoria']}</b>/<b>{s['hits_disco']}</b> · Misses: <b>{s['misses']}</b>\n"
+        f"• Aciertos: <b>{ratio:.1f}%</b> · Expulsadas: <b>{s['expulsadas']}</b> · Errores: <b>{s['errores']}</b>\n"
+    )
+
+# ─── Métricas de rendimiento (para /rendimiento) ─────────────────────────────
+# Cada componente registra aquí una función que devuelve su bloque de texto.
+METRICAS_RENDIMIENTO = {
+    "planificador":   estadisticas_planificador,
+    "pool_imagenes":  estadisticas_pool_imagenes,
+    "cache_imagenes": estadisticas_cache_imagenes,
+    "lecturas_mongo": estadisticas_lecturas_mongo,
+    "config_chats":   estadisticas_config_chats,
+    "limitador":      estadisticas_limitador,
+    "borrados":       estadisticas_borrados,
+}
+
+# ─── Buffer de escritura para drops_log ──────────────────────────────────────
+# Los eventos de drops solo los leen las estadísticas de admin, así que no se
+# escriben desde el handler: se acumulan aquí y un hilo los manda con
+# insert_many al llegar a DROPS_LOG_LOTE eventos o cada DROPS_LOG_FLUSH_SEG.
+# Si el buffer se llena (Mongo caído) los eventos nuevos se descartan y cuentan.
+DROPS_LOG_BUFFER_MAX = int(os.getenv("DROPS_LOG_BUFFER_MAX", "5000"))
+DROPS_LOG_LOTE       = int(os.getenv("DROPS_LOG_LOTE", "100"))
+DROPS_LOG_FLUSH_SEG  = float(os.getenv("DROPS_LOG_FLUSH_SEG", "5"))
+_buffer_drops_log       = []
+_buffer_drops_log_mutex = threading.Lock()
+_evento_drops_log       = threading.Event()
+DROPS_LOG_STATS = {"encolados": 0, "escritos": 0, "lotes": 0, "descartados": 0, "fallidos": 0}
+
+def registrar_evento_drop(evento):
+    with _buffer_drops_log_mutex:
+        if len(_buffer_drops_log) >= DROPS_LOG_BUFFER_MAX:
+            DROPS_LOG_STATS["descartados"] += 1
+            return
+        _buffer_drops_log.append(evento)
+        DROPS_LOG_STATS["encolados"] += 1
+        pendientes = len(_buffer_drops_log)
+    if pendientes >= DROPS_LOG_LOTE:
+        _evento_drops_log.set()
+
+def vaciar_drops_log():
+    with _buffer_drops_log_mutex:
+        lote = _buffer_drops_log[:]
+        del _buffer_drops_log[:]
+    if not lote:
+        return
+    try:
+        col_drops_log.insert_many(lote, ordered=False)
+        DROPS_LOG_STATS["escritos"] += len(lote)
+    except Exception as e:
+        # En un BulkWriteError parte del lote puede haberse escrito
+        escritos = (getattr(e, "details", None) or {}).get("nInserted", 0)
+        DROPS_LOG_STATS["escritos"] += escritos
+        DROPS_LOG_STATS["fallidos"] += len(lote) - escritos
+        print("[drops_log] Error escribiendo lote:", e)
+    DROPS_LOG_STATS["lotes"] += 1
+
+def _escritor_drops_log():
+    while True:
+        _evento_drops_log.wait(DROPS_LOG_FLUSH_SEG)
+        _evento_drops_log.clear()
+        vaciar_drops_log()
+
+def iniciar_escritor_drops_log():
+    threading.Thread(target=_escritor_drops_log, daemon=True, name="escritor_drops_log").start()
+
+def estadisticas_drops_log():
+    st = DROPS_LOG_STATS
+    with _buffer_drops_log_mutex:
+        pendientes = len(_buffer_drops_log)
+    return (
+        f"🗂 <b>Buffer drops_log</b> (lote {DROPS_LOG_LOTE}, cada {DROPS_LOG_FLUSH_SEG:g}s)\n"
+        f"• En cola: <b>{pendientes}</b>/{DROPS_LOG_BUFFER_MAX} · Escritos: <b>{st['escritos']}</b> en {st['lotes']} lotes\n"
+        f"• Descartados: <b>{st['descartados']}</b> · Fallidos: <b>{st['fallidos']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["drops_log"] = estadisticas_drops_log
+
+# ─── Recordatorios de /idolday ───────────────────────────────────────────────
+# Cada recordatorio es un documento {_id: user_id, due_at} en Mongo, así que
+# sobreviven reinicios y un usuario nunca tiene más de uno pendiente (agendar
+# de nuevo solo mueve due_at). Un único hilo revisa cada
+# RECORDATORIOS_INTERVALO_SEG los vencidos, los reclama con un delete_many
+# por lote y los envía; ya no hay un hilo dormido por usuario.
+RECORDATORIOS_INTERVALO_SEG = float(os.getenv("RECORDATORIOS_INTERVALO_SEG", "15"))
+RECORDATORIOS_LOTE          = int(os.getenv("RECORDATORIOS_LOTE", "100"))
+RECORDATORIOS_STATS = {"agendados": 0, "enviados": 0, "omitidos": 0, "errores": 0}
+
+def agendar_notificacion_idolday(user_id, segundos):
+    try:
+        col_recordatorios.update_one(
+            {"_id": user_id},
+            {"$set": {"due_at": datetime.utcnow() + timedelta(seconds=max(0, segundos))}},
+            upsert=True
+        )
+        RECORDATORIOS_STATS["agendados"] += 1
+    except Exception as e:
+        print("[recordatorios] Error agendando:", e)
+
+def cancelar_notificacion_idolday(user_id):
+    try:
+        col_recordatorios.delete_one({"_id": user_id})
+    except Exception as e:
+        print("[recordatorios] Error cancelando:", e)
+
+def enviar_recordatorios_vencidos():
+    ahora = datetime.utcnow()
+    vencidos = list(
+        col_recordatorios.find({"due_at": {"$lte": ahora}}).sort("due_at", 1).limit(RECORDATORIOS_LOTE)
+    )
+    if not vencidos:
+        return 0
+    # Reclamar todo el lote de una vez; si alguno se reagendó mientras tanto
+    # (volvió a usar /idolday) no se borra, y el chequeo de cooldown de abajo
+    # evita avisarle antes de tiempo.
+    reclamados = [r["_id"] for r in vencidos]
+    col_recordatorios.delete_many({"_id": {"$in": reclamados}, "due_at": {"$lte": ahora}})
+    usuarios = col_usuarios.find(
+        {"user_id": {"$in": reclamados}},
+        {"user_id": 1, "notify_idolday": 1, "last_idolday": 1, "lang": 1}
+    )
+    for user_doc in usuarios:
+        last    = user_doc.get("last_idolday")
+        last_ts = last.timestamp() if hasattr(last, "timestamp") else 0
+        if not user_doc.get("notify_idolday") or time.time() - last_ts < 6 * 3600 - 5:
+            RECORDATORIOS_STATS["omitidos"] += 1
+            continue
+        lang   = (user_doc.get("lang") or "en")[:2]
+        textos = translations.get(lang, translations["en"])
+        try:
+            bot.send_message(chat_id=user_doc["user_id"], text=textos["kkp_notify_sent"], parse_mode="HTML")
+            RECORDATORIOS_STATS["enviados"] += 1
+        except RetryAfter as e:
+            agendar_notificacion_idolday(user_doc["user_id"], e.retry_after)
+            time.sleep(e.retry_after)
+        except Exception as e:
+            RECORDATORIOS_STATS["errores"] += 1
+            print("[recordatorios] Error enviando:", e)
+    return len(reclamados)
+
+def _trabajador_recordatorios():
+    while True:
+        try:
+            # Si el lote vino lleno puede haber más vencidos: seguir sin esperar
+            if enviar_recordatorios_vencidos() >= RECORDATORIOS_LOTE:
+                continue
+        except Exception as e:
+            RECORDATORIOS_STATS["errores"] += 1
+            print("[recordatorios] Error:", e)
+        time.sleep(RECORDATORIOS_INTERVALO_SEG)
+
+def iniciar_recordatorios_idolday():
+    threading.Thread(target=_trabajador_recordatorios, daemon=True, name="recordatorios_idolday").start()
+
+def estadisticas_recordatorios():
+    st = RECORDATORIOS_STATS
+    try:
+        pendientes = col_recordatorios.estimated_document_count()
+    except Exception:
+        pendientes = "?"
+    return (
+        f"⏰ <b>Recordatorios /idolday</b> (cada {RECORDATORIOS_INTERVALO_SEG:g}s)\n"
+        f"• Pendientes: <b>{pendientes}</b> · Agendados: <b>{st['agendados']}</b> · Enviados: <b>{st['enviados']}</b>\n"
+        f"• Omitidos: <b>{st['omitidos']}</b> · Errores: <b>{st['errores']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["recordatorios"] = estadisticas_recordatorios
+
+# ─── Registro de fuentes y glifos para el número ─────────────────────────────
+# La ruta se resuelve una sola vez al arrancar (el glob de /nix/store es lento);
+# las fuentes y los glifos "#0-9" se guardan por tamaño en píxeles.
+def _resolver_ruta_fuente():
     # Buscar fuente en múltiples rutas posibles (Render, Railway, Mac, etc.)
     font_paths = [
         _FONT_PATH,
@@ -553,43 +1630,307 @@ def agregar_numero_a_imagen(imagen_url, numero):
         "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
         "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
         "/usr/share/fonts/liberation/LiberationSans-Bold.ttf",
-        "/nix/store",  # marcador para buscar en nix
     ]
-    font = None
     for fp in font_paths:
-        if fp == "/nix/store":
-            # Buscar cualquier fuente TTF en el store de nix
-            import glob
-            nix_fonts = glob.glob("/nix/store/**/DejaVuSans-Bold.ttf", recursive=True)
-            if not nix_fonts:
-                nix_fonts = glob.glob("/nix/store/**/*.ttf", recursive=True)
-            if nix_fonts:
-                try:
-                    font = ImageFont.truetype(nix_fonts[0], size=font_size)
-                    break
-                except Exception:
-                    continue
-        elif os.path.isfile(fp):
+        if os.path.isfile(fp):
             try:
-                font = ImageFont.truetype(fp, size=font_size)
-                break
+                ImageFont.truetype(fp, size=12)
+                return fp
             except Exception:
                 continue
-    if font is None:
-        font = ImageFont.load_default()
-    texto = f"#{numero}"
-    bbox  = draw.textbbox((0, 0), texto, font=font)
+    # Buscar cualquier fuente TTF en el store de nix
+    import glob
+    nix_fonts = glob.glob("/nix/store/**/DejaVuSans-Bold.ttf", recursive=True)
+    if not nix_fonts:
+        nix_fonts = glob.glob("/nix/store/**/*.ttf", recursive=True)
+    for fp in nix_fonts:
+        try:
+            ImageFont.truetype(fp, size=12)
+            return fp
+        except Exception:
+            continue
+    return None
+
+RUTA_FUENTE_NUMERO = _resolver_ruta_fuente()
+if RUTA_FUENTE_NUMERO:
+    print(f"[font] Usando fuente {RUTA_FUENTE_NUMERO}")
+else:
+    print("[font] Sin fuente TTF, se usará la fuente por defecto de PIL")
+
+GLIFOS_NUMERO  = "#0123456789"
+_fuentes       = {}   # tamaño -> FreeTypeFont
+_glifos        = {}   # tamaño -> {caracter: (imagen, dx, dy, avance)}
+_fuentes_mutex = threading.Lock()
+
+def obtener_fuente(size):
+    with _fuentes_mutex:
+        font = _fuentes.get(size)
+        if font is None:
+            try:
+                font = ImageFont.truetype(RUTA_FUENTE_NUMERO, size=size) if RUTA_FUENTE_NUMERO else ImageFont.load_default()
+            except Exception:
+                font = ImageFont.load_default()
+            _fuentes[size] = font
+        return font
+
+def _renderizar_glifos(font):
+    glifos = {}
+    for ch in GLIFOS_NUMERO:
+        x0, y0, x1, y1 = font.getbbox(ch)
+        img = Image.new("RGBA", (max(1, x1 - x0), max(1, y1 - y0)), (0, 0, 0, 0))
+        ImageDraw.Draw(img).text((-x0, -y0), ch, font=font, fill=(255, 255, 255, 255))
+        glifos[ch] = (img, x0, y0, font.getlength(ch))
+    return glifos
+
+def obtener_glifos(size):
+    """Tira de glifos "#0-9" ya rasterizados para un tamaño (None si no se pudo)."""
+    glifos = _glifos.get(size)
+    if glifos is None:
+        try:
+            glifos = _renderizar_glifos(obtener_fuente(size))
+        except Exception as e:
+            print(f"[font] No se pudieron pre-renderizar glifos ({size}px): {e}")
+            glifos = False
+        with _fuentes_mutex:
+            _glifos[size] = glifos
+    return glifos or None
+
+def _estampar_texto(img, texto, glifos, font):
+    """Caja oscura + texto centrado abajo; pega glifos cacheados si los hay."""
+    draw = ImageDraw.Draw(img)
+    if glifos and all(ch in glifos for ch in texto):
+        # Misma geometría que draw.textbbox/draw.text con origen en (0, 0)
+        cursor = 0; colocados = []
+        left = top = right = bottom = None
+        for ch in texto:
+            g, dx, dy, avance = glifos[ch]
+            px, py = int(round(cursor)) + dx, dy
+            colocados.append((g, px, py))
+            left   = px if left is None else min(left, px)
+            top    = py if top is None else min(top, py)
+            right  = px + g.width if right is None else max(right, px + g.width)
+            bottom = py + g.height if bottom is None else max(bottom, py + g.height)
+            cursor += avance
+        bbox = (left, top, right, bottom)
+    else:
+        colocados = None
+        bbox = draw.textbbox((0, 0), texto, font=font)
     text_width  = bbox[2] - bbox[0]
     text_height = bbox[3] - bbox[1]
     x = (img.width - text_width) // 2
     y = img.height - text_height - 8
     draw.rectangle([x-6, y-4, x-6+text_width+14, y-4+text_height+8], fill=(0,0,0,170))
-    draw.text((x, y), texto, font=font, fill=(255,255,255,255))
+    if colocados is None:
+        draw.text((x, y), texto, font=font, fill=(255,255,255,255))
+    else:
+        for g, px, py in colocados:
+            img.paste(g, (x + px, y + py), g)
+
+# ─── Codificador de imágenes de drop ─────────────────────────────────────────
+# FORMATO_DROP: png | jpeg | webp. CALIDAD_DROP aplica a jpeg/webp; si se define
+# MAX_KB_DROP se busca la mayor calidad que quepa en ese tamaño. LADO_MAX_DROP
+# reduce la imagen (Telegram muestra las fotos a 1280px como máximo).
+FORMATO_DROP  = os.getenv("FORMATO_DROP", "png").lower()
+CALIDAD_DROP  = int(os.getenv("CALIDAD_DROP", "85"))
+MAX_KB_DROP   = int(os.getenv("MAX_KB_DROP", "0"))
+LADO_MAX_DROP = int(os.getenv("LADO_MAX_DROP", "0"))
+CALIDAD_MIN_DROP = 40
+
+_FORMATOS_PIL = {"png": "PNG", "jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP"}
+if FORMATO_DROP not in _FORMATOS_PIL:
+    print(f"[encoder] Formato desconocido '{FORMATO_DROP}', usando png")
+    FORMATO_DROP = "png"
+
+ENCODER_STATS  = {}   # formato -> {"n", "ms", "bytes"}
+_encoder_mutex = threading.Lock()
+
+def redimensionar_para_envio(img, lado_max=None):
+    lado_max = LADO_MAX_DROP if lado_max is None else lado_max
+    if not lado_max or max(img.size) <= lado_max:
+        return img
+    escala = lado_max / max(img.size)
+    return img.resize((max(1, int(img.width * escala)), max(1, int(img.height * escala))), Image.LANCZOS)
+
+def _guardar(img, formato, calidad):
     output = BytesIO()
-    img.save(output, format="PNG")
+    if formato == "PNG":
+        img.save(output, format="PNG")
+    elif formato == "JPEG":
+        if img.mode != "RGB":
+            fondo = Image.new("RGB", img.size, (255, 255, 255))
+            fondo.paste(img, mask=img.getchannel("A") if "A" in img.getbands() else None)
+            img = fondo
+        img.save(output, format="JPEG", quality=calidad, optimize=True, progressive=True)
+    else:
+        img.save(output, format="WEBP", quality=calidad, method=4)
+    return output
+
+def codificar_imagen(img, formato=None, calidad=None, max_kb=None):
+    """Codifica la imagen para enviarla a Telegram y registra tiempo y tamaño por formato."""
+    formato = _FORMATOS_PIL.get((formato or FORMATO_DROP).lower(), "PNG")
+    calidad = CALIDAD_DROP if calidad is None else calidad
+    max_kb  = MAX_KB_DROP if max_kb is None else max_kb
+    inicio  = time.perf_counter()
+
+    output = _guardar(img, formato, calidad)
+    if formato != "PNG" and max_kb and output.tell() > max_kb * 1024:
+        # Búsqueda binaria de la mayor calidad que cabe en el presupuesto
+        lo, hi, mejor = CALIDAD_MIN_DROP, calidad - 1, None
+        while lo <= hi:
+            q = (lo + hi) // 2
+            intento = _guardar(img, formato, q)
+            if intento.tell() <= max_kb * 1024:
+                mejor, lo = intento, q + 1
+            else:
+                hi = q - 1
+        output = mejor or _guardar(img, formato, CALIDAD_MIN_DROP)
+
+    ms = (time.perf_counter() - inicio) * 1000
+    with _encoder_mutex:
+        st = ENCODER_STATS.setdefault(formato.lower(), {"n": 0, "ms": 0.0, "bytes": 0})
+        st["n"] += 1; st["ms"] += ms; st["bytes"] += output.tell()
+    output.name = f"carta.{'jpg' if formato == 'JPEG' else formato.lower()}"
     output.seek(0)
     return output
 
+def estadisticas_encoder():
+    texto = f"🗜️ <b>Encoder</b> ({FORMATO_DROP}, q={CALIDAD_DROP}, max={MAX_KB_DROP or '-'}KB, lado={LADO_MAX_DROP or '-'})\n"
+    with _encoder_mutex:
+        items = [(f, dict(st)) for f, st in ENCODER_STATS.items()]
+    if not items:
+        return texto + "• Sin imágenes codificadas aún.\n"
+    for formato, st in items:
+        texto += f"• {formato}: <b>{st['n']}</b> · {st['ms'] / st['n']:.0f} ms · {st['bytes'] / st['n'] / 1024:.0f} KB prom.\n"
+    return texto
+
+METRICAS_RENDIMIENTO["encoder"] = estadisticas_encoder
+
+# ─── Imagen con número ───────────────────────────────────────────────────────
+def renderizar_numero_en_imagen(imagen_url, numero):
+    """Carta con su número estampado, como Image RGBA sin codificar."""
+    img       = redimensionar_para_envio(obtener_imagen_catalogo(imagen_url))
+    font_size = int(img.height * 0.05)
+    _estampar_texto(img, f"#{numero}", obtener_glifos(font_size), obtener_fuente(font_size))
+    return img
+
+def agregar_numero_a_imagen(imagen_url, numero):
+    return codificar_imagen(renderizar_numero_en_imagen(imagen_url, numero))
+
+# ─── Caché de file_id de Telegram ────────────────────────────────────────────
+# Tras el primer envío de una URL (o de una variante renderizada) guardamos el
+# file_id que devuelve Telegram; los envíos siguientes lo reutilizan y Telegram
+# ya no tiene que descargar la imagen desde i.ibb.co.
+FILE_IDS_MAX_RAM  = 5000
+_file_ids         = OrderedDict()   # (url, variante) -> file_id
+_file_ids_mutex   = threading.Lock()
+FILE_IDS_STATS    = {"hits": 0, "misses": 0, "guardados": 0, "invalidos": 0}
+
+def file_id_de(url, variante="original"):
+    if not url:
+        return None
+    clave = (url, variante)
+    with _file_ids_mutex:
+        fid = _file_ids.get(clave)
+        if fid:
+            _file_ids.move_to_end(clave)
+    if not fid:
+        try:
+            doc = col_file_ids.find_one({"url": url, "variante": variante}, {"file_id": 1})
+        except Exception as e:
+            print("[file_ids] Error leyendo Mongo:", e)
+            doc = None
+        fid = doc.get("file_id") if doc else None
+        if fid:
+            _recordar_file_id(clave, fid)
+    FILE_IDS_STATS["hits" if fid else "misses"] += 1
+    return fid
+
+def file_ids_de(urls, variante="original"):
+    """Versión por lotes de file_id_de: una sola consulta a Mongo para los que faltan en RAM."""
+    encontrados, faltan = {}, []
+    urls = set(u for u in urls if u)
+    with _file_ids_mutex:
+        for url in urls:
+            fid = _file_ids.get((url, variante))
+            if fid:
+                encontrados[url] = fid
+            else:
+                faltan.append(url)
+    if faltan:
+        try:
+            for doc in col_file_ids.find({"url": {"$in": faltan}, "variante": variante}, {"url": 1, "file_id": 1}):
+                encontrados[doc["url"]] = doc["file_id"]
+                _recordar_file_id((doc["url"], variante), doc["file_id"])
+        except Exception as e:
+            print("[file_ids] Error leyendo Mongo:", e)
+    FILE_IDS_STATS["hits"]   += len(encontrados)
+    FILE_IDS_STATS["misses"] += len(urls) - len(encontrados)
+    return encontrados
+
+def _recordar_file_id(clave, fid):
+    with _file_ids_mutex:
+        _file_ids[clave] = fid
+        _file_ids.move_to_end(clave)
+        while len(_file_ids) > FILE_IDS_MAX_RAM:
+            _file_ids.popitem(last=False)
+
+def guardar_file_id(url, file_id, variante="original"):
+    if not url or not file_id:
+        return
+    _recordar_file_id((url, variante), file_id)
+    FILE_IDS_STATS["guardados"] += 1
+    try:
+        col_file_ids.update_one(
+            {"url": url, "variante": variante},
+            {"$set": {"file_id": file_id, "fecha": datetime.utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        print("[file_ids] Error guardando en Mongo:", e)
+
+def olvidar_file_id(url, variante="original"):
+    FILE_IDS_STATS["invalidos"] += 1
+    with _file_ids_mutex:
+        _file_ids.pop((url, variante), None)
+    try:
+        col_file_ids.delete_one({"url": url, "variante": variante})
+    except Exception:
+        pass
+
+def registrar_file_id_de_mensaje(url, mensaje, variante="original"):
+    """Guarda el file_id de la foto más grande de un mensaje ya enviado."""
+    fotos = getattr(mensaje, "photo", None) if mensaje else None
+    if fotos:
+        guardar_file_id(url, fotos[-1].file_id, variante)
+
+def foto_para_enviar(url, variante="original"):
+    return file_id_de(url, variante) or url
+
+def enviar_foto_cacheada(enviar, url, variante="original", **kwargs):
+    """Envía con file_id si lo conocemos; si Telegram lo rechaza, reintenta con la URL."""
+    fid = file_id_de(url, variante)
+    if fid:
+        try:
+            return enviar(photo=fid, **kwargs)
+        except BadRequest as e:
+            print(f"[file_ids] file_id rechazado para {url}: {e}")
+            olvidar_file_id(url, variante)
+    msg = enviar(photo=url, **kwargs)
+    registrar_file_id_de_mensaje(url, msg, variante)
+    return msg
+
+def estadisticas_file_ids():
+    s = FILE_IDS_STATS
+    with _file_ids_mutex:
+        en_ram = len(_file_ids)
+    return (
+        f"📎 <b>file_id de Telegram</b>\n"
+        f"• En RAM: <b>{en_ram}</b> · Hits: <b>{s['hits']}</b> · Misses: <b>{s['misses']}</b>\n"
+        f"• Guardados: <b>{s['guardados']}</b> · Inválidos: <b>{s['invalidos']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["file_ids"] = estadisticas_file_ids
+
 # ─── Catálogos de objetos ─────────────────────────────────────────────────────
 CATALOGO_OBJETOS = {
     "bono_idolday": {
@@ -630,17 +1971,135 @@ def extraer_card_id_de_id_unico(id_unico):
             return None
     return None
 
+# ─── Resumen de colección por usuario ────────────────────────────────────────
+# Un documento por usuario en col_resumen_coleccion:
+#   claves:    "grupo|nombre|version" -> copias   (cartas distintas que tiene)
+#   sets:      set -> cartas distintas del set que tiene
+#   estrellas: "★★☆" -> copias
+#   total:     copias en total
+# Se mantiene con $inc cada vez que una carta entra o sale del álbum, así los
+# sets completados y las vistas de progreso no tienen que leer todas sus cartas.
+_resumenes_confirmados = set()
+RESUMEN_STATS = {"incrementales": 0, "reconstrucciones": 0}
+
+def _campo_resumen(texto):
+    # Mongo no admite '.' ni '$' inicial en nombres de campo
+    return str(texto).replace(".", "．").replace("$", "＄")
+
+def clave_resumen(grupo, nombre, version):
+    return _campo_resumen(f"{grupo}|{nombre}|{version}")
+
+def _grupo_de(carta):
+    return carta.get("grupo") or carta.get("set") or ""
+
+def reconstruir_resumen_coleccion(user_id):
+    claves, sets, estrellas, total = {}, {}, {}, 0
+    vistos = set()
+    for c in col_cartas_usuario.find({"user_id": user_id}, {"nombre": 1, "version": 1, "grupo": 1, "set": 1, "estrellas": 1, "count": 1}):
+        n     = c.get("count", 1) or 1
+        grupo = _grupo_de(c)
+        k     = clave_resumen(grupo, c["nombre"], c["version"])
+        claves[k] = claves.get(k, 0) + n
+        total    += n
+        if c.get("estrellas"):
+            e = _campo_resumen(c["estrellas"])
+            estrellas[e] = estrellas.get(e, 0) + n
+        if k not in vistos and (c["nombre"], c["version"]) in SETS_PRECALCULADOS.get(grupo, ()):
+            ks = _campo_resumen(grupo)
+            sets[ks] = sets.get(ks, 0) + 1
+        vistos.add(k)
+    doc = {"user_id": user_id, "claves": claves, "sets": sets, "estrellas": estrellas, "total": total}
+    col_resumen_coleccion.replace_one({"user_id": user_id}, doc, upsert=True)
+    _resumenes_confirmados.add(user_id)
+    RESUMEN_STATS["reconstrucciones"] += 1
+    return doc
+
+def obtener_resumen_coleccion(user_id, campos=None):
+    proyeccion = {c: 1 for c in campos} if campos else None
+    doc = col_resumen_coleccion.find_one({"user_id": user_id}, proyeccion)
+    if doc is None:
+        return reconstruir_resumen_coleccion(user_id)
+    _resumenes_confirmados.add(user_id)
+    return doc
+
+def _aplicar_carta_resumen(user_id, carta, signo):
+    delta = signo * (carta.get("count", 1) or 1)
+    grupo = _grupo_de(carta)
+    k     = clave_resumen(grupo, carta["nombre"], carta["version"])
+    inc   = {"total": delta, f"claves.{k}": delta}
+    if carta.get("estrellas"):
+        inc[f"estrellas.{_campo_resumen(carta['estrellas'])}"] = delta
+    doc = col_resumen_coleccion.find_one_and_update(
+        {"user_id": user_id}, {"$inc": inc},
+        projection={f"claves.{k}": 1}, return_document=True
+    )
+    copias = (doc or {}).get("claves", {}).get(k, 0)
+    en_set = (carta["nombre"], carta["version"]) in SETS_PRECALCULADOS.get(grupo, ())
+    campo_set = f"sets.{_campo_resumen(grupo)}"
+    if delta > 0 and copias == delta and en_set:
+        col_resumen_coleccion.update_one({"user_id": user_id}, {"$inc": {campo_set: 1}})
+        return grupo
+    elif delta < 0 and copias <= 0:
+        # El filtro sobre claves.k hace que solo una salida descuente el set
+        cambios = {"$unset": {f"claves.{k}": ""}}
+        if en_set:
+            cambios["$inc"] = {campo_set: -1}
+        col_resumen_coleccion.update_one({"user_id": user_id, f"claves.{k}": {"$lte": 0}}, cambios)
+
+def actualizar_resumen_coleccion(user_id, entradas=(), salidas=()):
+    """Aplica al resumen las cartas que entraron y salieron del álbum (ya escritas).
+
+    Devuelve los sets cuyo contador subió, o None si el resumen se reconstruyó.
+    """
+    try:
+        if user_id not in _resumenes_confirmados and not col_resumen_coleccion.find_one({"user_id": user_id}, {"_id": 1}):
+            # Sin resumen previo: se arma desde el álbum, que ya incluye estos cambios
+            reconstruir_resumen_coleccion(user_id)
+            return None
+        _resumenes_confirmados.add(user_id)
+        for carta in salidas:
+            _aplicar_carta_resumen(user_id, carta, -1)
+        tocados = set()
+        for carta in entradas:
+            grupo = _aplicar_carta_resumen(user_id, carta, 1)
+            if grupo:
+                tocados.add(grupo)
+        RESUMEN_STATS["incrementales"] += 1
+        return tocados
+    except Exception as e:
+        print("[resumen_coleccion] Error:", e)
+        _resumenes_confirmados.discard(user_id)
+        col_resumen_coleccion.delete_one({"user_id": user_id})
+        return None
+
+def cambiar_estrellas_resumen(user_id, antes, despues):
+    try:
+        col_resumen_coleccion.update_one(
+            {"user_id": user_id},
+            {"$inc": {f"estrellas.{_campo_resumen(antes)}": -1, f"estrellas.{_campo_resumen(despues)}": 1}}
+        )
+    except Exception as e:
+        print("[resumen_coleccion] Error:", e)
+
+def estadisticas_resumen_coleccion():
+    st = RESUMEN_STATS
+    return (
+        f"📚 <b>Resumen de colecciones</b>\n"
+        f"• Actualizaciones incrementales: <b>{st['incrementales']}</b> · Reconstrucciones: <b>{st['reconstrucciones']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["resumen_coleccion"] = estadisticas_resumen_coleccion
+
 def revisar_sets_completados(user_id, context):
-    """Usa SETS_PRECALCULADOS para evitar iterar cartas.json en cada drop."""
-    cartas_usuario = list(col_cartas_usuario.find({"user_id": user_id}))
-    cartas_usuario_unicas = set((c["nombre"], c["version"]) for c in cartas_usuario)
+    """Compara los contadores por set del resumen con SETS_PRECALCULADOS."""
+    sets_usuario = obtener_resumen_coleccion(user_id, ["sets"]).get("sets", {})
 
-    doc_usuario  = col_usuarios.find_one({"user_id": user_id}) or {}
+    doc_usuario  = col_usuarios.find_one({"user_id": user_id}, {"sets_premiados": 1}) or {}
     sets_premiados = set(doc_usuario.get("sets_premiados", []))
     premios = []
 
     for s, cartas_set in SETS_PRECALCULADOS.items():
-        if cartas_set and cartas_set.issubset(cartas_usuario_unicas) and s not in sets_premiados:
+        if cartas_set and sets_usuario.get(_campo_resumen(s), 0) >= len(cartas_set) and s not in sets_premiados:
             monto = 500 * len(cartas_set)
             premios.append((s, monto))
             sets_premiados.add(s)
@@ -718,37 +2177,162 @@ def grupo_de_carta(nombre, version):
 def crear_drop_id(chat_id, mensaje_id):
     return f"{chat_id}_{mensaje_id}"
 
+# ─── Caché de administradores por chat ───────────────────────────────────────
+# es_admin ya no llama a get_chat_member en cada comando: la lista de admins de
+# cada chat se pide con get_chat_administrators y se guarda ADMINS_TTL_SEG.
+# Al vencer se sigue usando la copia vieja mientras un hilo la refresca, y las
+# actualizaciones chat_member (promociones / degradaciones) la corrigen al vuelo.
+ADMINS_TTL_SEG       = int(os.getenv("ADMINS_TTL_SEG", "600"))
+_admins_por_chat     = {}   # chat_id -> {"ids": set, "expira": ts, "refrescando": bool}
+_admins_mutex        = threading.Lock()
+ADMINS_STATS         = {"consultas": 0, "cargas": 0, "errores": 0, "eventos": 0}
+ESTADOS_ADMIN        = ("administrator", "creator")
+
+def _cargar_admins_chat(chat_id):
+    try:
+        ids = {m.user.id for m in bot.get_chat_administrators(chat_id) if m.status in ESTADOS_ADMIN}
+    except Exception as e:
+        ADMINS_STATS["errores"] += 1
+        print(f"[admins] Error cargando admins de {chat_id}:", e)
+        with _admins_mutex:
+            entrada = _admins_por_chat.get(chat_id)
+            if entrada:
+                entrada["refrescando"] = False
+        return None
+    ADMINS_STATS["cargas"] += 1
+    with _admins_mutex:
+        _admins_por_chat[chat_id] = {"ids": ids, "expira": time.time() + ADMINS_TTL_SEG, "refrescando": False}
+    return ids
+
+def admins_de_chat(chat_id):
+    """Set de user_ids admin del chat, o None si no se pudo obtener."""
+    ADMINS_STATS["consultas"] += 1
+    with _admins_mutex:
+        entrada = _admins_por_chat.get(chat_id)
+        refrescar = entrada is not None and entrada["expira"] <= time.time() and not entrada["refrescando"]
+        if refrescar:
+            entrada["refrescando"] = True
+    if entrada is None:
+        return _cargar_admins_chat(chat_id)
+    if refrescar:
+        threading.Thread(target=_cargar_admins_chat, args=(chat_id,), daemon=True, name="refresco_admins").start()
+    return entrada["ids"]
+
+def actualizar_admins_por_evento(update, context):
+    cambio = update.chat_member
+    if not cambio:
+        return
+    ADMINS_STATS["eventos"] += 1
+    with _admins_mutex:
+        entrada = _admins_por_chat.get(cambio.chat.id)
+        if entrada is None:
+            return
+        if cambio.new_chat_member.status in ESTADOS_ADMIN:
+            entrada["ids"].add(cambio.new_chat_member.user.id)
+        else:
+            entrada["ids"].discard(cambio.new_chat_member.user.id)
+
+def estadisticas_admins():
+    st = ADMINS_STATS
+    return (
+        f"🛡 <b>Caché de admins</b> (TTL {ADMINS_TTL_SEG}s)\n"
+        f"• Chats: <b>{len(_admins_por_chat)}</b> · Consultas: <b>{st['consultas']}</b> · Cargas API: <b>{st['cargas']}</b>\n"
+        f"• Eventos chat_member: <b>{st['eventos']}</b> · Errores: <b>{st['errores']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["admins"] = estadisticas_admins
+
 def es_admin(update, context=None):
     chat    = update.effective_chat
     user_id = update.effective_user.id
     if chat.type not in ["group", "supergroup"]:
         return False
+    admins = admins_de_chat(chat.id)
+    if admins is not None:
+        return user_id in admins
     try:
         member = bot.get_chat_member(chat.id, user_id)
-        return member.status in ("administrator", "creator")
+        return member.status in ESTADOS_ADMIN
     except Exception:
         return False
 
-def puede_usar_idolday(user_id):
-    user_doc        = col_usuarios.find_one({"user_id": user_id}) or {}
-    bono            = user_doc.get('bono', 0)
-    objetos         = user_doc.get('objetos', {})
-    bonos_inventario= objetos.get('bono_idolday', 0)
-    last            = user_doc.get('last_idolday')
-    ahora           = datetime.utcnow()
-    cooldown_listo  = False
-    bono_listo      = False
-    if last:
-        cooldown_listo = (ahora - last).total_seconds() >= 6 * 3600
-    else:
-        cooldown_listo = True
-    if (bono and bono > 0) or (bonos_inventario and bonos_inventario > 0):
-        bono_listo = True
-    return cooldown_listo, bono_listo
+# ─── Consumo atómico de cooldown/bono (/idolday y reclamos) ─────────────────
+def consumir_cooldown_o_bono(user_id, ahora_dt, renovar_cooldown=False, campos=None, proyeccion=None):
+    """Gasta el cooldown (o, si no está listo, un bono) en una sola escritura.
+
+    El filtro solo deja pasar usuarios que pueden usarlo y el pipeline decide
+    qué consumir sobre el documento original, así dos clics o comandos
+    simultáneos no pueden gastar el mismo cooldown. Con renovar_cooldown el
+    last_idolday se renueva también al gastar un bono (/idolday). `campos` se
+    escriben en la misma operación e `idolday_via` queda con lo consumido.
+    Devuelve (documento o None, last_idolday si falló). El documento es el
+    anterior a la escritura con `idolday_via` ya resuelto, así
+    devolver_idolday() puede deshacer exactamente lo consumido.
+    """
+    corte      = ahora_dt - timedelta(seconds=6 * 3600)
+    cooldown   = {"$lte": [{"$ifNull": ["$last_idolday", corte]}, corte]}
+    inventario = {"$gt": [{"$ifNull": ["$objetos.bono_idolday", 0]}, 0]}
+    legacy     = {"$gt": [{"$ifNull": ["$bono", 0]}, 0]}
+    cambios = {
+        "last_idolday": ahora_dt if renovar_cooldown else {"$cond": [cooldown, ahora_dt, "$last_idolday"]},
+        "objetos.bono_idolday": {"$cond": [
+            {"$and": [{"$not": [cooldown]}, inventario]},
+            {"$subtract": ["$objetos.bono_idolday", 1]}, "$objetos.bono_idolday"
+        ]},
+        "bono": {"$cond": [
+            {"$and": [{"$not": [cooldown]}, {"$not": [inventario]}, legacy]},
+            {"$subtract": ["$bono", 1]}, "$bono"
+        ]},
+        "idolday_via": {"$cond": [cooldown, "cooldown", {"$cond": [inventario, "bono_idolday", "bono"]}]},
+    }
+    for k, v in (campos or {}).items():
+        cambios[k] = {"$literal": v}
+    proyeccion = dict(proyeccion or {}, last_idolday=1, **{"objetos.bono_idolday": 1})
+    doc = col_usuarios.find_one_and_update(
+        {"user_id": user_id, "$or": [
+            {"last_idolday": None}, {"last_idolday": {"$lte": corte}},
+            {"objetos.bono_idolday": {"$gt": 0}}, {"bono": {"$gt": 0}},
+        ]},
+        [{"$set": cambios}],
+        projection=proyeccion
+    )
+    if doc:
+        # Misma decisión que el pipeline, sobre el documento original
+        last_previo = doc.get("last_idolday")
+        if last_previo is None or last_previo <= corte:
+            doc["idolday_via"] = "cooldown"
+        elif (doc.get("objetos") or {}).get("bono_idolday", 0) > 0:
+            doc["idolday_via"] = "bono_idolday"
+        else:
+            doc["idolday_via"] = "bono"
+        doc["last_idolday_nuevo"] = ahora_dt if renovar_cooldown or doc["idolday_via"] == "cooldown" else last_previo
+        return doc, None
+    actual = col_usuarios.find_one({"user_id": user_id}, {"last_idolday": 1})
+    if actual is None:
+        # Usuario nuevo: no tiene cooldown que respetar (solo gana quien lo crea)
+        nuevo = dict(campos or {}, last_idolday=ahora_dt, idolday_via="cooldown")
+        res = col_usuarios.update_one({"user_id": user_id}, {"$setOnInsert": nuevo}, upsert=True)
+        if res.upserted_id is not None:
+            return dict(nuevo, last_idolday=None, last_idolday_nuevo=ahora_dt), None
+        actual = col_usuarios.find_one({"user_id": user_id}, {"last_idolday": 1}) or {}
+    return None, actual.get("last_idolday")
+
+def devolver_idolday(user_id, doc):
+    """Deshace lo que gastó consumir_cooldown_o_bono (doc es lo que devolvió)."""
+    via = doc.get("idolday_via")
+    if via == "bono_idolday":
+        col_usuarios.update_one({"user_id": user_id}, {"$inc": {"objetos.bono_idolday": 1}})
+    elif via == "bono":
+        col_usuarios.update_one({"user_id": user_id}, {"$inc": {"bono": 1}})
+    # last_idolday solo vuelve atrás si nadie lo cambió desde entonces
+    if doc.get("last_idolday_nuevo") != doc.get("last_idolday"):
+        restaurar = ({"$set": {"last_idolday": doc["last_idolday"]}} if doc.get("last_idolday")
+                     else {"$unset": {"last_idolday": ""}})
+        col_usuarios.update_one({"user_id": user_id, "last_idolday": doc["last_idolday_nuevo"]}, restaurar)
 
 def expira_drop(drop_id):
-    drop = DROPS_ACTIVOS.get(drop_id)
-    if not drop or drop.get("expirado"):
+    drop = drop_expirar(drop_id)
+    if not drop:
         return
     keyboard = [[
         InlineKeyboardButton("❌", callback_data="expirado"),
@@ -762,40 +2346,34 @@ def expira_drop(drop_id):
         )
     except Exception:
         pass
-    drop["expirado"] = True
 
 def desbloquear_drop(drop_id):
-    time.sleep(60)
-    drop = DROPS_ACTIVOS.get(drop_id)
-    if drop and not drop.get("expirado"):
-        drop["expirado"] = True
-        try:
-            col_drops_log.insert_one({
-                "evento": "expirado",
-                "drop_id": drop_id,
-                "cartas": drop.get("cartas", []),
-                "dueño": drop.get("dueño"),
-                "chat_id": drop.get("chat_id"),
-                "mensaje_id": drop.get("mensaje_id"),
-                "fecha": datetime.utcnow(),
-                "usuarios_reclamaron": drop.get("usuarios_reclamaron", []),
-            })
-        except Exception:
-            pass
+    drop = drop_expirar(drop_id)
+    if drop:
+        registrar_evento_drop({
+            "evento": "expirado",
+            "drop_id": drop_id,
+            "cartas": [dict(c) for c in drop.get("cartas", [])],
+            "dueño": drop.get("dueño"),
+            "chat_id": drop.get("chat_id"),
+            "mensaje_id": drop.get("mensaje_id"),
+            "fecha": datetime.utcnow(),
+            "usuarios_reclamaron": list(drop.get("usuarios_reclamaron", [])),
+        })
 
 def estados_disponibles_para_carta(nombre, version):
     return [c for c in cartas if c['nombre'] == nombre and c['version'] == version]
 
-def get_user_lang(user_id, update):
-    user = col_usuarios.find_one({"user_id": user_id})
+def get_user_lang(user_id, update, context=None):
+    user = usuario_ctx(context, user_id, "lang")
     return (
-        (user.get("lang") if user else None)
+        user.get("lang")
         or getattr(update.effective_user, "language_code", "")
         or "en"
     )[:2]
 
-def t(user_id, update):
-    lang = get_user_lang(user_id, update)
+def t(user_id, update, context=None):
+    lang = get_user_lang(user_id, update, context)
     return translations.get(lang, translations["en"])
 
 # ─── Referidos ────────────────────────────────────────────────────────────────
@@ -808,11 +2386,12 @@ REFERRAL_REWARDS = [
     (100, "Lightstick x6",      {"objetos.lightstick": 6}),
 ]
 
+@usa_usuario("lang", "referidos", "ref_premios")
 def callback_invitamenu(update, context):
     try:
         query   = update.callback_query
         user_id = query.from_user.id
-        texto   = t(user_id, update)
+        texto   = t(user_id, update, context)
 
         if query.data == "menu_invitacion":
             link = f"https://t.me/{context.bot.username}?start=ref{user_id}"
@@ -828,7 +2407,7 @@ def callback_invitamenu(update, context):
             )
 
         elif query.data == "menu_progress":
-            user_doc       = col_usuarios.find_one({"user_id": user_id}) or {}
+            user_doc       = usuario_ctx(context, user_id, "referidos", "ref_premios")
             referidos      = user_doc.get("referidos", [])
             ref_premios    = user_doc.get("ref_premios", [])
             total          = len(referidos)
@@ -838,8 +2417,7 @@ def callback_invitamenu(update, context):
             for cantidad, nombre_p, obj_dict in REFERRAL_REWARDS:
                 if total >= cantidad:
                     if cantidad not in premios_obtenidos:
-                        col_usuarios.update_one({"user_id": user_id}, {"$addToSet": {"ref_premios": cantidad}})
-                        col_usuarios.update_one({"user_id": user_id}, {"$inc": obj_dict})
+                        actualizar_usuario(context, user_id, {"$addToSet": {"ref_premios": cantidad}, "$inc": obj_dict})
                         rewards_text += texto["reward_now"].format(prize=nombre_p, count=cantidad) + "\n"
                         premios_obtenidos.append(cantidad)
                     else:
@@ -859,7 +2437,7 @@ def callback_invitamenu(update, context):
 @log_command
 def comando_help(update, context):
     user_id = update.effective_user.id
-    texto   = t(user_id, update)
+    texto   = t(user_id, update, context)
     if update.message.chat.type != "private":
         update.message.reply_text(texto["help_message_group"])
         return
@@ -884,7 +2462,7 @@ def callback_help(update, context):
         query   = update.callback_query
         data    = query.data
         user_id = query.from_user.id
-        texto   = t(user_id, update)
+        texto   = t(user_id, update, context)
 
         textos_faq = {
             "help_faq_kponey": texto["faq_kponey_desc"],
@@ -979,6 +2557,7 @@ def comando_settema(update, context):
         {"$set": {"thread_ids": list(nuevos)}},
         upsert=True
     )
+    invalidar_config_chats()
     update.message.reply_text(
         f"✅ El comando <b>/{comando}</b> funcionará en los temas: <code>{', '.join(str(t) for t in nuevos)}</code>",
         parse_mode='HTML'
@@ -996,6 +2575,7 @@ def comando_removetema(update, context):
         return
     comando = context.args[0]
     res = col_temas_comandos.delete_one({"chat_id": chat_id, "comando": comando})
+    invalidar_config_chats()
     if res.deleted_count:
         update.message.reply_text(f"El comando <b>/{comando}</b> ahora puede usarse en cualquier tema.", parse_mode='HTML')
     else:
@@ -1019,6 +2599,215 @@ def comando_vertemas(update, context):
         texto += f"<b>/{d['comando']}</b>: {threads}\n"
     update.message.reply_text(texto, parse_mode='HTML')
 
+# ─── Reserva de seriales por bloques ──────────────────────────────────────────
+# En vez de un $inc por carta dropeada, se reserva un bloque de BLOQUE_SERIALES
+# números con un solo $inc y se reparten en memoria. Al apagar, lo no usado se
+# devuelve al contador (si nadie reservó después) o queda en seriales_sobrantes,
+# que se consume antes de pedir un bloque nuevo.
+BLOQUE_SERIALES = int(os.getenv("BLOQUE_SERIALES", "5"))
+
+_bloques_seriales       = {}   # (nombre, version, grupo) -> [siguiente, ultimo]
+_bloques_seriales_locks = {}
+_bloques_seriales_mutex = threading.Lock()
+SERIALES_STATS          = {"entregados": 0, "bloques": 0, "sobrantes_usados": 0}
+
+def _lock_serial(clave):
+    with _bloques_seriales_mutex:
+        if clave not in _bloques_seriales_locks:
+            _bloques_seriales_locks[clave] = threading.Lock()
+        return _bloques_seriales_locks[clave]
+
+def _nuevo_bloque_seriales(nombre, version, grupo):
+    filtro   = {"nombre": nombre, "version": version, "grupo": grupo}
+    sobrante = col_seriales_sobrantes.find_one_and_delete(filtro, sort=[("desde", 1)])
+    if sobrante:
+        SERIALES_STATS["sobrantes_usados"] += 1
+        return [sobrante["desde"], sobrante["hasta"]]
+    doc_cont = col_contadores.find_one_and_update(
+        filtro,
+        {"$inc": {"contador": BLOQUE_SERIALES}},
+        upsert=True,
+        return_document=True
+    )
+    SERIALES_STATS["bloques"] += 1
+    ultimo = doc_cont["contador"]
+    return [ultimo - BLOQUE_SERIALES + 1, ultimo]
+
+def reservar_serial(nombre, version, grupo):
+    clave = (nombre, version, grupo)
+    with _lock_serial(clave):
+        bloque = _bloques_seriales.get(clave)
+        if not bloque or bloque[0] > bloque[1]:
+            bloque = _nuevo_bloque_seriales(nombre, version, grupo)
+            _bloques_seriales[clave] = bloque
+        serial = bloque[0]
+        bloque[0] += 1
+    SERIALES_STATS["entregados"] += 1
+    return serial
+
+def liberar_seriales_reservados():
+    """Devuelve o registra los seriales reservados que no se usaron (al apagar)."""
+    with _bloques_seriales_mutex:
+        pendientes = list(_bloques_seriales.items())
+        _bloques_seriales.clear()
+    for (nombre, version, grupo), (siguiente, ultimo) in pendientes:
+        if siguiente > ultimo:
+            continue
+        filtro = {"nombre": nombre, "version": version, "grupo": grupo}
+        try:
+            res = col_contadores.update_one(
+                dict(filtro, contador=ultimo), {"$set": {"contador": siguiente - 1}}
+            )
+            if res.modified_count == 0:
+                col_seriales_sobrantes.insert_one(dict(filtro, desde=siguiente, hasta=ultimo, fecha=datetime.utcnow()))
+        except Exception as e:
+            logger.warning(f"[seriales] No se pudo liberar {nombre} {version} {grupo} {siguiente}-{ultimo}: {e}")
+
+def estadisticas_seriales():
+    with _bloques_seriales_mutex:
+        disponibles = sum(max(0, u - s + 1) for s, u in _bloques_seriales.values())
+        claves      = len(_bloques_seriales)
+    st = SERIALES_STATS
+    return (
+        f"🔢 <b>Seriales</b> (bloque {BLOQUE_SERIALES})\n"
+        f"• Entregados: <b>{st['entregados']}</b> · Bloques pedidos: <b>{st['bloques']}</b> · Sobrantes reutilizados: <b>{st['sobrantes_usados']}</b>\n"
+        f"• Reservados sin usar: <b>{disponibles}</b> en {claves} cartas\n"
+    )
+
+METRICAS_RENDIMIENTO["seriales"] = estadisticas_seriales
+
+# ─── Drops pre-renderizados por chat ─────────────────────────────────────────
+# Un hilo productor mantiene DROPS_PRECALCULADOS_POR_CHAT drops listos (seriales
+# reservados e imágenes ya codificadas) para cada grupo permitido; /idolday solo
+# saca uno y lo envía. Los seriales de los que queden sin usar al apagar se
+# guardan en seriales_sobrantes.
+DROPS_PRECALCULADOS_POR_CHAT = int(os.getenv("DROPS_PRECALCULADOS_POR_CHAT", "1"))
+
+_drops_precalculados       = {}   # chat_id -> [resultados de preparar_drop]
+_drops_precalculados_mutex = threading.Lock()
+_evento_reponer_drops      = threading.Event()
+DROPS_PRECALCULADOS_STATS  = {"usados": 0, "sin_buffer": 0, "generados": 0, "descartados": 0}
+
+def preparar_drop(cartas_drop):
+    """Reserva seriales y renderiza en el pool. Devuelve tuplas
+    (nombre, version, grupo, imagen_url, nuevo_id, imagen_con_numero|None).
+
+    Con DROP_COMPUESTO la imagen queda como Image sin codificar: se codifica
+    una sola vez, ya compuesta (o por carta si hay que caer al envío clásico)."""
+    def renderizar_carta(args):
+        imagen_url, nuevo_id = args
+        if DROP_COMPUESTO:
+            return renderizar_numero_en_imagen(imagen_url, nuevo_id)
+        return agregar_numero_a_imagen(imagen_url, nuevo_id)
+
+    seriales = [reservar_serial(c['nombre'], c['version'], c.get('grupo', '')) for c in cartas_drop]
+    imagenes = ejecutar_tareas_imagen(renderizar_carta, [(c.get('imagen'), n) for c, n in zip(cartas_drop, seriales)])
+    resultados = []
+    for carta, nuevo_id, imagen_con_numero in zip(cartas_drop, seriales, imagenes):
+        if imagen_con_numero is None:
+            logger.warning(f"[drop] Imagen no disponible para {carta['nombre']}")
+        resultados.append((carta['nombre'], carta['version'], carta.get('grupo', ''), carta.get('imagen'), nuevo_id, imagen_con_numero))
+    return resultados
+
+def devolver_seriales_drop(resultados):
+    """Guarda como sobrantes los seriales de un drop que no se llegó a enviar."""
+    for nombre, version, grupo, _, serial, _ in resultados:
+        try:
+            col_seriales_sobrantes.insert_one({
+                "nombre": nombre, "version": version, "grupo": grupo,
+                "desde": serial, "hasta": serial, "fecha": datetime.utcnow()
+            })
+        except Exception as e:
+            logger.warning(f"[seriales] No se pudo devolver #{serial} de {nombre}: {e}")
+
+def chats_con_drops_precalculados():
+    return list(grupos_permitidos())
+
+def tomar_drop_precalculado(chat_id):
+    with _drops_precalculados_mutex:
+        buffer = _drops_precalculados.get(chat_id)
+        drop   = buffer.pop(0) if buffer else None
+    DROPS_PRECALCULADOS_STATS["usados" if drop else "sin_buffer"] += 1
+    _evento_reponer_drops.set()
+    return drop
+
+def _productor_drops():
+    while True:
+        _evento_reponer_drops.clear()
+        for chat_id in chats_con_drops_precalculados():
+            while True:
+                with _drops_precalculados_mutex:
+                    faltan = DROPS_PRECALCULADOS_POR_CHAT - len(_drops_precalculados.get(chat_id, []))
+                if faltan <= 0:
+                    break
+                try:
+                    resultados = preparar_drop(sortear_cartas_drop(2))
+                except Exception as e:
+                    print("[drops_precalculados] Error:", e)
+                    break
+                if any(r[5] is None for r in resultados):
+                    # No guardar drops incompletos; se reintenta en la próxima vuelta
+                    devolver_seriales_drop(resultados)
+                    DROPS_PRECALCULADOS_STATS["descartados"] += 1
+                    break
+                with _drops_precalculados_mutex:
+                    _drops_precalculados.setdefault(chat_id, []).append(resultados)
+                DROPS_PRECALCULADOS_STATS["generados"] += 1
+        _evento_reponer_drops.wait(30)
+
+def iniciar_productor_drops():
+    if DROPS_PRECALCULADOS_POR_CHAT > 0:
+        threading.Thread(target=_productor_drops, daemon=True, name="productor_drops").start()
+
+def liberar_drops_precalculados():
+    with _drops_precalculados_mutex:
+        pendientes = [r for buffer in _drops_precalculados.values() for r in buffer]
+        _drops_precalculados.clear()
+    for resultados in pendientes:
+        devolver_seriales_drop(resultados)
+
+def estadisticas_drops_precalculados():
+    with _drops_precalculados_mutex:
+        listos = {c: len(b) for c, b in _drops_precalculados.items()}
+    st = DROPS_PRECALCULADOS_STATS
+    return (
+        f"🎴 <b>Drops pre-renderizados</b> ({DROPS_PRECALCULADOS_POR_CHAT} por chat)\n"
+        f"• Listos: <b>{sum(listos.values())}</b> · Usados: <b>{st['usados']}</b> · Sin buffer: <b>{st['sin_buffer']}</b>\n"
+        f"• Generados: <b>{st['generados']}</b> · Descartados: <b>{st['descartados']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["drops_precalculados"] = estadisticas_drops_precalculados
+
+# ─── Drop compuesto (una sola imagen + botones en el mismo mensaje) ──────────
+# Con DROP_COMPUESTO=1 las dos cartas numeradas se unen en una imagen y el drop
+# sale en un único send_photo con caption y teclado (1 llamada en vez de 3).
+DROP_COMPUESTO = os.getenv("DROP_COMPUESTO", "0").lower() in ("1", "true", "si", "sí")
+SEPARACION_DROP_COMPUESTO = 16
+
+def imagen_drop_para_envio(imagen):
+    """BytesIO listo para enviar a partir de lo que dejó preparar_drop."""
+    if isinstance(imagen, Image.Image):
+        return codificar_imagen(imagen)
+    imagen.seek(0)
+    return imagen
+
+def componer_imagen_drop(imagenes):
+    """Une las cartas en una imagen codificada; None si falta alguna."""
+    if not imagenes or any(img is None for img in imagenes):
+        return None
+    cartas_img = [
+        img if isinstance(img, Image.Image) else Image.open(BytesIO(img.getvalue())).convert("RGBA")
+        for img in imagenes
+    ]
+    alto   = max(img.height for img in cartas_img)
+    ancho  = sum(img.width for img in cartas_img) + SEPARACION_DROP_COMPUESTO * (len(cartas_img) - 1)
+    canvas = Image.new("RGBA", (ancho, alto), (0, 0, 0, 0))
+    x = 0
+    for img in cartas_img:
+        canvas.paste(img, (x, (alto - img.height) // 2), img)
+        x += img.width + SEPARACION_DROP_COMPUESTO
+    return codificar_imagen(canvas)
+
 # ─── /idolday ─────────────────────────────────────────────────────────────────
 @log_command
 @grupo_oficial
@@ -1032,59 +2821,37 @@ def comando_idolday(update, context):
     chat_id  = update.effective_chat.id
     thread_id= getattr(update.message, "message_thread_id", None)
     ahora    = datetime.utcnow()
-    ahora_ts = time.time()
-    user_doc = col_usuarios.find_one({"user_id": user_id}) or {}
-    last     = user_doc.get('last_idolday')
-
-    # Cooldown global de grupo
-    ultimo_drop = COOLDOWN_GRUPO.get(chat_id, 0)
-    if ahora_ts - ultimo_drop < COOLDOWN_GRUPO_SEG:
-        faltante = int(COOLDOWN_GRUPO_SEG - (ahora_ts - ultimo_drop))
-        try:
-            update.message.delete()
-        except Exception:
-            pass
+
+    # Límite de drops por grupo (la ficha se devuelve si el usuario no puede dropear)
+    ok, espera, _ = tomar_ficha("idolday", grupo=chat_id)
+    if not ok:
+        faltante = max(1, math.ceil(espera))
+        borrar_mensaje_en(0, chat_id, update.message.message_id)
         try:
             msg_cd = context.bot.send_message(
                 chat_id=chat_id,
                 text=f"⏳ Espera {faltante} segundos antes de volver a dropear.",
                 message_thread_id=thread_id
             )
-            def _borrar(m):
-                try:
-                    context.bot.delete_message(chat_id, m.message_id)
-                except Exception:
-                    pass
-            threading.Timer(10, _borrar, args=(msg_cd,)).start()
+            borrar_mensaje_en(10, chat_id, msg_cd.message_id)
         except Exception:
             pass
         return
 
-    cooldown_listo, bono_listo = puede_usar_idolday(user_id)
+    # Cooldown o bono, last_idolday y username en una sola escritura condicional
+    user_doc, last = consumir_cooldown_o_bono(
+        user_id, ahora, renovar_cooldown=True,
+        campos={"username": (update.effective_user.username.lower() if update.effective_user.username else "")},
+        proyeccion={"notify_idolday": 1}
+    )
 
-    if cooldown_listo:
-        col_usuarios.update_one({"user_id": user_id}, {"$set": {"last_idolday": ahora}}, upsert=True)
-        actualiza_mision_diaria(user_id, context)
-        user_doc2 = col_usuarios.find_one({"user_id": user_id}) or {}
-        last_ts   = user_doc2.get("last_idolday")
-        if last_ts and user_doc2.get("notify_idolday"):
-            restante = max(0, 6 * 3600 - (ahora_ts - (last_ts.timestamp() if hasattr(last_ts, "timestamp") else 0)))
-            if restante > 0:
-                agendar_notificacion_idolday(user_id, restante, context)
-
-    elif bono_listo:
-        objetos          = user_doc.get('objetos', {})
-        bonos_inventario = objetos.get('bono_idolday', 0)
-        if bonos_inventario and bonos_inventario > 0:
-            col_usuarios.update_one({"user_id": user_id}, {"$inc": {"objetos.bono_idolday": -1}}, upsert=True)
-        else:
-            col_usuarios.update_one({"user_id": user_id}, {"$inc": {"bono": -1}}, upsert=True)
+    if user_doc is not None:
         actualiza_mision_diaria(user_id, context)
+        if user_doc.get("idolday_via") == "cooldown" and user_doc.get("notify_idolday"):
+            agendar_notificacion_idolday(user_id, 6 * 3600)
     else:
-        try:
-            update.message.delete()
-        except Exception:
-            pass
+        devolver_ficha("idolday", grupo=chat_id)
+        borrar_mensaje_en(0, chat_id, update.message.message_id)
         if last:
             faltante = 6*3600 - (ahora - last).total_seconds()
             h = int(faltante // 3600); m = int((faltante % 3600) // 60); s = int(faltante % 60)
@@ -1093,114 +2860,127 @@ def comando_idolday(update, context):
             txt = "Ya usaste /idolday."
         try:
             msg_cd = context.bot.send_message(chat_id=chat_id, text=txt, message_thread_id=thread_id)
-            def _borrar2(m):
-                try:
-                    context.bot.delete_message(chat_id, m.message_id)
-                except Exception:
-                    pass
-            threading.Timer(10, _borrar2, args=(msg_cd,)).start()
+            borrar_mensaje_en(10, chat_id, msg_cd.message_id)
         except Exception:
             pass
         return
 
-    COOLDOWN_GRUPO[chat_id] = ahora_ts
+    # Usar un drop ya renderizado si hay; si no, prepararlo ahora
+    resultados = tomar_drop_precalculado(chat_id)
+    if resultados is None:
+        resultados = preparar_drop(sortear_cartas_drop(2))
 
-    cartas_excelentes = [c for c in cartas if c.get("estado") == "Excelente estado"]
-    if len(cartas_excelentes) < 2:
-        cartas_excelentes = cartas_excelentes * 2
-
-    # Sin repetición: sample por (nombre, version) únicos
-    pool = list({(c['nombre'], c['version']): c for c in cartas_excelentes}.values())
-    cartas_drop = random.sample(pool, min(2, len(pool)))
-    if len(cartas_drop) < 2:
-        cartas_drop = random.choices(cartas_excelentes, k=2)
-
-    media_group = []
     cartas_info = []
 
-    # Preparar imágenes en paralelo (no bloquea el thread principal)
-    def preparar_carta(carta):
-        nombre     = carta['nombre']
-        version    = carta['version']
-        grupo      = carta.get('grupo', '')
-        imagen_url = carta.get('imagen')
-        doc_cont = col_contadores.find_one_and_update(
-            {"nombre": nombre, "version": version, "grupo": grupo},
-            {"$inc": {"contador": 1}},
-            upsert=True,
-            return_document=True
-        )
-        nuevo_id = doc_cont['contador'] if doc_cont else 1
-        try:
-            imagen_con_numero = agregar_numero_a_imagen(imagen_url, nuevo_id)
-        except Exception as e:
-            logger.warning(f"[drop] Imagen no disponible para {nombre}: {e}")
-            imagen_con_numero = None
-        return nombre, version, grupo, imagen_url, nuevo_id, imagen_con_numero
-
-    with ThreadPoolExecutor(max_workers=2) as ex:
-        resultados = list(ex.map(preparar_carta, cartas_drop))
-
     # Restaurar cooldown si ninguna imagen se pudo cargar
     if all(r[5] is None for r in resultados):
-        col_usuarios.update_one({"user_id": user_id}, {"$unset": {"last_idolday": ""}})
-        update.message.reply_text("⚠️ No se pudo cargar las imágenes del drop. Tu cooldown no fue consumido, intenta de nuevo.")
+        devolver_seriales_drop(resultados)
+        devolver_idolday(user_id, user_doc)
+        if user_doc.get("idolday_via") == "cooldown":
+            cancelar_notificacion_idolday(user_id)
+        update.message.reply_text("⚠️ No se pudo cargar las imágenes del drop. Tu cooldown o bono no fue consumido, intenta de nuevo.")
         return
 
     for nombre, version, grupo, imagen_url, nuevo_id, imagen_con_numero in resultados:
-        caption = f"<b>{nombre}</b>\n{grupo} [{version}]"
-        if imagen_con_numero:
-            media_group.append(InputMediaPhoto(media=imagen_con_numero, caption=caption, parse_mode="HTML"))
-        else:
-            media_group.append(InputMediaPhoto(media=imagen_url, caption=f"{caption}\n<i>(#número no disponible)</i>", parse_mode="HTML"))
         cartas_info.append({
             "nombre": nombre, "version": version, "grupo": grupo,
             "imagen": imagen_url, "reclamada": False, "usuario": None,
             "hora_reclamada": None, "card_id": nuevo_id
         })
 
-    context.bot.send_media_group(chat_id=chat_id, media=media_group, message_thread_id=thread_id)
-
-    # Enviar texto primero sin botones para obtener message_id real, luego editar
-    texto_drop  = f"@{update.effective_user.username or update.effective_user.first_name} está dropeando 2 cartas!\n<i>El dueño tiene 15s de prioridad.</i>"
-    msg_botones = context.bot.send_message(
-        chat_id=chat_id,
-        text=texto_drop,
-        parse_mode="HTML",
-        message_thread_id=thread_id
-    )
-    botones_reclamar = [
-        InlineKeyboardButton("1️⃣", callback_data=f"reclamar_{chat_id}_{msg_botones.message_id}_0"),
-        InlineKeyboardButton("2️⃣", callback_data=f"reclamar_{chat_id}_{msg_botones.message_id}_1"),
-    ]
-    try:
-        context.bot.edit_message_reply_markup(
-            chat_id=chat_id, message_id=msg_botones.message_id,
-            reply_markup=InlineKeyboardMarkup([botones_reclamar])
-        )
-    except Exception as e:
-        logger.warning(f"[drop] Error al agregar botones: {e}")
-
-    drop_id   = crear_drop_id(chat_id, msg_botones.message_id)
-    drop_data = {
+    texto_drop = f"@{update.effective_user.username or update.effective_user.first_name} está dropeando 2 cartas!\n<i>El dueño tiene 15s de prioridad.</i>"
+    drop_data  = {
         "cartas": cartas_info, "dueño": user_id,
-        "chat_id": chat_id, "mensaje_id": msg_botones.message_id,
-        "inicio": time.time(), "msg_botones": msg_botones,
+        "chat_id": chat_id, "mensaje_id": None,
+        "inicio": time.time(), "expira": None,
         "usuarios_reclamaron": [], "expirado": False,
         "primer_reclamo_dueño": None,
         "thread_id": thread_id,
     }
-    DROPS_ACTIVOS[drop_id] = drop_data
 
-    col_usuarios.update_one(
-        {"user_id": user_id},
-        {"$set": {
-            "last_idolday": ahora,
-            "username": (update.effective_user.username.lower() if update.effective_user.username else "")
-        }},
-        upsert=True
-    )
-    threading.Thread(target=desbloquear_drop, args=(drop_id,), daemon=True).start()
+    compuesta = None
+    if DROP_COMPUESTO and all(r[5] for r in resultados):
+        compuesta = ejecutar_tareas_imagen(componer_imagen_drop, [[r[5] for r in resultados]])[0]
+
+    if compuesta:
+        # Un solo send_photo con caption y botones; el callback usa una clave
+        # propia del drop, así que el drop se registra antes de enviarlo.
+        clave_drop = uuid.uuid4().hex[:10]
+        drop_id    = crear_drop_id(chat_id, clave_drop)
+        drop_guardar(drop_id, drop_data)
+        lineas = "\n".join(
+            f"{i+1}️⃣ <b>{nombre}</b> — {grupo} [{version}]"
+            for i, (nombre, version, grupo, _, _, _) in enumerate(resultados)
+        )
+        botones_reclamar = [
+            InlineKeyboardButton(f"{i+1}️⃣", callback_data=f"reclamar_{chat_id}_{clave_drop}_{i}")
+            for i in range(len(resultados))
+        ]
+        try:
+            msg_botones = context.bot.send_photo(
+                chat_id=chat_id, photo=compuesta,
+                caption=f"{lineas}\n\n{texto_drop}", parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup([botones_reclamar]),
+                message_thread_id=thread_id
+            )
+        except Exception:
+            drop_borrar(drop_id)
+            raise
+        drop_actualizar(drop_id, {"mensaje_id": msg_botones.message_id, "expira": time.time() + DURACION_DROP_SEG})
+    else:
+        def armar_grupo(usar_file_ids):
+            grupo_media = []
+            for nombre, version, grupo, imagen_url, nuevo_id, imagen_con_numero in resultados:
+                caption = f"<b>{nombre}</b>\n{grupo} [{version}]"
+                if imagen_con_numero:
+                    grupo_media.append(InputMediaPhoto(media=imagen_drop_para_envio(imagen_con_numero), caption=caption, parse_mode="HTML"))
+                else:
+                    foto = foto_para_enviar(imagen_url) if usar_file_ids else imagen_url
+                    grupo_media.append(InputMediaPhoto(media=foto, caption=f"{caption}\n<i>(#número no disponible)</i>", parse_mode="HTML"))
+            return grupo_media
+
+        media_group = armar_grupo(True)
+        try:
+            mensajes_media = context.bot.send_media_group(chat_id=chat_id, media=media_group, message_thread_id=thread_id)
+        except BadRequest as e:
+            # Un file_id rechazado tumba todo el grupo: olvidarlos y reenviar con las URLs
+            sin_numero = [r[3] for r in resultados if not r[5]]
+            if not any(file_id_de(url) for url in sin_numero):
+                raise
+            print(f"[file_ids] Grupo de drop rechazado, reenviando con URLs: {e}")
+            for url in sin_numero:
+                olvidar_file_id(url)
+            media_group    = armar_grupo(False)
+            mensajes_media = context.bot.send_media_group(chat_id=chat_id, media=media_group, message_thread_id=thread_id)
+        for (_, _, _, imagen_url, _, imagen_con_numero), m in zip(resultados, mensajes_media or []):
+            if imagen_con_numero is None:
+                registrar_file_id_de_mensaje(imagen_url, m)
+
+        # Enviar texto primero sin botones para obtener message_id real, luego editar
+        msg_botones = context.bot.send_message(
+            chat_id=chat_id,
+            text=texto_drop,
+            parse_mode="HTML",
+            message_thread_id=thread_id
+        )
+        botones_reclamar = [
+            InlineKeyboardButton("1️⃣", callback_data=f"reclamar_{chat_id}_{msg_botones.message_id}_0"),
+            InlineKeyboardButton("2️⃣", callback_data=f"reclamar_{chat_id}_{msg_botones.message_id}_1"),
+        ]
+        try:
+            context.bot.edit_message_reply_markup(
+                chat_id=chat_id, message_id=msg_botones.message_id,
+                reply_markup=InlineKeyboardMarkup([botones_reclamar])
+            )
+        except Exception as e:
+            logger.warning(f"[drop] Error al agregar botones: {e}")
+
+        drop_id = crear_drop_id(chat_id, msg_botones.message_id)
+        drop_data["mensaje_id"] = msg_botones.message_id
+        drop_data["expira"]     = time.time() + DURACION_DROP_SEG
+        drop_guardar(drop_id, drop_data)
+
+    programar(DURACION_DROP_SEG, desbloquear_drop, drop_id)
 
 FRASES_ESTADO = {
     "Excelente estado": "Genial!",
@@ -1347,11 +3127,13 @@ def comando_topicid(update, context):
 # ─── /kkp y notificaciones ────────────────────────────────────────────────────
 @log_command
 @en_tema_asignado_o_privado("kkp")
+@usa_usuario("lang", "misiones", "notify_idolday", "last_idolday")
 def comando_kkp(update, context):
     user_id = update.message.from_user.id
-    texto, reply_markup, _ = get_kkp_menu(user_id, update)
+    texto, reply_markup, _ = get_kkp_menu(user_id, update, context)
     update.message.reply_text(texto, parse_mode="HTML", reply_markup=reply_markup)
 
+@usa_usuario("lang", "misiones", "notify_idolday", "last_idolday")
 def callback_kkp_notify(update, context):
     query   = update.callback_query
     user_id = query.from_user.id
@@ -1365,50 +3147,33 @@ def callback_kkp_notify(update, context):
 
     toggled = None
     if action == "kkp_notify_on":
-        col_usuarios.update_one({"user_id": user_id}, {"$set": {"notify_idolday": True}})
+        actualizar_usuario(context, user_id, {"$set": {"notify_idolday": True}})
         toggled = True
     elif action == "kkp_notify_off":
-        col_usuarios.update_one({"user_id": user_id}, {"$set": {"notify_idolday": False}})
+        actualizar_usuario(context, user_id, {"$set": {"notify_idolday": False}})
         toggled = False
 
-    textos = t(user_id, update)
+    textos = t(user_id, update, context)
     msg = (
         textos["kkp_notify_toggled_on"]  if toggled is True  else
         textos["kkp_notify_toggled_off"] if toggled is False else "❓"
     )
     query.answer(msg, show_alert=True)
-    texto, reply_markup, restante = get_kkp_menu(user_id, update)
+    texto, reply_markup, restante = get_kkp_menu(user_id, update, context)
     try:
         query.edit_message_text(text=texto, parse_mode="HTML", reply_markup=reply_markup)
     except Exception:
         pass
     if toggled is True and restante > 0:
-        agendar_notificacion_idolday(user_id, restante, context)
-
-def agendar_notificacion_idolday(user_id, segundos, context):
-    def tarea():
-        try:
-            time.sleep(max(0, min(segundos, 7*3600)))
-            user_doc = col_usuarios.find_one({"user_id": user_id}) or {}
-            if not user_doc.get("notify_idolday"):
-                return
-            last = user_doc.get("last_idolday")
-            now  = time.time()
-            last_ts = last.timestamp() if hasattr(last, "timestamp") else 0
-            if now - last_ts < 6 * 3600 - 5:
-                return
-            lang   = (user_doc.get("lang") or "en")[:2]
-            textos = translations.get(lang, translations["en"])
-            context.bot.send_message(chat_id=user_id, text=textos["kkp_notify_sent"], parse_mode="HTML")
-        except Exception as e:
-            print("[agendar_notificacion_idolday] Error:", e)
-    threading.Thread(target=tarea, daemon=True).start()
+        agendar_notificacion_idolday(user_id, restante)
+    elif toggled is False:
+        cancelar_notificacion_idolday(user_id)
 
-def get_kkp_menu(user_id, update):
-    user_doc = col_usuarios.find_one({"user_id": user_id}) or {}
+def get_kkp_menu(user_id, update, context=None):
+    user_doc = usuario_ctx(context, user_id, "misiones", "notify_idolday", "last_idolday")
     misiones = user_doc.get("misiones", {})
     notif    = user_doc.get("notify_idolday", False)
-    textos   = t(user_id, update)
+    textos   = t(user_id, update, context)
 
     last_idolday = user_doc.get("last_idolday")
     if last_idolday:
@@ -1631,6 +3396,20 @@ def comando_usar(update, context):
         mostrar_lista_mejorables(update, context, user_id, cartas_mejorables, pagina=1)
         return
 
+# ─── Métricas de reclamos ────────────────────────────────────────────────────
+RECLAMOS_STATS = {"confirmados": 0, "rechazados": 0, "ms_commit": 0.0}
+
+def estadisticas_reclamos():
+    st = RECLAMOS_STATS
+    promedio = st["ms_commit"] / st["confirmados"] if st["confirmados"] else 0.0
+    return (
+        f"🎴 <b>Reclamos</b>\n"
+        f"• Confirmados: <b>{st['confirmados']}</b> · Rechazados por cooldown: <b>{st['rechazados']}</b>\n"
+        f"• Commit promedio: <b>{promedio:.1f} ms</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["reclamos"] = estadisticas_reclamos
+
 # ─── Reclamar carta (con lock para evitar race condition) ─────────────────────
 @grupo_oficial
 def manejador_reclamar(update, context):
@@ -1641,143 +3420,83 @@ def manejador_reclamar(update, context):
     if len(partes) != 4:
         query.answer()
         return
-    _, chat_id, mensaje_id, idx = partes
+    # clave_drop es el message_id (drop clásico) o la clave propia del drop compuesto
+    _, chat_id, clave_drop, idx = partes
     chat_id    = int(chat_id)
-    mensaje_id = int(mensaje_id)
     carta_idx  = int(idx)
-    drop_id    = crear_drop_id(chat_id, mensaje_id)
-
-    drop = DROPS_ACTIVOS.get(drop_id)
-    if not drop:
-        mensaje_fecha = getattr(query.message, "date", None)
-        if mensaje_fecha:
-            secs = (datetime.utcnow() - mensaje_fecha.replace(tzinfo=None)).total_seconds()
-            if secs < 60:
-                query.answer("⏳ El drop aún se está inicializando. Intenta en unos segundos.", show_alert=True)
-                return
-        query.answer("Este drop ya expiró o no existe.", show_alert=True)
-        return
-
-    # ─── LOCK para evitar race condition ─────────────────────────────────────
-    lock = get_drop_lock(drop_id)
-    acquired = lock.acquire(blocking=False)
-    if not acquired:
-        query.answer("⏳ Procesando... intenta en un momento.", show_alert=True)
-        return
-
-    try:
-        # Re-leer el drop DENTRO del lock (estado fresco)
-        drop = DROPS_ACTIVOS.get(drop_id)
-        if not drop or drop.get("expirado"):
+    drop_id    = crear_drop_id(chat_id, clave_drop)
+
+    # ─── Reserva atómica de la carta (reclamada false -> true) ──────────────
+    drop, motivo = drop_reservar_carta(drop_id, carta_idx, usuario_click)
+    if drop is None:
+        if motivo == "no_existe":
+            mensaje_fecha = getattr(query.message, "date", None)
+            if mensaje_fecha:
+                secs = (datetime.utcnow() - mensaje_fecha.replace(tzinfo=None)).total_seconds()
+                if secs < 60:
+                    query.answer("⏳ El drop aún se está inicializando. Intenta en unos segundos.", show_alert=True)
+                    return
+            query.answer("Este drop ya expiró o no existe.", show_alert=True)
+        elif motivo == "expirado":
+            # Por si el temporizador se perdió en un reinicio
+            desbloquear_drop(drop_id)
             query.answer("Este drop ya expiró.", show_alert=True)
-            return
-
-        carta = drop["cartas"][carta_idx]
-        if carta.get("reclamada"):
+        elif motivo == "ocupado":
+            query.answer("⏳ Procesando... intenta en un momento.", show_alert=True)
+        else:
             query.answer("Esta carta ya fue reclamada.", show_alert=True)
-            return
-
-        # ─── Marcar INMEDIATAMENTE dentro del lock ────────────────────────
-        carta["reclamada"]     = True
-        carta["usuario"]       = usuario_click
-        carta["hora_reclamada"]= time.time()
-        # ─────────────────────────────────────────────────────────────────
-
-    finally:
-        lock.release()
+        return
 
-    # A partir de aquí la carta está reservada, el resto puede ir fuera del lock
+    # A partir de aquí la carta está reservada
+    carta      = drop["cartas"][carta_idx]
+    mensaje_id = drop.get("mensaje_id") or query.message.message_id
     ahora    = time.time()
     thread_id= drop.get("thread_id") or getattr(query.message, "message_thread_id", None)
 
-    if "intentos" not in carta:
-        carta["intentos"] = 0
+    carta.setdefault("intentos", 0)
     if usuario_click != drop["dueño"]:
-        carta["intentos"] += 1
-
-    user_doc         = col_usuarios.find_one({"user_id": usuario_click}) or {}
-    objetos          = user_doc.get("objetos", {})
-    bonos_inventario = objetos.get('bono_idolday', 0)
-    bono_legacy      = user_doc.get('bono', 0)
-    last             = user_doc.get('last_idolday')
-    ahora_dt         = datetime.utcnow()
-    cooldown_listo   = False
-    bono_listo       = False
-
-    if last:
-        cooldown_listo = (ahora_dt - last).total_seconds() >= 6 * 3600
-    else:
-        cooldown_listo = True
-
-    if (bonos_inventario and bonos_inventario > 0) or (bono_legacy and bono_legacy > 0):
-        bono_listo = True
+        carta["intentos"] = drop_sumar_intento(drop_id, carta_idx)
 
-    puede_reclamar = False
+    ahora_dt          = datetime.utcnow()
     tiempo_desde_drop = ahora - drop["inicio"]
+    cobrar            = True
 
     if usuario_click == drop["dueño"]:
-        primer_reclamo = drop.get("primer_reclamo_dueño")
-        if primer_reclamo is None:
-            puede_reclamar = True
-            drop["primer_reclamo_dueño"] = ahora
+        primer_reclamo = drop_primer_reclamo_dueño(drop_id, ahora)
+        if primer_reclamo == ahora:
+            cobrar = False
         else:
-            tiempo_faltante = 15 - (ahora - drop["primer_reclamo_dueño"])
+            tiempo_faltante = 15 - (ahora - primer_reclamo)
             if tiempo_faltante > 0:
                 # Revertir reserva
-                carta["reclamada"] = False; carta["usuario"] = None
+                drop_liberar_carta(drop_id, carta_idx, usuario_click)
                 query.answer(f"Te quedan {int(round(tiempo_faltante))} segundos para reclamar la otra.", show_alert=True)
                 return
-            if cooldown_listo:
-                puede_reclamar = True
-                col_usuarios.update_one({"user_id": usuario_click}, {"$set": {"last_idolday": ahora_dt}}, upsert=True)
-            elif bono_listo:
-                puede_reclamar = True
-                if bonos_inventario and bonos_inventario > 0:
-                    col_usuarios.update_one({"user_id": usuario_click}, {"$inc": {"objetos.bono_idolday": -1}}, upsert=True)
-                else:
-                    col_usuarios.update_one({"user_id": usuario_click}, {"$inc": {"bono": -1}}, upsert=True)
-            else:
-                carta["reclamada"] = False; carta["usuario"] = None
-                if last:
-                    f = 6*3600 - (ahora_dt - last).total_seconds()
-                    query.answer(f"No puedes reclamar: espera {int(f//3600)}h {int((f%3600)//60)}m {int(f%60)}s.", show_alert=True)
-                else:
-                    query.answer("No puedes reclamar. Espera el cooldown.", show_alert=True)
-                return
-    else:
-        if tiempo_desde_drop < 15:
-            carta["reclamada"] = False; carta["usuario"] = None
-            query.answer(f"Aún no puedes reclamar. Te quedan {int(round(15 - tiempo_desde_drop))} segundos.", show_alert=True)
-            return
-        if cooldown_listo:
-            puede_reclamar = True
-            col_usuarios.update_one({"user_id": usuario_click}, {"$set": {"last_idolday": ahora_dt}}, upsert=True)
-        elif bono_listo:
-            puede_reclamar = True
-            if bonos_inventario and bonos_inventario > 0:
-                col_usuarios.update_one({"user_id": usuario_click}, {"$inc": {"objetos.bono_idolday": -1}}, upsert=True)
-            else:
-                col_usuarios.update_one({"user_id": usuario_click}, {"$inc": {"bono": -1}}, upsert=True)
-        else:
-            carta["reclamada"] = False; carta["usuario"] = None
+    elif tiempo_desde_drop < 15:
+        drop_liberar_carta(drop_id, carta_idx, usuario_click)
+        query.answer(f"Aún no puedes reclamar. Te quedan {int(round(15 - tiempo_desde_drop))} segundos.", show_alert=True)
+        return
+
+    t0_commit = time.time()
+    if cobrar:
+        doc_reclamo, last = consumir_cooldown_o_bono(usuario_click, ahora_dt)
+        if doc_reclamo is None:
+            drop_liberar_carta(drop_id, carta_idx, usuario_click)
             if last:
                 f = 6*3600 - (ahora_dt - last).total_seconds()
                 query.answer(f"No puedes reclamar: espera {int(f//3600)}h {int((f%3600)//60)}m {int(f%60)}s.", show_alert=True)
             else:
                 query.answer("No puedes reclamar. Espera el cooldown.", show_alert=True)
+            RECLAMOS_STATS["rechazados"] += 1
             return
 
-    if not puede_reclamar:
-        carta["reclamada"] = False; carta["usuario"] = None
-        return
-
     # ─── Actualizar botones ───────────────────────────────────────────────────
     teclado = []
     for i, c in enumerate(drop["cartas"]):
         if c.get("reclamada"):
             teclado.append(InlineKeyboardButton("❌", callback_data="reclamada"))
         else:
-            teclado.append(InlineKeyboardButton(f"{i+1}️⃣", callback_data=f"reclamar_{chat_id}_{mensaje_id}_{i}"))
+            teclado.append(InlineKeyboardButton(f"{i+1}️⃣", callback_data=f"reclamar_{chat_id}_{clave_drop}_{i}"))
     try:
         context.bot.edit_message_reply_markup(
             chat_id=chat_id, message_id=mensaje_id,
@@ -1807,41 +3526,33 @@ def manejador_reclamar(update, context):
     intentos = carta.get("intentos", 0)
     precio   = precio_carta_karuta(nombre, version, estado, id_unico=id_unico, card_id=nuevo_id) + 200 * max(0, intentos - 1)
 
-    existente = col_cartas_usuario.find_one({
-        "user_id": usuario_click, "nombre": nombre,
-        "version": version, "card_id": nuevo_id, "estado": estado,
-    })
-    if existente:
-        col_cartas_usuario.update_one(
-            {"user_id": usuario_click, "nombre": nombre, "version": version, "card_id": nuevo_id, "estado": estado},
-            {"$inc": {"count": 1}}
-        )
-    else:
-        col_cartas_usuario.insert_one({
-            "user_id": usuario_click, "nombre": nombre, "version": version,
-            "grupo": grupo, "estado": estado, "estrellas": estrellas,
-            "imagen": imagen_url, "card_id": nuevo_id, "count": 1,
+    # Una sola escritura: suma una copia si ya existe, o inserta la carta
+    col_cartas_usuario.update_one(
+        {"user_id": usuario_click, "nombre": nombre, "version": version, "card_id": nuevo_id, "estado": estado},
+        {"$inc": {"count": 1}, "$setOnInsert": {
+            "grupo": grupo, "estrellas": estrellas, "imagen": imagen_url,
             "id_unico": id_unico, "estado_estrella": estrellas.count("★"),
-        })
-
-    revisar_sets_completados(usuario_click, context)
-    drop.setdefault("usuarios_reclamaron", []).append(usuario_click)
+        }},
+        upsert=True
+    )
+    sets_tocados = actualizar_resumen_coleccion(usuario_click, entradas=[{"nombre": nombre, "version": version, "grupo": grupo, "estrellas": estrellas}])
 
-    try:
-        col_drops_log.insert_one({
-            "evento": "reclamado", "drop_id": drop_id,
-            "user_id": usuario_click,
-            "username": query.from_user.username if hasattr(query.from_user, "username") else "",
-            "nombre": carta['nombre'], "version": carta['version'],
-            "grupo": carta.get('grupo', ''), "card_id": carta.get("card_id"),
-            "estado": estado, "estrellas": estrellas,
-            "fecha": datetime.utcnow(), "intentos": carta.get("intentos", 0),
-            "chat_id": chat_id, "mensaje_id": mensaje_id,
-        })
-    except Exception:
-        pass
+    if sets_tocados is None or sets_tocados:
+        revisar_sets_completados(usuario_click, context)
+    drop_agregar_reclamante(drop_id, usuario_click)
 
-    DROPS_ACTIVOS[drop_id] = drop
+    registrar_evento_drop({
+        "evento": "reclamado", "drop_id": drop_id,
+        "user_id": usuario_click,
+        "username": query.from_user.username if hasattr(query.from_user, "username") else "",
+        "nombre": carta['nombre'], "version": carta['version'],
+        "grupo": carta.get('grupo', ''), "card_id": carta.get("card_id"),
+        "estado": estado, "estrellas": estrellas,
+        "fecha": datetime.utcnow(), "intentos": carta.get("intentos", 0),
+        "chat_id": chat_id, "mensaje_id": mensaje_id,
+    })
+    RECLAMOS_STATS["confirmados"] += 1
+    RECLAMOS_STATS["ms_commit"]   += (time.time() - t0_commit) * 1000
 
     user_mention  = f"@{query.from_user.username or query.from_user.first_name}"
     frase_estado  = FRASES_ESTADO.get(estado, "")
@@ -1861,16 +3572,8 @@ def manejador_reclamar(update, context):
         message_thread_id=thread_id
     )
 
-    favoritos = []
-    for user in col_usuarios.find({}):
-        for fav in user.get("favoritos", []):
-            if (
-                fav.get("nombre", "").lower() == nombre.lower() and
-                fav.get("version", "").lower() == version.lower() and
-                fav.get("grupo", "").lower() == grupo.lower()
-            ):
-                favoritos.append(user)
-                break
+    fans      = usuarios_con_favorito(grupo, version, nombre)
+    favoritos = list(col_usuarios.find({"user_id": {"$in": list(fans)}}, {"user_id": 1, "username": 1})) if fans else []
 
     if favoritos:
         nombres = [
@@ -1895,38 +3598,17 @@ def gastar_gemas(user_id, cantidad):
     return True
 
 # ─── Album 2 (collage con descarga paralela) ──────────────────────────────────
-def descargar_imagen_url(url, path):
-    try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        with open(path, "wb") as f:
-            f.write(r.content)
-        return True
-    except Exception as e:
-        print(f"[album2] Error descargando {url}: {e}")
-        return False
-
 def crear_cuadricula_cartas_urls(urls, output_path="cuadricula_album2.png"):
+    """Arma el collage y devuelve (ruta, faltantes); ruta es None si no bajó ninguna imagen."""
     from math import ceil
-    imgs = []
-    temp_files = []
 
-    # ─── Descarga paralela de imágenes ───────────────────────────────────────
-    temp_paths = [f"temp_album2_{i}.png" for i in range(len(urls))]
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        resultados = list(executor.map(lambda args: descargar_imagen_url(*args), zip(urls, temp_paths)))
-
-    for i, (ok, path) in enumerate(zip(resultados, temp_paths)):
-        if ok:
-            try:
-                imgs.append(Image.open(path).convert("RGBA"))
-                temp_files.append(path)
-            except Exception:
-                pass
+    # ─── Descarga paralela (pool compartido + caché de imágenes) ─────────────
+    imgs = [img for img in ejecutar_tareas_imagen(obtener_imagen_catalogo, urls) if img is not None]
     # ─────────────────────────────────────────────────────────────────────────
 
+    faltantes = len(urls) - len(imgs)
     if not imgs:
-        raise ValueError("No se pudo descargar ninguna imagen.")
+        return None, faltantes
     ancho, alto  = imgs[0].size
     columnas     = 5
     filas        = ceil(len(imgs) / columnas)
@@ -1934,10 +3616,28 @@ def crear_cuadricula_cartas_urls(urls, output_path="cuadricula_album2.png"):
     for idx, img in enumerate(imgs):
         canvas.paste(img, ((idx % columnas) * ancho, (idx // columnas) * alto), img)
     canvas.save(output_path)
-    for path in temp_files:
-        try: os.remove(path)
-        except Exception: pass
-    return output_path
+    return output_path, faltantes
+
+# Collages ya subidos: la clave es un hash de las URLs de la página en orden y
+# el file_id se guarda en la caché de file_ids (variante "album2"), así que
+# volver a una página vista es un solo edit_media sin descargar ni renderizar.
+VARIANTE_COLLAGE = "album2"
+COLLAGES_STATS   = {"reutilizados": 0, "renderizados": 0, "incompletos": 0}
+
+def clave_collage_album2(urls):
+    return "collage:" + hashlib.sha1("\n".join(urls).encode()).hexdigest()
+
+def estadisticas_collages():
+    st    = COLLAGES_STATS
+    total = st["reutilizados"] + st["renderizados"]
+    ratio = st["reutilizados"] / total * 100 if total else 0
+    return (
+        f"🧩 <b>Collages album2</b>\n"
+        f"• Reutilizados: <b>{st['reutilizados']}</b> · Renderizados: <b>{st['renderizados']}</b> · Reuso: <b>{ratio:.1f}%</b>\n"
+        f"• Incompletos (sin cachear): <b>{st['incompletos']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["collages"] = estadisticas_collages
 
 def mostrar_menu_grupos_album2(user_id, pagina):
     grupos  = sorted({c.get("grupo", "") for c in col_cartas_usuario.find({"user_id": user_id}) if c.get("grupo")})
@@ -1997,16 +3697,40 @@ def mostrar_album2_uno(bot, chat_id, user_id, pagina=1, grupo=None, thread_id=No
     if not urls_imgs:
         bot.send_message(chat_id, "No se encontraron imágenes en esta página.", message_thread_id=thread_id)
         return
-    img_path = crear_cuadricula_cartas_urls(urls_imgs, output_path=f"cuadricula_album2_{user_id}.png")
     caption  = f"🖼️ <b>Selecciona una carta</b> (página {pagina}/{paginas})"
 
-    if editar and mensaje:
-        with open(img_path, "rb") as f:
-            mensaje.edit_media(media=InputMediaPhoto(f, caption=caption, parse_mode="HTML"), reply_markup=teclado)
+    def enviar(foto):
+        if editar and mensaje:
+            return mensaje.edit_media(media=InputMediaPhoto(foto, caption=caption, parse_mode="HTML"), reply_markup=teclado)
+        return bot.send_photo(chat_id=chat_id, photo=foto, caption=caption, parse_mode="HTML",
+                              reply_markup=teclado, message_thread_id=thread_id)
+
+    clave = clave_collage_album2(urls_imgs)
+    fid   = file_id_de(clave, VARIANTE_COLLAGE)
+    if fid:
+        try:
+            enviar(fid)
+            COLLAGES_STATS["reutilizados"] += 1
+            return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            print(f"[album2] file_id de collage rechazado: {e}")
+            olvidar_file_id(clave, VARIANTE_COLLAGE)
+
+    img_path, faltantes = crear_cuadricula_cartas_urls(urls_imgs, output_path=f"cuadricula_album2_{user_id}.png")
+    if img_path is None:
+        bot.send_message(chat_id, "No se pudieron cargar las imágenes de esta página. Intenta de nuevo.",
+                         message_thread_id=thread_id)
+        return
+    with open(img_path, "rb") as f:
+        msg = enviar(f)
+    COLLAGES_STATS["renderizados"] += 1
+    # Un collage con huecos no corresponde a la clave: no se reutiliza
+    if faltantes:
+        COLLAGES_STATS["incompletos"] += 1
     else:
-        with open(img_path, "rb") as f:
-            bot.send_photo(chat_id=chat_id, photo=f, caption=caption, parse_mode="HTML",
-                           reply_markup=teclado, message_thread_id=thread_id)
+        registrar_file_id_de_mensaje(clave, msg, VARIANTE_COLLAGE)
 
 def callback_album2_handler(update, context):
     query     = update.callback_query
@@ -2034,6 +3758,8 @@ def callback_album2_handler(update, context):
     elif data.startswith("album2_"):
         if len(partes) < 3:
             query.answer("Error.", show_alert=True); return
+        if not tomar_ficha("album2_pagina", usuario=user_id)[0]:
+            query.answer("⏳ Más despacio..."); return
         pagina    = int(partes[1])
         grupo_cod = partes[2]
         grupo     = None if grupo_cod == "none" else urllib.parse.unquote(grupo_cod)
@@ -2126,12 +3852,54 @@ def mostrar_lista_mejorables(update, context, user_id, cartas_mejorables, pagina
     else:
         update.message.reply_text(texto, parse_mode='HTML', reply_markup=teclado)
 
+# ─── Paginado del álbum en Mongo (keyset) ────────────────────────────────────
+# Orden y filtros se resuelven en Mongo con los índices compuestos de
+# cartas_usuario (collation sin distinguir mayúsculas, igual que el .lower()
+# de antes). En vez de skip, cada página pide "las N siguientes a la carta X":
+# el cursor es el id_unico de la última (o primera) carta de la página vista,
+# así cada pasada lee solo las cartas que se muestran.
+COLACION_ALBUM = {"locale": "es", "strength": 2}
+ORDENES_ALBUM = {
+    None:    [("grupo", 1), ("nombre", 1), ("card_id", 1), ("id_unico", 1)],
+    "menor": [("card_id", 1), ("id_unico", 1)],
+    "mayor": [("card_id", -1), ("id_unico", -1)],
+}
+
+def _condicion_keyset(orden, ref, despues=True):
+    condiciones, prefijo = [], {}
+    for campo, sentido in orden:
+        op = "$gt" if (sentido == 1) == despues else "$lt"
+        condiciones.append(dict(prefijo, **{campo: {op: ref.get(campo)}}))
+        prefijo[campo] = ref.get(campo)
+    return {"$or": condiciones}
+
+def pagina_cartas_usuario(filtro, orden, limite, cursor=None, despues=True, salto=0):
+    """Cartas de cartas_usuario que cumplen `filtro`, ordenadas por `orden`.
+
+    Con `cursor` (id_unico) devuelve las `limite` posteriores (o anteriores si
+    despues=False) a esa carta; sin cursor salta `salto` cartas. Devuelve None
+    si el cursor ya no sirve (la carta cambió de dueño o le falta un campo del
+    orden, y $gt/$lt contra null saltaría cartas): el llamador pagina con salto."""
+    consulta, sentido = filtro, orden
+    if cursor:
+        ref = col_cartas_usuario.find_one(
+            {"user_id": filtro["user_id"], "id_unico": cursor}, {campo: 1 for campo, _ in orden}
+        )
+        if not ref or any(ref.get(campo) is None for campo, _ in orden):
+            return None
+        consulta, salto = {"$and": [filtro, _condicion_keyset(orden, ref, despues)]}, 0
+        if not despues:
+            sentido = [(campo, -s) for campo, s in orden]
+    cartas = list(
+        col_cartas_usuario.find(consulta, collation=COLACION_ALBUM).sort(sentido).skip(salto).limit(limite)
+    )
+    return cartas if sentido is orden else cartas[::-1]
+
 def inline_album_handler(update, context):
     query      = update.inline_query
     user_id    = query.from_user.id
     first_name = query.from_user.first_name or "Usuario"
     PER_PAGE   = 50
-    offset     = int(query.offset) if query.offset else 0
     texto      = query.query.strip()
     partes     = texto.split(maxsplit=1)
     filtro     = partes[1].strip() if len(partes) > 1 else None
@@ -2141,9 +3909,20 @@ def inline_album_handler(update, context):
             {"nombre": {"$regex": filtro, "$options": "i"}},
             {"grupo":  {"$regex": filtro, "$options": "i"}},
         ]
-    total_cartas = col_cartas_usuario.count_documents(mongo_query)
-    cartas_list  = list(col_cartas_usuario.find(mongo_query).sort([("grupo", 1), ("nombre", 1)]).skip(offset).limit(PER_PAGE))
+    # El offset es "posición|id_unico de la última carta enviada"; la posición
+    # solo se usa si esa carta ya no sirve de cursor. Se pide una de más para
+    # saber si hay otra página sin contar todo.
+    posicion, _, cursor = (query.offset or "").partition("|")
+    posicion    = int(posicion) if posicion.isdigit() else 0
+    cartas_list = None
+    if cursor:
+        cartas_list = pagina_cartas_usuario(mongo_query, ORDENES_ALBUM[None], PER_PAGE + 1, cursor=cursor)
+    if cartas_list is None:
+        cartas_list = pagina_cartas_usuario(mongo_query, ORDENES_ALBUM[None], PER_PAGE + 1, salto=posicion)
+    hay_mas     = len(cartas_list) > PER_PAGE
+    cartas_list = cartas_list[:PER_PAGE]
     results = []
+    fids    = file_ids_de([c.get('imagen') for c in cartas_list])
     for carta in cartas_list:
         nombre    = carta['nombre']
         estrellas = carta.get('estrellas', '')
@@ -2159,11 +3938,18 @@ def inline_album_handler(update, context):
             f"• Estado: <b>{estrellas}</b>\n• Precio: <code>{precio} Kponey</code>\n"
             f"• Copias globales: <b>{copias}</b>\n<i>Carta de {first_name}</i>"
         )
-        results.append(InlineQueryResultPhoto(
-            id=carta['id_unico'], photo_url=carta['imagen'], thumb_url=carta['imagen'],
-            title=f"{nombre} {estrellas}", caption=caption, parse_mode="HTML",
-        ))
-    next_offset = str(offset + PER_PAGE) if (offset + PER_PAGE) < total_cartas else ""
+        fid = fids.get(carta['imagen'])
+        if fid:
+            results.append(InlineQueryResultCachedPhoto(
+                id=carta['id_unico'], photo_file_id=fid,
+                title=f"{nombre} {estrellas}", caption=caption, parse_mode="HTML",
+            ))
+        else:
+            results.append(InlineQueryResultPhoto(
+                id=carta['id_unico'], photo_url=carta['imagen'], thumb_url=carta['imagen'],
+                title=f"{nombre} {estrellas}", caption=caption, parse_mode="HTML",
+            ))
+    next_offset = f"{posicion + PER_PAGE}|{cartas_list[-1]['id_unico']}" if hay_mas else ""
     try:
         update.inline_query.answer(results, cache_time=0, is_personal=True, next_offset=next_offset,
                                    switch_pm_text=f"Álbum de {first_name}", switch_pm_parameter="start")
@@ -2173,22 +3959,24 @@ def inline_album_handler(update, context):
 dispatcher.add_handler(InlineQueryHandler(inline_album_handler, pattern=r"^(Album|album)( |$)"))
 
 def mostrar_album_pagina(update, context, chat_id, message_id, user_id, pagina=1,
-                         filtro=None, valor_filtro=None, orden=None, solo_botones=False, thread_id=None):
+                         filtro=None, valor_filtro=None, orden=None, solo_botones=False, thread_id=None,
+                         cursor=None):
     query_album = {"user_id": user_id}
     if filtro == "estrellas": query_album["estrellas"] = valor_filtro
     elif filtro == "grupo":   query_album["grupo"]     = valor_filtro
 
-    cartas_list = list(col_cartas_usuario.find(query_album))
-    if orden == "menor":    cartas_list.sort(key=lambda x: x.get("card_id", 0))
-    elif orden == "mayor":  cartas_list.sort(key=lambda x: -x.get("card_id", 0))
-    else:
-        cartas_list.sort(key=lambda x: (x.get("grupo", "").lower(), x.get("nombre", "").lower(), x.get("card_id", 0)))
-
     por_pagina  = 10
-    total_pag   = max(1, ((len(cartas_list) - 1) // por_pagina) + 1)
+    total       = col_cartas_usuario.count_documents(query_album, collation=COLACION_ALBUM)
+    total_pag   = max(1, ((total - 1) // por_pagina) + 1)
     pagina      = max(1, min(pagina, total_pag))
-    inicio      = (pagina - 1) * por_pagina
-    cartas_pag  = cartas_list[inicio:inicio + por_pagina]
+    orden_album = ORDENES_ALBUM.get(orden, ORDENES_ALBUM[None])
+    # cursor: "s<id_unico>" = siguientes a esa carta, "a<id_unico>" = anteriores
+    cartas_pag = []
+    if cursor:
+        cartas_pag = pagina_cartas_usuario(query_album, orden_album, por_pagina,
+                                           cursor=cursor[1:], despues=cursor[0] == "s")
+    if not cartas_pag:
+        cartas_pag = pagina_cartas_usuario(query_album, orden_album, por_pagina, salto=(pagina - 1) * por_pagina)
 
     texto = f"📗 <b>Álbum de cartas (página {pagina}/{total_pag})</b>\n\n"
     if cartas_pag:
@@ -2204,8 +3992,17 @@ def mostrar_album_pagina(update, context, chat_id, message_id, user_id, pagina=1
     if not solo_botones:
         botones.append([telegram.InlineKeyboardButton("🔎 Filtrar / Ordenar", callback_data=f"album_filtros_{user_id}_{pagina}")])
     paginacion = []
-    if pagina > 1:       paginacion.append(telegram.InlineKeyboardButton("⬅️", callback_data=f"album_pagina_{user_id}_{pagina-1}_{filtro or 'none'}_{valor_filtro or 'none'}_{orden or 'none'}"))
-    if pagina < total_pag:paginacion.append(telegram.InlineKeyboardButton("➡️", callback_data=f"album_pagina_{user_id}_{pagina+1}_{filtro or 'none'}_{valor_filtro or 'none'}_{orden or 'none'}"))
+    sufijo     = f"{filtro or 'none'}_{valor_filtro or 'none'}_{orden or 'none'}"
+    def _boton_pagina(texto, pag, cursor):
+        data = f"album_pagina_{user_id}_{pag}_{sufijo}"
+        # Si el cursor no entra en los 64 bytes de callback_data se pagina con skip
+        if len(f"{data}_{cursor}".encode()) <= 64:
+            data = f"{data}_{cursor}"
+        return telegram.InlineKeyboardButton(texto, callback_data=data)
+    if pagina > 1 and cartas_pag:
+        paginacion.append(_boton_pagina("⬅️", pagina - 1, f"a{cartas_pag[0]['id_unico']}"))
+    if pagina < total_pag and cartas_pag:
+        paginacion.append(_boton_pagina("➡️", pagina + 1, f"s{cartas_pag[-1]['id_unico']}"))
     if paginacion and not solo_botones: botones.append(paginacion)
     teclado = telegram.InlineKeyboardMarkup(botones) if botones else None
 
@@ -2337,13 +4134,17 @@ def manejador_callback_album(update, context):
         safe_answer(); return
 
     if data.startswith("album_pagina_"):
+        if not tomar_ficha("album_pagina", usuario=user_id)[0]:
+            safe_answer("⏳ Más despacio..."); return
         uid          = int(partes[2]); pag = int(partes[3])
         filtro       = partes[4] if len(partes) > 4 and partes[4] != "none" else None
         valor_filtro = partes[5] if len(partes) > 5 and partes[5] != "none" else None
         orden        = partes[6] if len(partes) > 6 and partes[6] != "none" else None
+        cursor       = partes[7] if len(partes) > 7 else None
         try:
             mostrar_album_pagina(update, context, query.message.chat_id, query.message.message_id,
-                                 uid, int(pag), filtro=filtro, valor_filtro=valor_filtro, orden=orden)
+                                 uid, int(pag), filtro=filtro, valor_filtro=valor_filtro, orden=orden,
+                                 cursor=cursor)
         except Exception as e: handle_telegram_error(e)
         safe_answer(); return
 
@@ -2405,6 +4206,7 @@ def comando_trk(update, context):
     }
     TRADES_POR_USUARIO[user_id]  = trade_id
     TRADES_POR_USUARIO[otro_id]  = trade_id
+    TRADES_EN_CURSO[trade_id]["tarea_timeout"] = programar(TRADE_TIMEOUT_SEG, expirar_trade, trade_id)
 
     context.bot.send_message(
         chat_id=chat_id,
@@ -2422,10 +4224,7 @@ def mensaje_trade_id(update, context):
 
     if texto.lower() in ("cancel", "cancelar"):
         trade_id = TRADES_POR_USUARIO.pop(user_id, None)
-        if trade_id and trade_id in TRADES_EN_CURSO:
-            trade = TRADES_EN_CURSO.pop(trade_id)
-            for uid in trade["usuarios"]:
-                TRADES_POR_USUARIO.pop(uid, None)
+        if trade_id and cerrar_trade(trade_id):
             context.bot.send_message(chat_id=chat_id, text="❌ Intercambio cancelado.", message_thread_id=thread_id)
         else:
             update.message.reply_text("No tienes ningún intercambio activo.")
@@ -2504,14 +4303,15 @@ def callback_trade_confirm(update, context):
                     text="❌ Uno de los usuarios no tiene suficiente Kponey (100 🪙).",
                     message_thread_id=trade["thread_id"]
                 )
-                for uid in trade["usuarios"]: TRADES_POR_USUARIO.pop(uid, None)
-                TRADES_EN_CURSO.pop(trade_id, None)
+                cerrar_trade(trade_id)
                 return
 
             if carta_a and carta_b:
                 carta_a["user_id"] = b; carta_b["user_id"] = a
                 col_cartas_usuario.insert_one(carta_a)
                 col_cartas_usuario.insert_one(carta_b)
+                actualizar_resumen_coleccion(a, entradas=[carta_b], salidas=[carta_a])
+                actualizar_resumen_coleccion(b, entradas=[carta_a], salidas=[carta_b])
                 col_usuarios.update_one({"user_id": a}, {"$inc": {"kponey": -100}})
                 col_usuarios.update_one({"user_id": b}, {"$inc": {"kponey": -100}})
                 revisar_sets_completados(a, context)
@@ -2525,16 +4325,14 @@ def callback_trade_confirm(update, context):
                 txt = "❌ Error: una de las cartas ya no está disponible."
 
             context.bot.send_message(chat_id=trade["chat_id"], text=txt, message_thread_id=trade["thread_id"])
-            for uid in trade["usuarios"]: TRADES_POR_USUARIO.pop(uid, None)
-            TRADES_EN_CURSO.pop(trade_id, None)
+            cerrar_trade(trade_id)
 
     elif data.startswith("tradecancel_"):
         context.bot.send_message(
             chat_id=trade["chat_id"], text="❌ Intercambio cancelado.",
             message_thread_id=trade["thread_id"]
         )
-        for uid in trade["usuarios"]: TRADES_POR_USUARIO.pop(uid, None)
-        TRADES_EN_CURSO.pop(trade_id, None)
+        cerrar_trade(trade_id)
         query.answer("Trade cancelado.", show_alert=True)
 
 dispatcher.add_handler(CallbackQueryHandler(callback_trade_confirm, pattern=r"^trade(conf|cancel)_"))
@@ -2609,17 +4407,18 @@ def comprar_objeto(user_id, obj_id, context, chat_id, reply_func):
     info = CATALOGO_OBJETOS.get(obj_id)
     if not info:
         reply_func("Ese objeto no existe."); return
-    doc    = col_usuarios.find_one({"user_id": user_id}) or {}
+    doc    = usuario_ctx(context, user_id, "kponey")
     kponey = doc.get("kponey", 0)
     precio = info['precio']
     if kponey < precio:
         reply_func("No tienes suficiente Kponey."); return
-    col_usuarios.update_one({"user_id": user_id}, {"$inc": {f"objetos.{obj_id}": 1, "kponey": -precio}}, upsert=True)
+    actualizar_usuario(context, user_id, {"$inc": {f"objetos.{obj_id}": 1, "kponey": -precio}}, upsert=True)
     reply_func(f"¡Compraste {info['emoji']} {info['nombre']} por {precio} Kponey!", parse_mode="HTML")
 
 @log_command
 @solo_en_tema_asignado("comprarobjeto")
 @cooldown_critico
+@usa_usuario("kponey")
 def comando_comprarobjeto(update, context):
     user_id = update.message.from_user.id
     if not context.args:
@@ -2632,7 +4431,7 @@ def comando_comprarobjeto(update, context):
 @cooldown_critico
 def comando_tiendaG(update, context):
     user_id = update.message.from_user.id
-    doc     = col_usuarios.find_one({"user_id": user_id}) or {}
+    doc     = usuario_ctx(context, user_id, "gemas")
     gemas   = doc.get("gemas", 0)
     texto   = "💎 <b>Tienda de objetos (Gemas)</b>\n\n"
     botones = []
@@ -2657,6 +4456,18 @@ def solo_admin(func):
         return func(update, context, *args, **kwargs)
     return wrapper
 
+# ─── /rendimiento (admin) ─────────────────────────────────────────────────────
+@log_command
+@solo_admin
+def comando_rendimiento(update, context):
+    bloques = []
+    for nombre, fn in METRICAS_RENDIMIENTO.items():
+        try:
+            bloques.append(fn())
+        except Exception as e:
+            bloques.append(f"⚠️ {nombre}: {e}\n")
+    update.message.reply_text("📈 <b>Rendimiento del bot</b>\n\n" + "\n".join(bloques), parse_mode="HTML")
+
 # ─── Sorteos ──────────────────────────────────────────────────────────────────
 @log_command
 @solo_admin
@@ -2786,8 +4597,12 @@ def mostrar_mercado_pagina(chat_id, message_id, context, user_id, pagina=1,
     pagina      = max(1, min(pagina, total_pag))
     cartas_pag  = cartas_list[(pagina-1)*por_pagina: pagina*por_pagina]
 
-    usuario    = col_usuarios.find_one({"user_id": user_id}) or {}
+    usuario    = usuario_ctx(context, user_id, "favoritos")
     favoritos  = usuario.get("favoritos", [])
+    ids_vendedores = list({c["vendedor_id"] for c in cartas_pag if c.get("vendedor_id")})
+    vendedores = {
+        u["user_id"]: u for u in col_usuarios.find({"user_id": {"$in": ids_vendedores}}, {"user_id": 1, "username": 1})
+    } if ids_vendedores else {}
 
     texto = "<b>🛒 Mercado</b>\n"
     for c in cartas_pag:
@@ -2800,7 +4615,7 @@ def mostrar_mercado_pagina(chat_id, message_id, context, user_id, pagina=1,
         vendedor_id = c.get("vendedor_id")
         vendedor_linea = ""
         if vendedor_id:
-            vd = col_usuarios.find_one({"user_id": vendedor_id}) or {}
+            vd = vendedores.get(vendedor_id, {})
             if vd.get("username"):
                 vendedor_linea = f'👤 <code>{vd["username"]}</code>\n'
         texto += f"{est} · {num} · {ver} · {nom} · {grp}{fav_icon}\n💲{precio:,}\n{vendedor_linea}<code>/comprar {idu}</code>\n\n"
@@ -2863,6 +4678,97 @@ def normalizar_nombre_carta(nombre):
     nombre = re.sub(r"\s+", " ", nombre).strip()
     return nombre
 
+# ─── Índice invertido de favoritos ───────────────────────────────────────────
+# Cada favorito es un documento {clave, user_id} en col_favoritos, con clave =
+# "grupo [version] nombre" normalizado. En memoria se mantiene clave -> user_ids
+# para que al reclamar una carta baste un lookup en lugar de recorrer usuarios.
+_indice_favoritos = {}
+_indice_favoritos_lock = threading.Lock()
+FAVORITOS_STATS = {"consultas": 0, "con_fans": 0}
+
+def clave_favorito(grupo, version, nombre):
+    return normalizar_nombre_carta(f"{grupo} [{version}] {nombre}")
+
+def _migrar_favoritos_legacy():
+    # Copia los arrays usuarios.favoritos a la colección (upserts idempotentes).
+    # Solo se marca como hecha si no hubo errores; si no, se reintenta al arrancar.
+    ops = errores = 0
+    for user in col_usuarios.find({"favoritos.0": {"$exists": True}}, {"user_id": 1, "favoritos": 1}):
+        for fav in user.get("favoritos", []):
+            try:
+                col_favoritos.update_one(
+                    {"clave": clave_favorito(fav.get("grupo", ""), fav.get("version", ""), fav.get("nombre", "")), "user_id": user["user_id"]},
+                    {"$setOnInsert": {"grupo": fav.get("grupo", ""), "version": fav.get("version", ""), "nombre": fav.get("nombre", "")}},
+                    upsert=True
+                )
+                ops += 1
+            except Exception as e:
+                errores += 1
+                print("[favoritos] Error migrando:", e)
+    if ops:
+        print(f"[favoritos] Migrados {ops} favoritos a la colección.")
+    if errores:
+        print(f"[favoritos] {errores} favoritos sin migrar, se reintentará en el próximo arranque.")
+        return
+    col_migraciones.update_one(
+        {"_id": "favoritos_legacy"}, {"$set": {"fecha": datetime.utcnow(), "migrados": ops}}, upsert=True
+    )
+
+def cargar_indice_favoritos():
+    try:
+        if not col_migraciones.find_one({"_id": "favoritos_legacy"}, {"_id": 1}):
+            _migrar_favoritos_legacy()
+        indice = {}
+        for doc in col_favoritos.find({}, {"clave": 1, "user_id": 1, "_id": 0}):
+            indice.setdefault(doc["clave"], set()).add(doc["user_id"])
+        with _indice_favoritos_lock:
+            _indice_favoritos.clear()
+            _indice_favoritos.update(indice)
+    except Exception as e:
+        print("[favoritos] Error cargando índice:", e)
+
+def agregar_favorito(user_id, grupo, version, nombre):
+    clave = clave_favorito(grupo, version, nombre)
+    col_favoritos.update_one(
+        {"clave": clave, "user_id": user_id},
+        {"$setOnInsert": {"grupo": grupo, "version": version, "nombre": nombre}},
+        upsert=True
+    )
+    with _indice_favoritos_lock:
+        _indice_favoritos.setdefault(clave, set()).add(user_id)
+
+def quitar_favorito(user_id, grupo, version, nombre):
+    clave = clave_favorito(grupo, version, nombre)
+    col_favoritos.delete_one({"clave": clave, "user_id": user_id})
+    with _indice_favoritos_lock:
+        fans = _indice_favoritos.get(clave)
+        if fans:
+            fans.discard(user_id)
+            if not fans:
+                _indice_favoritos.pop(clave, None)
+
+def usuarios_con_favorito(grupo, version, nombre):
+    with _indice_favoritos_lock:
+        fans = set(_indice_favoritos.get(clave_favorito(grupo, version, nombre), ()))
+    FAVORITOS_STATS["consultas"] += 1
+    if fans:
+        FAVORITOS_STATS["con_fans"] += 1
+    return fans
+
+def estadisticas_favoritos():
+    with _indice_favoritos_lock:
+        claves  = len(_indice_favoritos)
+        entradas= sum(len(v) for v in _indice_favoritos.values())
+    st = FAVORITOS_STATS
+    return (
+        f"⭐ <b>Índice de favoritos</b>\n"
+        f"• Cartas: <b>{claves}</b> · Favoritos: <b>{entradas}</b>\n"
+        f"• Consultas al reclamar: <b>{st['consultas']}</b> · Con fans: <b>{st['con_fans']}</b>\n"
+    )
+
+METRICAS_RENDIMIENTO["favoritos"] = estadisticas_favoritos
+cargar_indice_favoritos()
+
 # ─── Favoritos ────────────────────────────────────────────────────────────────
 @log_command
 @en_tema_asignado_o_privado("favoritos")
@@ -2902,10 +4808,12 @@ def comando_fav(update, context):
     if ya_es_fav:
         favoritos = [f for f in favoritos if normalizar_nombre_carta(f"{f['grupo']} [{f['version']}] {f['nombre']}") != nombre_norm]
         col_usuarios.update_one({"user_id": user_id}, {"$set": {"favoritos": favoritos}}, upsert=True)
+        quitar_favorito(user_id, grupo, version, nombre)
         update.message.reply_text(f"❌ Quitaste de favoritos: <code>{grupo} [{version}] {nombre}</code>", parse_mode="HTML")
     else:
         favoritos.append({"grupo": grupo, "nombre": nombre, "version": version})
         col_usuarios.update_one({"user_id": user_id}, {"$set": {"favoritos": favoritos}}, upsert=True)
+        agregar_favorito(user_id, grupo, version, nombre)
         update.message.reply_text(f"⭐ Añadiste a favoritos: <code>{grupo} [{version}] {nombre}</code>", parse_mode="HTML")
 
 # ─── Precio ───────────────────────────────────────────────────────────────────
@@ -2948,6 +4856,7 @@ def comando_vender(update, context):
     card_id   = carta.get('card_id', extraer_card_id_de_id_unico(id_unico))
     precio    = precio_carta_tabla(estrellas, card_id)
     col_cartas_usuario.delete_one({"user_id": user_id, "id_unico": id_unico})
+    actualizar_resumen_coleccion(user_id, salidas=[carta])
     col_mercado.insert_one({
         "id_unico": id_unico, "vendedor_id": user_id,
         "nombre": carta['nombre'], "version": carta['version'],
@@ -2999,6 +4908,7 @@ def comando_comprar(update, context):
     if not carta.get('estrellas'): carta['estrellas'] = estrellas
     if not carta.get('card_id'):   carta['card_id']   = card_id
     col_cartas_usuario.insert_one(carta)
+    actualizar_resumen_coleccion(user_id, entradas=[carta])
     revisar_sets_completados(user_id, context)
 
     update.message.reply_text(
@@ -3058,6 +4968,7 @@ def comando_retirar(update, context):
                 carta['estrellas'] = c.get('estado_estrella', '★??')
                 break
     col_cartas_usuario.insert_one(carta)
+    actualizar_resumen_coleccion(user_id, entradas=[carta])
     update.message.reply_text("Carta retirada del mercado y devuelta a tu álbum.")
 
 # ─── Saldo / Gemas ───────────────────────────────────────────────────────────
@@ -3110,15 +5021,17 @@ def mostrar_carta_individual(chat_id, user_id, lista_cartas, idx, context, mensa
     id_unico  = carta.get('id_unico', '')
     texto     = f"<b>[{version}] {nombre}</b>\nID: <code>{id_unico}</code>\n"
     if query is not None:
-        try:
-            query.edit_message_media(
-                media=InputMediaPhoto(media=imagen_url, caption=texto, parse_mode='HTML'),
+        def editar(photo, **kwargs):
+            return query.edit_message_media(
+                media=InputMediaPhoto(media=photo, caption=texto, parse_mode='HTML'),
                 reply_markup=query.message.reply_markup
             )
+        try:
+            enviar_foto_cacheada(editar, imagen_url)
         except Exception:
             query.answer("No se pudo actualizar la imagen.", show_alert=True)
     else:
-        context.bot.send_photo(chat_id=chat_id, photo=imagen_url, caption=texto, parse_mode='HTML')
+        enviar_foto_cacheada(lambda **kw: context.bot.send_photo(chat_id=chat_id, **kw), imagen_url, caption=texto, parse_mode='HTML')
 
 @en_tema_asignado_o_privado("miid")
 def comando_miid(update, context):
@@ -3202,7 +5115,7 @@ def comando_ampliar(update, context, id_unico=None):
     teclado = InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Poner en el mercado", callback_data=f"ampliar_vender_{id_unico}")]]) if fuente == "album" else None
 
     try:
-        enviar(photo=imagen_url, caption=texto, parse_mode='HTML', reply_markup=teclado)
+        enviar_foto_cacheada(enviar, imagen_url, caption=texto, parse_mode='HTML', reply_markup=teclado)
     except Exception:
         enviar(caption=f"[Imagen no disponible]\n\n{texto}", parse_mode='HTML', reply_markup=teclado)
 
@@ -3263,6 +5176,8 @@ def comando_giveidol(update, context):
     col_cartas_usuario.delete_one({"user_id": user_id, "id_unico": id_unico})
     carta["user_id"] = target_user_id
     col_cartas_usuario.insert_one(carta)
+    actualizar_resumen_coleccion(user_id, salidas=[carta])
+    actualizar_resumen_coleccion(target_user_id, entradas=[carta])
     update.message.reply_text(f"🎁 Carta [{id_unico}] enviada a <b>@{user_dest.lstrip('@')}</b>!", parse_mode='HTML')
     try:
         context.bot.send_message(chat_id=target_user_id, text=f"🎉 ¡Recibiste la carta <b>{id_unico}</b>! Revisa tu /album.", parse_mode='HTML')
@@ -3276,19 +5191,19 @@ def mostrar_setsprogreso(update, context, pagina=1, mensaje=None, editar=False,
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     sets    = obtener_sets_disponibles()
-    cartas_usuario  = list(col_cartas_usuario.find({"user_id": user_id}))
-    cartas_u_unicas = set((c.get("grupo", c.get("set")), c["nombre"], c["version"]) for c in cartas_usuario)
+    resumen = obtener_resumen_coleccion(user_id, ["sets", "total"])
+    sets_usuario = resumen.get("sets", {})
 
     por_pagina = 5; total = len(sets)
     paginas    = (total-1)//por_pagina+1
     pagina     = max(1, min(pagina, paginas))
     inicio     = (pagina-1)*por_pagina; fin = min(inicio+por_pagina, total)
-    texto = "<b>📚 Progreso de sets:</b>\n\n"
+    texto = f"<b>📚 Progreso de sets:</b>\n🃏 Cartas en tu álbum: <b>{resumen.get('total', 0)}</b>\n\n"
 
     for s in sets[inicio:fin]:
         cartas_set = SETS_PRECALCULADOS.get(s, set())
         total_set  = len(cartas_set)
-        usuario_tiene = sum(1 for (n, v) in cartas_set if (s, n, v) in cartas_u_unicas)
+        usuario_tiene = min(sets_usuario.get(_campo_resumen(s), 0), total_set)
         emoji = "🌟" if usuario_tiene == total_set else ("⭐" if usuario_tiene >= total_set//2 else ("🔸" if usuario_tiene > 0 else "⬜"))
         bloques_llenos = int((usuario_tiene / total_set) * 10) if total_set > 0 else 0
         barra = "🟩" * bloques_llenos + "⬜" * (10 - bloques_llenos)
@@ -3356,12 +5271,15 @@ def mostrar_detalle_set(update, context, set_name, user_id, pagina=1, mensaje=No
     pagina     = max(1, min(pagina, paginas))
     inicio     = (pagina-1)*por_pagina; fin = min(inicio+por_pagina, total)
 
-    cartas_usuario  = list(col_cartas_usuario.find({"user_id": user_id}))
-    cartas_u_unicas = set((c["nombre"], c["version"], c.get("grupo", set_name)) for c in cartas_usuario)
-    user_doc        = col_usuarios.find_one({"user_id": user_id}) or {}
+    claves_usuario  = obtener_resumen_coleccion(user_id, ["claves"]).get("claves", {})
+    cartas_u_unicas = set(
+        (c["nombre"], c["version"], c.get("grupo", set_name)) for c in cartas_set_unicas
+        if claves_usuario.get(clave_resumen(c.get("grupo", set_name), c["nombre"], c["version"]), 0) > 0
+    )
+    user_doc        = col_usuarios.find_one({"user_id": user_id}, {"favoritos": 1}) or {}
     favoritos       = user_doc.get("favoritos", [])
 
-    usuario_tiene   = sum(1 for c in cartas_set_unicas if (c["nombre"], c["version"], c.get("grupo", set_name)) in cartas_u_unicas)
+    usuario_tiene   = len(cartas_u_unicas)
     bloques_llenos  = int((usuario_tiene / total) * 10) if total > 0 else 0
     barra = "🟩" * bloques_llenos + "⬜" * (10 - bloques_llenos)
     texto = f"<b>🌟 Set: {set_name} ({usuario_tiene}/{total})</b>\n{barra}\n\n"
@@ -3437,6 +5355,7 @@ def callback_ampliar_vender(update, context):
     precio    = precio_carta_tabla(estrellas, card_id)
 
     col_cartas_usuario.delete_one({"user_id": user_id, "id_unico": id_unico})
+    actualizar_resumen_coleccion(user_id, salidas=[carta])
     col_mercado.insert_one({
         "id_unico": id_unico, "vendedor_id": user_id,
         "nombre": carta['nombre'], "version": carta['version'],
@@ -3524,6 +5443,7 @@ def callback_confirmar_mejora(update, context):
                 {"user_id": user_id, "id_unico": id_unico},
                 {"$set": {"estrellas": est_nuevo, "estado": nuevo_estado, "imagen": nueva_imagen}}
             )
+            cambiar_estrellas_resumen(user_id, est_actual, est_nuevo)
             resultado = f"¡Éxito! Tu carta ahora es <b>{est_nuevo}</b> — <b>{nuevo_estado}</b>."
         else:
             resultado = "Fallaste el intento. La carta se mantiene igual."
@@ -3673,6 +5593,8 @@ def handler_regalo_respuesta(update, context):
 
     carta["user_id"] = target_user_id
     col_cartas_usuario.insert_one(carta)
+    actualizar_resumen_coleccion(user_id, salidas=[carta])
+    actualizar_resumen_coleccion(target_user_id, entradas=[carta])
     update.message.reply_text(f"🎁 ¡Carta [{carta['id_unico']}] enviada correctamente!")
     try:
         context.bot.send_message(
@@ -3742,10 +5664,12 @@ dispatcher.add_handler(CommandHandler('vender',                comando_vender))
 dispatcher.add_handler(CommandHandler('comprar',               comando_comprar))
 dispatcher.add_handler(CommandHandler('retirar',               comando_retirar))
 dispatcher.add_handler(CommandHandler('mejorar',               comando_mejorar))
+dispatcher.add_handler(CommandHandler('rendimiento',           comando_rendimiento))
 
 dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, mensaje_trade_id))
 dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handler_regalo_respuesta))
 dispatcher.add_handler(MessageHandler(Filters.all, borrar_mensajes_no_idolday), group=99)
+dispatcher.add_handler(ChatMemberHandler(actualizar_admins_por_evento, ChatMemberHandler.CHAT_MEMBER), group=98)
 
 # ─── Arranque ─────────────────────────────────────────────────────────────────
 
@@ -3782,7 +5706,19 @@ if __name__ == '__main__':
     # Iniciar proceso de sorteos en background
     iniciar_proceso_sorteos(updater.dispatcher)
 
+    # Precalentar caché de imágenes con el pool de drops
+    iniciar_precalentado_imagenes({c["imagen"] for c in POOL_DROP["cartas"] if c.get("imagen")})
+
+    # Mantener drops listos para cada grupo permitido
+    iniciar_productor_drops()
+    iniciar_escritor_drops_log()
+    iniciar_recordatorios_idolday()
+
     # Arrancar polling
-    updater.start_polling(poll_interval=1.0, timeout=20, drop_pending_updates=True)
+    # chat_member no llega por defecto; se pide para mantener la caché de admins
+    updater.start_polling(poll_interval=1.0, timeout=20, drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
     logger.info("[startup] Bot corriendo. Ctrl+C para detener.")
     updater.idle()
+    vaciar_drops_log()
+    liberar_drops_precalculados()
+    liberar_seriales_reservados()
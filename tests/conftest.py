@@ -0,0 +1,41 @@
+import ast
+import pathlib
+
+import pytest
+
+MAIN = pathlib.Path(__file__).resolve().parent.parent / "main.py"
+_ARBOL = ast.parse(MAIN.read_text(encoding="utf-8"), filename=str(MAIN))
+
+
+def _nombres_asignados(nodo):
+    objetivos = nodo.targets if isinstance(nodo, ast.Assign) else [nodo.target]
+    return {n.id for t in objetivos for n in ast.walk(t) if isinstance(n, ast.Name)}
+
+
+def cargar_de_main(nombres, **globales):
+    """Ejecuta solo las definiciones `nombres` de main.py sobre `globales`.
+
+    main.py no se puede importar en los tests (al cargarse conecta con Telegram
+    y Mongo), así que se extraen las funciones y asignaciones de nivel módulo
+    pedidas, en el orden en que aparecen, y se les pasan sus dependencias.
+    """
+    nombres = set(nombres)
+    nodos = []
+    for nodo in _ARBOL.body:
+        if isinstance(nodo, (ast.FunctionDef, ast.ClassDef)) and nodo.name in nombres:
+            nodos.append(nodo)
+        elif isinstance(nodo, (ast.Assign, ast.AnnAssign)) and _nombres_asignados(nodo) & nombres:
+            nodos.append(nodo)
+    encontrados = set()
+    for nodo in nodos:
+        encontrados |= {nodo.name} if hasattr(nodo, "name") else _nombres_asignados(nodo)
+    faltan = nombres - encontrados
+    assert not faltan, f"main.py no define {sorted(faltan)}"
+    namespace = dict(globales)
+    exec(compile(ast.Module(body=nodos, type_ignores=[]), str(MAIN), "exec"), namespace)
+    return namespace
+
+
+@pytest.fixture
+def main_parcial():
+    return cargar_de_main
@@ -0,0 +1,144 @@
+import random
+
+import pytest
+
+
+def _norm(valor):
+    return valor.lower() if isinstance(valor, str) else valor
+
+
+def _cumple(doc, consulta):
+    """Subconjunto de la semántica de Mongo que usa el paginado (collation strength 2)."""
+    for campo, cond in consulta.items():
+        if campo == "$and":
+            if not all(_cumple(doc, c) for c in cond):
+                return False
+        elif campo == "$or":
+            if not any(_cumple(doc, c) for c in cond):
+                return False
+        elif isinstance(cond, dict):
+            (op, ref), = cond.items()
+            valor = _norm(doc.get(campo))
+            # Como en Mongo, $gt/$lt no comparan entre tipos distintos (ni con null)
+            if valor is None or ref is None or type(valor) is not type(_norm(ref)):
+                return False
+            if op == "$gt" and not valor > _norm(ref):
+                return False
+            if op == "$lt" and not valor < _norm(ref):
+                return False
+        elif _norm(doc.get(campo)) != _norm(cond):
+            return False
+    return True
+
+
+class CursorFalso:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, orden):
+        for campo, sentido in reversed(orden):
+            self.docs.sort(key=lambda d: _norm(d.get(campo)), reverse=sentido == -1)
+        return self
+
+    def skip(self, n):
+        self.docs = self.docs[n:]
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class ColeccionFalsa:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, consulta, proyeccion=None, collation=None):
+        return CursorFalso([d for d in self.docs if _cumple(d, consulta)])
+
+    def find_one(self, consulta, proyeccion=None):
+        return next((d for d in self.docs if _cumple(d, consulta)), None)
+
+
+def _cartas(n=47, semilla=5):
+    rnd = random.Random(semilla)
+    return [
+        {"user_id": 1, "grupo": rnd.choice(["TWICE", "aespa", "BTS"]), "nombre": rnd.choice(["Ana", "bea", "Cris"]),
+         "card_id": rnd.randint(1, 5), "id_unico": f"x{i:03d}"}
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def album(main_parcial):
+    def cargar(docs):
+        return main_parcial(
+            ["COLACION_ALBUM", "ORDENES_ALBUM", "_condicion_keyset", "pagina_cartas_usuario"],
+            col_cartas_usuario=ColeccionFalsa(docs),
+        )
+    return cargar
+
+
+def _ids(cartas):
+    return [c["id_unico"] for c in cartas]
+
+
+def test_condicion_keyset_ascendente_y_descendente(album):
+    ns = album([])
+    orden = [("card_id", 1), ("id_unico", 1)]
+    ref = {"card_id": 3, "id_unico": "x010"}
+    assert ns["_condicion_keyset"](orden, ref) == {"$or": [
+        {"card_id": {"$gt": 3}},
+        {"card_id": 3, "id_unico": {"$gt": "x010"}},
+    ]}
+    assert ns["_condicion_keyset"](orden, ref, despues=False)["$or"][0] == {"card_id": {"$lt": 3}}
+    desc = [("card_id", -1), ("id_unico", -1)]
+    assert ns["_condicion_keyset"](desc, ref)["$or"][0] == {"card_id": {"$lt": 3}}
+
+
+@pytest.mark.parametrize("orden", [None, "menor", "mayor"])
+def test_recorrido_con_cursor_igual_al_orden_completo(album, orden):
+    docs = _cartas()
+    ns = album(docs)
+    campos = ns["ORDENES_ALBUM"][orden]
+    esperado = _ids(CursorFalso(list(docs)).sort(campos))
+    paginas, cursor = [], None
+    while True:
+        pagina = ns["pagina_cartas_usuario"]({"user_id": 1}, campos, 10, cursor=cursor)
+        if not pagina:
+            break
+        paginas.append(pagina)
+        cursor = pagina[-1]["id_unico"]
+    assert [i for p in paginas for i in _ids(p)] == esperado
+    anterior = ns["pagina_cartas_usuario"]({"user_id": 1}, campos, 10, cursor=paginas[2][0]["id_unico"], despues=False)
+    assert _ids(anterior) == _ids(paginas[1])
+
+
+def test_sin_cursor_pagina_con_salto(album):
+    docs = _cartas()
+    ns = album(docs)
+    campos = ns["ORDENES_ALBUM"][None]
+    esperado = _ids(CursorFalso(list(docs)).sort(campos))
+    assert _ids(ns["pagina_cartas_usuario"]({"user_id": 1}, campos, 10, salto=20)) == esperado[20:30]
+
+
+def test_cursor_inexistente_devuelve_none(album):
+    ns = album(_cartas())
+    assert ns["pagina_cartas_usuario"]({"user_id": 1}, ns["ORDENES_ALBUM"][None], 10, cursor="vendida") is None
+
+
+def test_cursor_de_otro_usuario_devuelve_none(album):
+    docs = _cartas()
+    docs.append({"user_id": 2, "grupo": "BTS", "nombre": "Ana", "card_id": 1, "id_unico": "ajena"})
+    ns = album(docs)
+    assert ns["pagina_cartas_usuario"]({"user_id": 1}, ns["ORDENES_ALBUM"][None], 10, cursor="ajena") is None
+
+
+def test_cursor_con_campo_nulo_devuelve_none(album):
+    docs = _cartas()
+    docs.append({"user_id": 1, "grupo": "BTS", "nombre": "Ana", "id_unico": "vieja"})   # sin card_id
+    ns = album(docs)
+    assert ns["pagina_cartas_usuario"]({"user_id": 1}, ns["ORDENES_ALBUM"]["menor"], 10, cursor="vieja") is None
@@ -0,0 +1,43 @@
+import hashlib
+
+import pytest
+
+
+@pytest.fixture
+def collage(main_parcial):
+    return main_parcial(["clave_collage_album2"], hashlib=hashlib)
+
+
+def test_clave_estable_y_con_prefijo(collage):
+    urls = ["https://i.ibb.co/a.png", "https://i.ibb.co/b.png"]
+    clave = collage["clave_collage_album2"](urls)
+    assert clave == collage["clave_collage_album2"](list(urls))
+    assert clave.startswith("collage:") and len(clave) == len("collage:") + 40
+
+
+def test_clave_depende_del_orden_y_del_contenido(collage):
+    clave = collage["clave_collage_album2"]
+    assert clave(["a", "b"]) != clave(["b", "a"])
+    assert clave(["a", "b"]) != clave(["a", "b", "c"])
+    # El separador evita que dos listas distintas concatenen igual
+    assert clave(["ab", "c"]) != clave(["a", "bc"])
+
+
+def test_cuadricula_reporta_imagenes_faltantes(main_parcial, tmp_path):
+    pytest.importorskip("PIL")
+    from PIL import Image
+
+    def ejecutar_tareas_imagen(fn, urls):
+        return [fn(u) for u in urls]
+
+    def obtener_imagen_catalogo(url):
+        return None if "rota" in url else Image.new("RGBA", (4, 6), (255, 0, 0, 255))
+
+    ns = main_parcial(["crear_cuadricula_cartas_urls"], Image=Image,
+                      ejecutar_tareas_imagen=ejecutar_tareas_imagen,
+                      obtener_imagen_catalogo=obtener_imagen_catalogo)
+    salida = str(tmp_path / "c.png")
+    ruta, faltantes = ns["crear_cuadricula_cartas_urls"](["a", "rota", "b"], output_path=salida)
+    assert (ruta, faltantes) == (salida, 1)
+    assert Image.open(ruta).size == (4 * 5, 6)
+    assert ns["crear_cuadricula_cartas_urls"](["rota"], output_path=salida) == (None, 1)
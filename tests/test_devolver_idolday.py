@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+class UsuariosFalsos:
+    def __init__(self):
+        self.updates = []
+
+    def update_one(self, filtro, cambios):
+        self.updates.append((filtro, cambios))
+
+
+AHORA = datetime(2026, 1, 1, 12, 0)
+ANTES = AHORA - timedelta(hours=2)
+
+
+@pytest.fixture
+def devolver(main_parcial):
+    col = UsuariosFalsos()
+    ns = main_parcial(["devolver_idolday"], col_usuarios=col)
+    return ns["devolver_idolday"], col
+
+
+def test_cooldown_restaura_el_last_idolday_previo(devolver):
+    fn, col = devolver
+    fn(7, {"idolday_via": "cooldown", "last_idolday": ANTES - timedelta(hours=6), "last_idolday_nuevo": AHORA})
+    assert col.updates == [({"user_id": 7, "last_idolday": AHORA},
+                             {"$set": {"last_idolday": ANTES - timedelta(hours=6)}})]
+
+
+def test_cooldown_sin_previo_lo_borra(devolver):
+    fn, col = devolver
+    fn(7, {"idolday_via": "cooldown", "last_idolday": None, "last_idolday_nuevo": AHORA})
+    assert col.updates == [({"user_id": 7, "last_idolday": AHORA}, {"$unset": {"last_idolday": ""}})]
+
+
+def test_bono_de_inventario_se_devuelve_sin_tocar_cooldown(devolver):
+    fn, col = devolver
+    fn(7, {"idolday_via": "bono_idolday", "last_idolday": ANTES, "last_idolday_nuevo": ANTES})
+    assert col.updates == [({"user_id": 7}, {"$inc": {"objetos.bono_idolday": 1}})]
+
+
+def test_bono_con_cooldown_renovado_devuelve_ambos(devolver):
+    fn, col = devolver
+    fn(7, {"idolday_via": "bono", "last_idolday": ANTES, "last_idolday_nuevo": AHORA})
+    assert col.updates == [
+        ({"user_id": 7}, {"$inc": {"bono": 1}}),
+        ({"user_id": 7, "last_idolday": AHORA}, {"$set": {"last_idolday": ANTES}}),
+    ]
@@ -0,0 +1,43 @@
+import os
+import threading
+import time
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image  # noqa: E402
+
+
+@pytest.fixture
+def compuesto(main_parcial, monkeypatch):
+    monkeypatch.setenv("FORMATO_DROP", "jpeg")
+    return main_parcial(
+        ["FORMATO_DROP", "CALIDAD_DROP", "MAX_KB_DROP", "CALIDAD_MIN_DROP", "_FORMATOS_PIL",
+         "ENCODER_STATS", "_encoder_mutex", "_guardar", "codificar_imagen",
+         "SEPARACION_DROP_COMPUESTO", "imagen_drop_para_envio", "componer_imagen_drop"],
+        os=os, threading=threading, time=time, Image=Image, BytesIO=BytesIO,
+    )
+
+
+def _carta(color):
+    return Image.new("RGBA", (30, 40), color)
+
+
+def test_compone_desde_image_y_codifica_una_sola_vez(compuesto):
+    salida = compuesto["componer_imagen_drop"]([_carta((255, 0, 0, 255)), _carta((0, 0, 255, 255))])
+    assert Image.open(salida).size == (30 * 2 + compuesto["SEPARACION_DROP_COMPUESTO"], 40)
+    assert compuesto["ENCODER_STATS"]["jpeg"]["n"] == 1
+
+
+def test_falta_una_carta_devuelve_none(compuesto):
+    assert compuesto["componer_imagen_drop"]([_carta((255, 0, 0, 255)), None]) is None
+    assert compuesto["componer_imagen_drop"]([]) is None
+    assert compuesto["ENCODER_STATS"] == {}
+
+
+def test_imagen_para_envio_codifica_image_y_rebobina_bytes(compuesto):
+    codificada = compuesto["imagen_drop_para_envio"](_carta((0, 255, 0, 255)))
+    assert codificada.name == "carta.jpg" and codificada.tell() == 0
+    codificada.read()
+    assert compuesto["imagen_drop_para_envio"](codificada).tell() == 0
@@ -0,0 +1,57 @@
+import os
+import random
+import threading
+import time
+from io import BytesIO
+
+import pytest
+
+PIL = pytest.importorskip("PIL")
+from PIL import Image  # noqa: E402
+
+
+@pytest.fixture
+def encoder(main_parcial):
+    return main_parcial(
+        ["FORMATO_DROP", "CALIDAD_DROP", "MAX_KB_DROP", "CALIDAD_MIN_DROP", "_FORMATOS_PIL",
+         "ENCODER_STATS", "_encoder_mutex", "_guardar", "codificar_imagen"],
+        os=os, threading=threading, time=time, Image=Image, BytesIO=BytesIO,
+    )
+
+
+def _imagen_ruido(lado=256):
+    rnd = random.Random(1)
+    img = Image.new("RGB", (lado, lado))
+    img.putdata([(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for _ in range(lado * lado)])
+    return img
+
+
+def test_jpeg_respeta_presupuesto_de_kb(encoder):
+    img = _imagen_ruido()
+    sin_limite = encoder["codificar_imagen"](img, formato="jpeg", calidad=95, max_kb=0)
+    tam_sin_limite = len(sin_limite.getvalue())
+    presupuesto_kb = tam_sin_limite // 1024 // 2
+    salida = encoder["codificar_imagen"](img, formato="jpeg", calidad=95, max_kb=presupuesto_kb)
+    assert len(salida.getvalue()) <= presupuesto_kb * 1024
+    assert salida.tell() == 0
+    assert salida.name == "carta.jpg"
+
+
+def test_presupuesto_imposible_usa_calidad_minima(encoder):
+    img = _imagen_ruido()
+    salida = encoder["codificar_imagen"](img, formato="jpeg", calidad=95, max_kb=1)
+    minima = encoder["_guardar"](img, "JPEG", encoder["CALIDAD_MIN_DROP"])
+    assert len(salida.getvalue()) == minima.tell()
+
+
+def test_png_ignora_presupuesto_y_registra_stats(encoder):
+    img = _imagen_ruido(64).convert("RGBA")
+    salida = encoder["codificar_imagen"](img, formato="png", max_kb=1)
+    assert salida.name == "carta.png"
+    assert Image.open(salida).size == (64, 64)
+    assert encoder["ENCODER_STATS"]["png"]["n"] == 1
+
+
+def test_formato_desconocido_cae_a_png(encoder):
+    salida = encoder["codificar_imagen"](_imagen_ruido(8), formato="bmp")
+    assert salida.name == "carta.png"
@@ -0,0 +1,92 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+import pytest
+
+
+class RelojFalso:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def time(self):
+        return self.ahora
+
+
+@pytest.fixture
+def limitador(main_parcial):
+    reloj = RelojFalso()
+    ns = main_parcial(
+        ["LIMITES_POR_DEFECTO", "LIMITES_COMANDOS", "LIMITADOR_MAX_CLAVES", "_cubos", "_cubos_mutex",
+         "LIMITADOR_STATS", "LIMITADOR_TOTALES", "_limite", "_fichas_actuales", "tomar_ficha",
+         "devolver_ficha", "purgar_cubos_inactivos"],
+        os=os, threading=threading, time=reloj, OrderedDict=OrderedDict, math=math, wraps=wraps,
+    )
+    ns["reloj"] = reloj
+    ns["LIMITES_COMANDOS"].clear()
+    ns["LIMITES_COMANDOS"]["prueba"] = {"usuario": (2, 5.0), "grupo": (1, 1.0)}
+    return ns
+
+
+def test_rafaga_y_recarga(limitador):
+    tomar, reloj = limitador["tomar_ficha"], limitador["reloj"]
+    assert tomar("prueba", usuario=1)[0]
+    assert tomar("prueba", usuario=1)[0]
+    ok, espera, ambito = tomar("prueba", usuario=1)
+    assert (ok, ambito) == (False, "usuario")
+    assert espera == pytest.approx(5.0)
+    reloj.ahora += 2.5
+    ok, espera, _ = tomar("prueba", usuario=1)
+    assert not ok and espera == pytest.approx(2.5)
+    reloj.ahora += 2.5
+    assert tomar("prueba", usuario=1)[0]
+
+
+def test_la_recarga_no_supera_la_capacidad(limitador):
+    tomar, reloj = limitador["tomar_ficha"], limitador["reloj"]
+    tomar("prueba", usuario=1)
+    reloj.ahora += 3600
+    assert [tomar("prueba", usuario=1)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_todo_o_nada_entre_usuario_y_grupo(limitador):
+    tomar = limitador["tomar_ficha"]
+    assert tomar("prueba", usuario=1, grupo=9)[0]
+    ok, _, ambito = tomar("prueba", usuario=2, grupo=9)
+    assert (ok, ambito) == (False, "grupo")
+    # El rechazo del grupo no gastó la ficha del usuario 2
+    assert limitador["_fichas_actuales"](("prueba", "usuario", 2), (2, 5.0), limitador["reloj"].time()) == 2
+    assert limitador["LIMITADOR_STATS"]["prueba"] == {"permitidos": 1, "rechazados": 1}
+
+
+def test_devolver_ficha(limitador):
+    tomar = limitador["tomar_ficha"]
+    assert tomar("prueba", grupo=9)[0]
+    assert not tomar("prueba", grupo=9)[0]
+    limitador["devolver_ficha"]("prueba", grupo=9)
+    assert tomar("prueba", grupo=9)[0]
+
+
+def test_comando_sin_limite_propio_usa_el_por_defecto(limitador):
+    assert limitador["_limite"]("otro", "usuario") == limitador["LIMITES_POR_DEFECTO"]["usuario"]
+
+
+def test_purga_borra_cubos_llenos(limitador):
+    tomar, reloj = limitador["tomar_ficha"], limitador["reloj"]
+    tomar("prueba", usuario=1)
+    tomar("prueba", grupo=9)
+    reloj.ahora += 1.0   # el cubo de grupo (1 ficha/s) ya está lleno; el de usuario no
+    limitador["purgar_cubos_inactivos"]()
+    assert list(limitador["_cubos"]) == [("prueba", "usuario", 1)]
+    assert limitador["LIMITADOR_TOTALES"]["purgados"] == 1
+
+
+def test_expulsa_el_menos_usado_al_pasar_el_maximo(limitador):
+    limitador["LIMITADOR_MAX_CLAVES"] = 2
+    tomar = limitador["tomar_ficha"]
+    for uid in (1, 2, 3):
+        tomar("prueba", usuario=uid)
+    assert [clave[2] for clave in limitador["_cubos"]] == [2, 3]
+    assert limitador["LIMITADOR_TOTALES"]["expulsados"] == 1
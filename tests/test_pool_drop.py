@@ -0,0 +1,74 @@
+import collections
+import json
+import os
+import random
+
+import pytest
+
+
+def _carta(nombre, version="V1", grupo="G", estado="Excelente estado", rareza="Común"):
+    return {"nombre": nombre, "version": version, "grupo": grupo, "estado": estado, "rareza": rareza}
+
+
+@pytest.fixture
+def pool_drop(main_parcial, monkeypatch):
+    def cargar(pesos_grupo=None, pesos_rareza=None):
+        monkeypatch.setenv("PESOS_GRUPO_DROP", json.dumps(pesos_grupo or {}))
+        monkeypatch.setenv("PESOS_RAREZA_DROP", json.dumps(pesos_rareza or {}))
+        return main_parcial(
+            ["_pesos_drop_env", "PESOS_RAREZA_DROP", "PESOS_GRUPO_DROP", "_peso_carta_drop",
+             "construir_pool_drop", "_extraer_indice", "sortear_cartas_drop"],
+            os=os, json=json, random=random, POOL_DROP=None,
+        )
+    return cargar
+
+
+def test_solo_cartas_unicas_en_excelente_estado(pool_drop):
+    ns = pool_drop()
+    pool = ns["construir_pool_drop"]([
+        _carta("A"), _carta("A"), _carta("A", version="V2"),
+        _carta("B", estado="Mal estado"),
+    ])
+    assert sorted((c["nombre"], c["version"]) for c in pool["cartas"]) == [("A", "V1"), ("A", "V2")]
+    assert all(0.0 <= p <= 1.0 for p in pool["prob"])
+
+
+def test_peso_cero_excluye_la_carta(pool_drop):
+    ns = pool_drop(pesos_grupo={"X": 0})
+    pool = ns["construir_pool_drop"]([_carta("A"), _carta("B", grupo="X")])
+    assert [c["nombre"] for c in pool["cartas"]] == ["A"]
+
+
+def test_muestreo_alias_respeta_los_pesos(pool_drop):
+    ns = pool_drop(pesos_grupo={"Pesado": 3}, pesos_rareza={"Rara": 0.5})
+    pool = ns["construir_pool_drop"]([
+        _carta("liviana"), _carta("pesada", grupo="Pesado"), _carta("rara", rareza="Rara"),
+    ])
+    random.seed(7)
+    conteo = collections.Counter(pool["cartas"][ns["_extraer_indice"](pool)]["nombre"] for _ in range(45000))
+    # Pesos 1 : 3 : 0.5 sobre un total de 4.5
+    assert conteo["liviana"] / 45000 == pytest.approx(1 / 4.5, abs=0.01)
+    assert conteo["pesada"] / 45000 == pytest.approx(3 / 4.5, abs=0.01)
+    assert conteo["rara"] / 45000 == pytest.approx(0.5 / 4.5, abs=0.01)
+
+
+def test_json_invalido_se_ignora(pool_drop, monkeypatch):
+    ns = pool_drop()
+    monkeypatch.setenv("PESOS_GRUPO_DROP", "{no json")
+    assert ns["_pesos_drop_env"]("PESOS_GRUPO_DROP") == {}
+
+
+def test_sortear_devuelve_cartas_distintas(pool_drop):
+    ns = pool_drop()
+    pool = ns["construir_pool_drop"]([_carta(n) for n in "ABCDE"])
+    random.seed(3)
+    for _ in range(200):
+        elegidas = ns["sortear_cartas_drop"](2, pool=pool)
+        assert len({c["nombre"] for c in elegidas}) == 2
+
+
+def test_pool_chico_permite_repetidas_y_vacio_no_sortea(pool_drop):
+    ns = pool_drop()
+    pool = ns["construir_pool_drop"]([_carta("A")])
+    assert [c["nombre"] for c in ns["sortear_cartas_drop"](2, pool=pool)] == ["A", "A"]
+    assert ns["sortear_cartas_drop"](2, pool=ns["construir_pool_drop"]([])) == []